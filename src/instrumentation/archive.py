@@ -0,0 +1,582 @@
+'''
+Chunked, compressed archive of a recording with a time index, so the few
+seconds around ignition can be read from a long firing without reading
+the rest of it.
+
+Frames are grouped into chunks of chunk_duration seconds on the recording
+time axis (chunk k holds k * chunk_duration <= timestamp < (k + 1) *
+chunk_duration) and each chunk is compressed on its own with zlib or lzma.
+Every chunk has an index entry with its time span and the min, max and mean
+of each channel, so reading a time window only decompresses the chunks it
+overlaps and an overview of a whole firing decompresses nothing.
+
+    magic        8 bytes  b'PDPARC01'
+    length       uint32   length of the JSON header in bytes
+    header       JSON     {"version", "dtype", "channels", "metadata",
+                           "compression", "chunk_duration"}
+    chunks       index entry (see index_dtype()), then the compressed frames:
+                 every timestamp, then every value of each channel in turn
+    index        every index entry again, back to back
+    trailer      '<QQ8s'  index offset, number of chunks, b'PDPARCIX'
+
+Values are stored channel by channel rather than frame by frame, similar
+bytes next to each other compress better. Each chunk carries its own index
+entry, so an archive cut short by a power loss, without the index, is read
+by walking the chunks instead.
+
+Run as a script to archive a recording, or to read from an archive:
+    python archive.py instrumentation_data.pdprec --archive firing.pdparc --lzma
+    python archive.py firing.pdparc --info
+    python archive.py firing.pdparc --range 1712345678 1712345680.5 --csv ignition.csv
+'''
+import io
+import os
+import sys
+import json
+import lzma
+import math
+import time
+import zlib
+import queue
+import struct
+import argparse
+import contextlib
+import warnings
+import threading
+import numpy as np
+
+MAGIC = b'PDPARC01'
+INDEX_MAGIC = b'PDPARCIX'
+VERSION = 1
+PREAMBLE_FORMAT = '<8sI'
+TRAILER_FORMAT = '<QQ8s'
+
+ZLIB = 'zlib'
+LZMA = 'lzma'
+COMPRESSIONS = (ZLIB, LZMA)
+
+# The archive read_labjack.py writes and the websocket server answers HISTORY
+# requests from
+INSTRUMENTATION_ARCHIVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instrumentation_data.pdparc')
+
+# Seconds of frames in each chunk, the smallest window that is decompressed
+DEFAULT_CHUNK_DURATION = 1.0
+
+# Statistics of an ArchiveWriter, see ArchiveWriter.status()
+ARCHIVE_STATUS = ('pending', 'ratio', 'written_mb', 'compress_mb_per_s')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def index_dtype(num_channels: int) -> np.dtype:
+    '''
+    Name:
+        index_dtype(num_channels= int) -> np.dtype
+    Returns:
+        The dtype of one index entry: the offset and size of the compressed
+        chunk, its number of frames, first and last timestamp, and the
+        number of values, min, max and mean of each channel ignoring gap
+        markers (NaN if the chunk has no value for the channel)
+    '''
+    return np.dtype([
+        ('offset', '<u8'),
+        ('size', '<u8'),
+        ('frames', '<u8'),
+        ('start', '<f8'),
+        ('end', '<f8'),
+        ('count', '<u8', (num_channels,)),
+        ('min', '<f8', (num_channels,)),
+        ('max', '<f8', (num_channels,)),
+        ('mean', '<f8', (num_channels,))])
+
+
+class ArchiveWriter(threading.Thread):
+    '''
+    Name:
+        ArchiveWriter
+    Desc:
+        Writes an archive from a stream of frames. write_frames() only
+        gathers frames into the current chunk. Each complete chunk is
+        compressed and written by a background thread, zlib and lzma release
+        the GIL so compression runs beside the caller rather than in its way.
+
+        An error writing the file stops the thread and is raised by the
+        next write or close().
+
+        An archive already at path is replaced, not truncated: the new one
+        is started beside it and swapped in once its header is written, so
+        a reader with the previous firing open keeps reading it.
+
+    Public:
+        path: the archive file
+        channels: list of channel description dicts, as in a recording
+        compression: ZLIB or LZMA
+        chunk_duration: seconds of frames in each chunk
+        chunks_queued: chunks complete so far
+        chunks_written: chunks compressed and written so far
+    '''
+    def __init__(
+        self,
+        path: str,
+        channels: list,
+        value_dtype: str = 'float32',
+        metadata: dict = None,
+        compression: str = ZLIB,
+        chunk_duration: float = DEFAULT_CHUNK_DURATION
+    ):
+        if compression not in COMPRESSIONS:
+            raise ArchiveError(f"Unknown compression {compression}, expected one of {COMPRESSIONS}")
+        if value_dtype not in ('float32', 'float64'):
+            raise ArchiveError(f"Unsupported value dtype: {value_dtype}")
+
+        super().__init__(name="ArchiveWriter", daemon=True)
+        self.path = path
+        self.channels = channels
+        self.compression = compression
+        self.chunk_duration = chunk_duration
+        self.chunks_queued = 0
+        self.chunks_written = 0
+
+        self.__value_dtype = np.dtype(value_dtype).newbyteorder('<')
+        self.__index_dtype = index_dtype(len(channels))
+        self.__queue = queue.SimpleQueue()
+        self.__pending = []
+        self.__chunk = None
+        self.__index = []
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__compress_time = 0.0
+        self.__error = None
+
+        header = json.dumps({
+            'version': VERSION,
+            'dtype': value_dtype,
+            'channels': channels,
+            'metadata': metadata or {},
+            'compression': compression,
+            'chunk_duration': chunk_duration
+        }).encode()
+        staging = f'{path}.{os.getpid()}'
+        self.__file = open(staging, 'wb')
+        self.__file.write(struct.pack(PREAMBLE_FORMAT, MAGIC, len(header)))
+        self.__file.write(header)
+        self.__file.flush()
+        os.replace(staging, path)
+
+
+    def write_frames(self, timestamps, values) -> None:
+        '''
+        Name:
+            ArchiveWriter.write_frames(timestamps= np.ndarray, values= np.ndarray) -> None
+        Args:
+            timestamps: array of N frame times, in order
+            values: N x channels array of values
+        Desc:
+            Adds the frames to their chunks and queues every chunk they
+            complete. The arrays are copied, they can be reused.
+        '''
+        if self.__error is not None:
+            raise self.__error
+
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        numbers = np.floor(timestamps / self.chunk_duration)
+        for part in np.split(np.arange(len(timestamps)), np.flatnonzero(np.diff(numbers)) + 1):
+            if not len(part):
+                continue
+            if self.__chunk is not None and numbers[part[0]] != self.__chunk:
+                self.__end_chunk()
+            self.__chunk = numbers[part[0]]
+            self.__pending.append((timestamps[part], np.asarray(values)[part].astype(self.__value_dtype)))
+
+
+    def status(self) -> dict:
+        '''
+        Name:
+            ArchiveWriter.status() -> dict
+        Returns:
+            Each of ARCHIVE_STATUS: chunks waiting to be compressed, the
+            compression ratio, MB written, and MB/s compressed
+        '''
+        return {
+            'pending': self.chunks_queued - self.chunks_written,
+            'ratio': self.__bytes_in / self.__bytes_out if self.__bytes_out else 0.0,
+            'written_mb': self.__bytes_out / 1e6,
+            'compress_mb_per_s': self.__bytes_in / 1e6 / self.__compress_time if self.__compress_time else 0.0
+        }
+
+
+    def run(self) -> None:
+        try:
+            while (chunk := self.__queue.get()) is not None:
+                self.__write_chunk(*chunk)
+        except OSError as error:
+            self.__error = error
+
+
+    def close(self) -> None:
+        '''
+        Name:
+            ArchiveWriter.close() -> None
+        Desc:
+            Writes the last chunk, then the index and trailer
+        '''
+        self.__end_chunk()
+        if self.is_alive():
+            self.__queue.put(None)
+            self.join()
+        else:
+            # Never started, write everything here
+            while not self.__queue.empty():
+                self.__write_chunk(*self.__queue.get())
+
+        if self.__error is None:
+            index = np.concatenate(self.__index) if self.__index else np.empty(0, dtype=self.__index_dtype)
+            offset = self.__file.tell()
+            self.__file.write(index.tobytes())
+            self.__file.write(struct.pack(TRAILER_FORMAT, offset, len(index), INDEX_MAGIC))
+        self.__file.close()
+
+        if self.__error is not None:
+            raise self.__error
+
+
+    def __end_chunk(self) -> None:
+        if self.__pending:
+            timestamps = np.concatenate([part[0] for part in self.__pending])
+            values = np.concatenate([part[1] for part in self.__pending])
+            self.__queue.put((timestamps, values))
+            self.chunks_queued += 1
+        self.__pending = []
+
+
+    def __write_chunk(self, timestamps: np.ndarray, values: np.ndarray) -> None:
+        started = time.monotonic()
+        frames = timestamps.tobytes() + np.ascontiguousarray(values.T).tobytes()
+        data = zlib.compress(frames) if self.compression == ZLIB else lzma.compress(frames)
+
+        entry = np.zeros(1, dtype=self.__index_dtype)
+        entry['offset'] = self.__file.tell() + self.__index_dtype.itemsize
+        entry['size'] = len(data)
+        entry['frames'] = len(timestamps)
+        entry['start'] = timestamps[0]
+        entry['end'] = timestamps[-1]
+
+        # A channel can be all gap markers, its statistics are then NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            entry['count'] = np.count_nonzero(~np.isnan(values), axis=0)
+            entry['min'] = np.nanmin(values, axis=0)
+            entry['max'] = np.nanmax(values, axis=0)
+            entry['mean'] = np.nanmean(values, axis=0, dtype=np.float64)
+
+        self.__file.write(entry.tobytes())
+        self.__file.write(data)
+        self.__file.flush()
+
+        self.__index.append(entry)
+        self.__bytes_in += len(frames)
+        self.__bytes_out += entry.nbytes + len(data)
+        self.__compress_time += time.monotonic() - started
+        self.chunks_written += 1
+
+
+class ArchiveReader:
+    '''
+    Name:
+        ArchiveReader
+    Desc:
+        Reads time windows of an archive. The index is loaded once, every
+        read only decompresses the chunks the window overlaps. Safe to use
+        from several threads.
+
+        An archive still being written has no index yet. refresh() adds the
+        chunks written since, reading only their index entries, and
+        replaced() tells when a new firing has replaced the archive.
+
+    Public:
+        path: the archive file
+        header: the decoded JSON header
+        channels: list of channel description dicts
+        index: one index entry per chunk, in time order
+    '''
+    def __init__(self, path: str):
+        self.path = path
+
+        self.__file = open(path, 'rb')
+        self.__lock = threading.Lock()
+        stat = os.fstat(self.__file.fileno())
+        self.__file_id = (stat.st_dev, stat.st_ino)
+
+        preamble = self.__file.read(struct.calcsize(PREAMBLE_FORMAT))
+        if len(preamble) < struct.calcsize(PREAMBLE_FORMAT) or struct.unpack(PREAMBLE_FORMAT, preamble)[0] != MAGIC:
+            self.__file.close()
+            raise ArchiveError(f"{path} is not a PDP archive")
+
+        length = struct.unpack(PREAMBLE_FORMAT, preamble)[1]
+        self.header = json.loads(self.__file.read(length))
+        self.channels = self.header['channels']
+
+        self.__value_dtype = np.dtype(self.header['dtype']).newbyteorder('<')
+        self.__index_dtype = index_dtype(len(self.channels))
+        self.__first_chunk = struct.calcsize(PREAMBLE_FORMAT) + length
+        self.__position = self.__first_chunk
+        self.__complete = False
+        self.index = np.empty(0, dtype=self.__index_dtype)
+        self.index = self.__read_index()
+
+
+    def refresh(self) -> None:
+        '''
+        Name:
+            ArchiveReader.refresh() -> None
+        Desc:
+            Adds the chunks written since the index was read, or the whole
+            index once the writer has closed. Only the new index entries are
+            read, the chunks already indexed are not touched again.
+        '''
+        with self.__lock:
+            if not self.__complete:
+                self.index = self.__read_index()
+
+
+    def replaced(self) -> bool:
+        '''
+        Name:
+            ArchiveReader.replaced() -> bool
+        Returns:
+            True if path is now a different archive or gone, this reader
+            still reads the one it opened
+        '''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return (stat.st_dev, stat.st_ino) != self.__file_id
+
+
+    def chunks(self, start: float = -math.inf, end: float = math.inf) -> np.ndarray:
+        '''
+        Name:
+            ArchiveReader.chunks(start= float, end= float) -> np.ndarray
+        Returns:
+            The index entries of the chunks with frames between start and
+            end, with their statistics, without decompressing anything
+        '''
+        return self.index[(self.index['end'] >= start) & (self.index['start'] <= end)]
+
+
+    def read(self, start: float = -math.inf, end: float = math.inf, channels: list = None) -> tuple:
+        '''
+        Name:
+            ArchiveReader.read(start= float, end= float, channels= list) -> (np.ndarray, np.ndarray)
+        Args:
+            start, end: the time window, inclusive
+            channels: indices of the channels to return, all if None
+        Returns:
+            The timestamps of every frame in the window and a frames x
+            channels array of their values
+        '''
+        parts = [self.read_chunk(entry) for entry in self.chunks(start, end)]
+        if not parts:
+            return np.empty(0), np.empty((0, len(self.channels) if channels is None else len(channels)))
+
+        timestamps = np.concatenate([part[0] for part in parts])
+        values = np.concatenate([part[1] for part in parts])
+        inside = (timestamps >= start) & (timestamps <= end)
+        if channels is not None:
+            values = values[:, channels]
+        return timestamps[inside], values[inside]
+
+
+    def resolution(self, resolution: float) -> float:
+        '''
+        Name:
+            ArchiveReader.resolution(resolution= float) -> float
+        Returns:
+            The resolution resample() uses for the one asked for, rounded up
+            to whole chunks from chunk_duration up
+        '''
+        chunk_duration = self.header['chunk_duration']
+        if resolution < chunk_duration:
+            return max(0.0, resolution)
+        return math.ceil(resolution / chunk_duration - 1e-9) * chunk_duration
+
+
+    def resample(self, channel: int, start: float = -math.inf, end: float = math.inf, resolution: float = 0.0):
+        '''
+        Name:
+            ArchiveReader.resample(channel= int, start= float, end= float, resolution= float) -> generator
+        Args:
+            channel: index of the channel
+            start, end: the time window, inclusive
+            resolution: seconds of each bin, 0 for every frame
+        Returns:
+            Blocks of (timestamps, min, max, mean) arrays in time order, one
+            block per chunk read. A bin has the start time of its bin, bins
+            are multiples of resolution(resolution). Gap markers are left out
+            of a bin, a bin of only gap markers is NaN. With resolution 0
+            every frame is its own bin.
+        Desc:
+            From chunk_duration up the bins are whole chunks and come from
+            the index alone, nothing is decompressed and the window is
+            widened to the chunks it overlaps. Below that each chunk in the
+            window is decompressed once, when its block is asked for.
+        '''
+        resolution = self.resolution(resolution)
+        entries = self.chunks(start, end)
+        if resolution >= self.header['chunk_duration']:
+            if len(entries):
+                yield self.__index_bins(entries, channel, resolution)
+            return
+
+        # The last bin of a chunk can continue into the next chunk
+        carry = (np.empty(0), np.empty(0))
+        for i, entry in enumerate(entries):
+            timestamps, values = self.read_chunk(entry)
+            inside = (timestamps >= start) & (timestamps <= end)
+            timestamps = np.concatenate([carry[0], timestamps[inside]])
+            values = np.concatenate([carry[1], values[inside, channel]])
+            if not len(timestamps):
+                continue
+            if not resolution:
+                yield timestamps, values, values, values
+                continue
+
+            bins = np.floor(timestamps / resolution)
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+            if i < len(entries) - 1:
+                carry = (timestamps[starts[-1]:], values[starts[-1]:])
+                timestamps, values, bins, starts = timestamps[:starts[-1]], values[:starts[-1]], bins[:starts[-1]], starts[:-1]
+                if not len(starts):
+                    continue
+
+            valid = ~np.isnan(values)
+            counts = np.add.reduceat(valid, starts)
+            sums = np.add.reduceat(np.where(valid, values, 0.0), starts, dtype=np.float64)
+            mean = np.divide(sums, counts, out=np.full(len(starts), np.nan), where=counts > 0)
+            yield (bins[starts] * resolution,
+                   np.fmin.reduceat(values, starts).astype(np.float64),
+                   np.fmax.reduceat(values, starts).astype(np.float64),
+                   mean)
+
+
+    def read_chunk(self, entry) -> tuple:
+        '''
+        Name:
+            ArchiveReader.read_chunk(entry= np.void) -> (np.ndarray, np.ndarray)
+        Returns:
+            The timestamps and frames x channels values of one chunk
+        '''
+        with self.__lock:
+            self.__file.seek(int(entry['offset']))
+            data = self.__file.read(int(entry['size']))
+        frames = zlib.decompress(data) if self.header['compression'] == ZLIB else lzma.decompress(data)
+
+        count = int(entry['frames'])
+        timestamps = np.frombuffer(frames, dtype='<f8', count=count)
+        values = np.frombuffer(frames, dtype=self.__value_dtype, offset=8 * count).reshape(len(self.channels), count)
+        return timestamps, values.T
+
+
+    def close(self) -> None:
+        self.__file.close()
+
+
+    def __index_bins(self, entries: np.ndarray, channel: int, resolution: float) -> tuple:
+        chunk_duration = self.header['chunk_duration']
+        chunks_per_bin = round(resolution / chunk_duration)
+        bins = np.floor(entries['start'] / chunk_duration) // chunks_per_bin
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+
+        # Chunks of only gap markers have a NaN mean and no values
+        weights = entries['count'][:, channel]
+        counts = np.add.reduceat(weights, starts)
+        sums = np.add.reduceat(np.where(weights > 0, entries['mean'][:, channel] * weights, 0.0), starts)
+        return (bins[starts] * chunks_per_bin * chunk_duration,
+                np.fmin.reduceat(entries['min'][:, channel], starts),
+                np.fmax.reduceat(entries['max'][:, channel], starts),
+                np.divide(sums, counts, out=np.full(len(starts), np.nan), where=counts > 0))
+
+
+    def __read_index(self) -> np.ndarray:
+        self.__file.seek(0, io.SEEK_END)
+        size = self.__file.tell()
+
+        trailer_size = struct.calcsize(TRAILER_FORMAT)
+        if size - self.__first_chunk >= trailer_size:
+            self.__file.seek(size - trailer_size)
+            offset, count, magic = struct.unpack(TRAILER_FORMAT, self.__file.read(trailer_size))
+            if magic == INDEX_MAGIC:
+                self.__complete = True
+                self.__file.seek(offset)
+                return np.frombuffer(self.__file.read(count * self.__index_dtype.itemsize), dtype=self.__index_dtype)
+
+        # No index, the writer is still going or never closed. Walk the
+        # chunks from the last one read, a chunk cut short ends the archive
+        # for now.
+        entries = []
+        position = self.__position
+        while position + self.__index_dtype.itemsize <= size:
+            self.__file.seek(position)
+            entry = np.frombuffer(self.__file.read(self.__index_dtype.itemsize), dtype=self.__index_dtype)
+            end = int(entry['offset'][0]) + int(entry['size'][0])
+            if int(entry['offset'][0]) != position + self.__index_dtype.itemsize or end > size:
+                break
+            entries.append(entry)
+            position = end
+        self.__position = position
+        return np.concatenate([self.index, *entries]) if entries else self.index
+
+
+def archive_recording(recording_path: str, archive_path: str, compression: str = ZLIB, chunk_duration: float = DEFAULT_CHUNK_DURATION) -> None:
+    '''
+    Name:
+        archive_recording(recording_path= str, archive_path= str, compression= str, chunk_duration= float) -> None
+    Desc:
+        Archives a recording written by recording.py
+    '''
+    # Only used from the command line, where recording.py is beside this file
+    from recording import open_recording
+
+    header, frames = open_recording(recording_path)
+    archive = ArchiveWriter(archive_path, header['channels'], header['dtype'], header['metadata'], compression, chunk_duration)
+    archive.start()
+    step = 1 << 16
+    for i in range(0, len(frames), step):
+        archive.write_frames(frames['timestamp'][i:i + step], frames['values'][i:i + step])
+    archive.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archive a PDP recording, or read from an archive")
+    parser.add_argument('input', help="a recording to archive, or an archive")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--archive', metavar='OUTPUT', help="archive the input recording")
+    group.add_argument('--info', action='store_true', help="print the time span and statistics of each chunk")
+    group.add_argument('--csv', metavar='OUTPUT', help="write the frames of --range to CSV")
+    parser.add_argument('--lzma', action='store_true', help="compress with lzma, smaller and slower than zlib")
+    parser.add_argument('--chunk', type=float, default=DEFAULT_CHUNK_DURATION, help="seconds of frames in each chunk")
+    parser.add_argument('--range', type=float, nargs=2, metavar=('START', 'END'), default=(-math.inf, math.inf))
+    args = parser.parse_args()
+
+    if args.archive:
+        archive_recording(args.input, args.archive, LZMA if args.lzma else ZLIB, args.chunk)
+        sys.exit()
+
+    reader = ArchiveReader(args.input)
+    names = [channel['name'] for channel in reader.channels]
+    if args.info:
+        for entry in reader.chunks(*args.range):
+            print(f"{entry['start']:.6f} - {entry['end']:.6f}  {entry['frames']} frames  {entry['size']} bytes")
+            for name, low, high, mean in zip(names, entry['min'], entry['max'], entry['mean']):
+                print(f"    {name:<14} min {low:<12.6g} max {high:<12.6g} mean {mean:.6g}")
+    else:
+        # Only used from the command line, where recording.py is beside this file
+        from recording import write_csv
+
+        timestamps, values = reader.read(*args.range)
+        with (open(args.csv, 'w') if args.csv != '-' else contextlib.nullcontext(sys.stdout)) as output:
+            write_csv(output, names, timestamps, values)
+    reader.close()
@@ -0,0 +1,236 @@
+'''
+Vectorized conversion of LabJack stream packets into sensor values.
+
+processStreamData() returns a dict of 'AINX' -> list of raw voltages. The
+ConversionEngine stacks the channels it cares about into a single
+channels x samples NumPy array and applies every gain, offset and
+reduction in one pass instead of looping over each sensor in Python.
+
+Conversion and reduction are separate stages. convert_samples() keeps every
+sample for full rate recording and reduce() averages a packet down to one
+value per channel.
+'''
+import numpy as np
+from thermocouple import V_to_K_array
+
+
+class ConversionEngine:
+    '''
+    Name:
+        ConversionEngine
+    Desc:
+        Converts the voltages of a stream packet to SI units using gain and
+        offset vectors built from the sensor table in read_labjack.py.
+
+        Each sensor is a tuple of (NAME, CHANNEL, GAIN, OFFSET, UNIT). Thermocouples
+        use None for GAIN and OFFSET and every raw sample is linearized with
+        V_to_K_array instead.
+
+    Public:
+        names: the sensor names in the order they are converted
+        channels: the LJ result key ('AINX') for each sensor
+        units: the SI unit of each sensor
+        gains: vector of gains, 1 for thermocouples
+        offsets: vector of offsets, 0 for thermocouples
+        thermocouples: boolean mask of the thermocouple rows
+    '''
+    def __init__(self, sensors: list):
+        self.names = [sensor[0] for sensor in sensors]
+        self.channels = [sensor[1] for sensor in sensors]
+        self.units = [sensor[4] for sensor in sensors]
+        self.__sensors = sensors
+
+        self.thermocouples = np.array([sensor[2] is None for sensor in sensors])
+        self.gains = np.array(
+            [1.0 if sensor[2] is None else sensor[2] for sensor in sensors],
+            dtype=np.float64)
+        self.offsets = np.array(
+            [0.0 if sensor[3] is None else sensor[3] for sensor in sensors],
+            dtype=np.float64)
+
+        self.__has_thermocouples = bool(self.thermocouples.any())
+
+
+    def schema(self) -> list:
+        '''
+        Name:
+            ConversionEngine.schema() -> list
+        Returns:
+            A description of every sensor for the recording header. GAIN and
+            OFFSET are None for thermocouples.
+        '''
+        return [{
+            'name': name,
+            'unit': unit,
+            'channel': channel,
+            'gain': gain,
+            'offset': offset
+        } for name, channel, gain, offset, unit in self.__sensors]
+
+
+    def stack(self, values: dict) -> np.ndarray:
+        '''
+        Name:
+            ConversionEngine.stack(values= dict) -> np.ndarray
+        Args:
+            values: the dict returned by processStreamData()
+        Returns:
+            A channels x samples array of raw voltages
+        Desc:
+            When samples_per_packet is not a multiple of the number of
+            channels the lists differ in length by one sample. Only complete
+            scans are kept so the result is always rectangular.
+        '''
+        scans = min(len(values[channel]) for channel in self.channels)
+        return np.array(
+            [values[channel][:scans] for channel in self.channels],
+            dtype=np.float64)
+
+
+    def convert(self, values: dict, ref_voltage: float) -> dict:
+        '''
+        Name:
+            ConversionEngine.convert(values= dict, ref_voltage= float) -> dict
+        Args:
+            values: the dict returned by processStreamData()
+            ref_voltage: the cold junction voltage from get_ref_voltage()
+        Returns:
+            A dict of sensor name -> packet averaged value in SI units
+        Desc:
+            Converts every sample of the packet and averages each channel,
+            see convert_samples() and reduce()
+        '''
+        converted = self.reduce(self.convert_samples(self.stack(values), ref_voltage))
+        return dict(zip(self.names, converted.tolist()))
+
+
+    def convert_samples(self, samples: np.ndarray, ref_voltage: float) -> np.ndarray:
+        '''
+        Name:
+            ConversionEngine.convert_samples(samples= np.ndarray, ref_voltage= float) -> np.ndarray
+        Args:
+            samples: channels x scans array of raw voltages from stack() or
+                     ScanAssembler.push()
+            ref_voltage: the cold junction voltage from get_ref_voltage()
+        Returns:
+            A scans x channels array of every sample in SI units, ready for
+            RecordingWriter.write_frames(). Thermocouple samples out of the
+            range of the polynomials are NaN.
+        '''
+        converted = samples * self.gains[:, None] + self.offsets[:, None]
+
+        if self.__has_thermocouples:
+            converted[self.thermocouples] = V_to_K_array(samples[self.thermocouples], ref_voltage)
+
+        return converted.T
+
+
+    def reduce(self, converted: np.ndarray) -> np.ndarray:
+        '''
+        Name:
+            ConversionEngine.reduce(converted= np.ndarray) -> np.ndarray
+        Args:
+            converted: scans x channels array from convert_samples()
+        Returns:
+            The average of each channel ignoring NaN samples. Channels with
+            no valid samples are 0 like V_to_K.
+        '''
+        valid = ~np.isnan(converted)
+        counts = valid.sum(axis=0)
+        sums = np.where(valid, converted, 0).sum(axis=0)
+        return np.divide(sums, counts, out=np.zeros(len(sums)), where=counts > 0)
+
+
+class ScanAssembler:
+    '''
+    Name:
+        ScanAssembler
+    Desc:
+        Reassembles complete scans across stream packets. When
+        samples_per_packet is not a multiple of the number of channels, a
+        packet ends part way through a scan. stack() drops that partial scan,
+        which is fine for averaging but loses samples at full rate. The
+        assembler keeps the leftover samples of each channel and puts them
+        in front of the next packet instead, so every sample is kept and
+        stays in scan order.
+
+        When the LabJack skips samples (missed scans or lost packets), skip()
+        drops the scans they were part of so no scan is ever assembled from
+        samples on both sides of the gap, and moves the scan count on so
+        later scans keep their place on the scan clock.
+
+    Public:
+        channels: the LJ result key ('AINX') of each row
+        stream_channels: every channel streamed, in scan order
+        scans: the number of scans so far including skipped ones, the scan
+               number of the next scan
+    '''
+    def __init__(self, channels: list, stream_channels: list = None):
+        self.channels = list(channels)
+        self.stream_channels = list(stream_channels) if stream_channels is not None else list(self.channels)
+        self.scans = 0
+
+        self.__leftover = [[] for _ in self.channels]
+        self.__drop = {}
+
+
+    def push(self, values: dict) -> np.ndarray:
+        '''
+        Name:
+            ScanAssembler.push(values= dict) -> np.ndarray
+        Args:
+            values: the dict returned by processStreamData()
+        Returns:
+            A channels x scans array of raw voltages for every scan completed
+            by this packet. May have no scans.
+        '''
+        rows = [leftover + self.__take(channel, values[channel]) for leftover, channel in zip(self.__leftover, self.channels)]
+        scans = min(len(row) for row in rows)
+
+        self.__leftover = [row[scans:] for row in rows]
+        self.scans += scans
+        return np.array([row[:scans] for row in rows], dtype=np.float64).reshape(len(rows), scans)
+
+
+    def skip(self, samples: int) -> int:
+        '''
+        Name:
+            ScanAssembler.skip(samples= int) -> int
+        Args:
+            samples: the number of samples the LabJack skipped before the
+                     next packet
+        Returns:
+            The number of scans lost. A scan is lost if any of its samples
+            were skipped.
+        '''
+        if samples <= 0:
+            return 0
+
+        # Position of the next sample in the scan: one past the last stream
+        # channel holding a leftover sample
+        leftover = {channel for channel, row in zip(self.channels, self.__leftover) if row}
+        position = max((i + 1 for i, channel in enumerate(self.stream_channels) if channel in leftover), default=0)
+
+        channels = len(self.stream_channels)
+        position += samples
+        phase = position % channels
+        lost = position // channels + (1 if phase else 0)
+
+        # A gap that ends part way through a scan leaves the rest of that
+        # scan in the next packet, it is incomplete so drop it too
+        self.__leftover = [[] for _ in self.channels]
+        if phase:
+            for channel in self.stream_channels[phase:]:
+                self.__drop[channel] = self.__drop.get(channel, 0) + 1
+
+        self.scans += lost
+        return lost
+
+
+    def __take(self, channel: str, samples: list) -> list:
+        drop = self.__drop.get(channel)
+        if not drop:
+            return samples
+        dropped = min(drop, len(samples))
+        self.__drop[channel] = drop - dropped
+        return samples[dropped:]
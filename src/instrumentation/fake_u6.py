@@ -0,0 +1,356 @@
+'''
+A fake LabJack U6 that streams generated packets, for running and
+benchmarking the acquisition pipeline without hardware.
+
+FakeU6 implements the part of LabJackPython's u6.U6 used by read_labjack.py:
+streamConfig(), streamStart(), streamData(), processStreamData(),
+getTemperature(), streamStop() and close(). Packets are laid out like the
+U6 StreamData response (section 5.2.14 of the U6 user guide):
+
+    bytes 0-5     header
+    bytes 6-9     reserved, the missed scan count in an auto recover packet
+    byte  10      packet number, 0 to 255
+    byte  11      errorcode
+    bytes 12-     samples_per_packet unsigned 16 bit samples, 0x8000 is 0 V
+    byte  last-1  backlog, percent of the device buffer in use
+    byte  last    reserved
+
+Samples are produced on the device clock. With realtime=True streamData()
+waits until each request of packets would have been sampled, and a reader
+that falls behind builds up a backlog on the device until the buffer
+overflows and whole scans are missed, like the real U6 in auto recover. With
+realtime=False packets are produced as fast as they are read, to measure
+the most channels x Hz the pipeline can sustain.
+'''
+import time
+import math
+import struct
+import numpy as np
+
+# errorcode of the first packet after the device buffer overflowed. Bytes
+# 6-9 hold the number of scans missed.
+AUTO_RECOVER_END_OVERFLOW = 60
+
+HEADER_SIZE = 12
+TRAILER_SIZE = 2
+
+# The U6 stream buffer holds 4 KB of 16 bit samples
+DEFAULT_BUFFER_SAMPLES = 2048
+
+# LabJackPython reads this many packets per streamData() reading
+DEFAULT_PACKETS_PER_REQUEST = 48
+
+# Input range in volts of each GainIndex, bits 4-5 of ChannelOptions
+GAIN_RANGES = [10.0, 1.0, 0.1, 0.01]
+
+
+def default_signal(channel: int, times: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    '''
+    Name:
+        default_signal(channel= int, times= np.ndarray, rng= np.random.Generator) -> np.ndarray
+    Args:
+        channel: index of the channel in ChannelNumbers
+        times: seconds since streamStart() of each sample
+        rng: random generator for noise
+    Returns:
+        Volts as a fraction of full scale, a slow sine with a different
+        offset and phase on each channel plus noise
+    '''
+    return 0.005 * (channel % 5) + 0.01 * np.sin(2 * math.pi * times + channel) + rng.normal(0, 0.001, len(times))
+
+
+class FakeU6:
+    '''
+    Name:
+        FakeU6
+    Desc:
+        Drop in replacement for u6.U6 in stream mode. The scan rate and
+        channel list come from streamConfig() like the real device.
+
+        Backlog, missed scans, lost packets and error packets can be
+        injected at any time and take effect from the next streamData()
+        reading.
+
+    Public:
+        packets_per_request: packets returned by each streamData() reading
+        realtime: pace packets by the device clock
+        buffer_samples: samples the device buffers before it overflows
+        signal: function of (channel, times, rng) returning each sample as a
+                fraction of the channel's full scale range
+        temperature: internal temperature in K returned by getTemperature()
+        packets: packets produced since streamStart(), including lost ones
+        missed: scans missed since streamStart()
+        lost: packets lost since streamStart()
+        streamPacketOffset: the channel of the next sample processStreamData()
+                            reads, like LabJackPython
+    '''
+    def __init__(
+        self,
+        packets_per_request: int = DEFAULT_PACKETS_PER_REQUEST,
+        realtime: bool = True,
+        buffer_samples: int = DEFAULT_BUFFER_SAMPLES,
+        signal = default_signal,
+        temperature: float = 298.15,
+        seed: int = None
+    ):
+        self.packets_per_request = packets_per_request
+        self.realtime = realtime
+        self.buffer_samples = buffer_samples
+        self.signal = signal
+        self.temperature = temperature
+        self.packets = 0
+        self.missed = 0
+        self.lost = 0
+        self.streamPacketOffset = 0
+
+        self.__rng = np.random.default_rng(seed)
+        self.__channel_numbers = []
+        self.__ranges = np.zeros(0)
+        self.__scan_frequency = 0
+        self.__samples_per_packet = 0
+        self.__streaming = False
+        self.__start = 0.0
+        self.__sample = 0
+        self.__errors = []
+        self.__missed = 0
+        self.__missed_packet = 0
+        self.__lost = 0
+
+
+    def streamConfig(
+        self,
+        NumChannels: int = 1,
+        ResolutionIndex: int = 0,
+        SamplesPerPacket: int = 25,
+        SettlingFactor: int = 0,
+        InternalStreamClockFrequency: int = 0,
+        DivideClockBy256: bool = False,
+        ScanInterval: int = 1,
+        ChannelNumbers: list = [0],
+        ChannelOptions: list = [0],
+        ScanFrequency: int = None,
+        SampleFrequency: int = None
+    ) -> None:
+        if NumChannels != len(ChannelNumbers) or NumChannels != len(ChannelOptions):
+            raise ValueError("NumChannels must match the length of ChannelNumbers and ChannelOptions")
+        if not 1 <= SamplesPerPacket <= 25:
+            raise ValueError("SamplesPerPacket must be between 1 and 25")
+
+        if ScanFrequency is None:
+            ScanFrequency = SampleFrequency / NumChannels if SampleFrequency else 4e6 / ScanInterval
+
+        self.__channel_numbers = list(ChannelNumbers)
+        self.__ranges = np.array([GAIN_RANGES[(options >> 4) & 0b11] for options in ChannelOptions])
+        self.__scan_frequency = ScanFrequency
+        self.__samples_per_packet = SamplesPerPacket
+
+
+    def streamStart(self) -> None:
+        if not self.__channel_numbers:
+            raise RuntimeError("streamConfig() must be called before streamStart()")
+        if self.__streaming:
+            raise RuntimeError("Stream already started")
+
+        self.__streaming = True
+        self.__start = time.monotonic()
+        self.__sample = 0
+        self.streamPacketOffset = 0
+        self.packets = 0
+        self.missed = 0
+        self.lost = 0
+
+
+    def streamStop(self) -> None:
+        self.__streaming = False
+
+
+    def close(self) -> None:
+        self.__streaming = False
+
+
+    def getTemperature(self) -> float:
+        return self.temperature
+
+
+    def inject_backlog(self, seconds: float) -> None:
+        '''
+        Name:
+            FakeU6.inject_backlog(seconds= float) -> None
+        Args:
+            seconds: how long the reader appears to have stalled
+        Desc:
+            Moves the device clock ahead, as if the reader had not read for
+            this long. Only applies with realtime=True. A stall longer than
+            the device buffer holds overflows it.
+        '''
+        self.__start -= seconds
+
+
+    def inject_missed(self, scans: int, packet: int = 0) -> None:
+        '''
+        Name:
+            FakeU6.inject_missed(scans= int, packet= int) -> None
+        Args:
+            scans: scans to skip
+            packet: index in the next reading of the auto recover packet
+                    that reports them, the scans are skipped right before it
+        Desc:
+            Skips this many scans and reports them in an auto recover packet
+        '''
+        self.__missed += scans
+        self.__missed_packet = min(packet, self.packets_per_request - 1)
+
+
+    def inject_lost_packets(self, packets: int) -> None:
+        '''
+        Name:
+            FakeU6.inject_lost_packets(packets= int) -> None
+        Desc:
+            Drops the next packets on the way to the host. Nothing reports
+            them, the packet numbers of the next reading jump instead.
+        '''
+        self.__lost += packets
+
+
+    def inject_error(self, errorcode: int, packets: int = 1) -> None:
+        '''
+        Name:
+            FakeU6.inject_error(errorcode= int, packets= int) -> None
+        Desc:
+            Sets the errorcode of the next packets. Their samples are still
+            sent, the errorcode is only counted in the reading.
+        '''
+        self.__errors.extend([errorcode] * packets)
+
+
+    def streamData(self, convert: bool = True):
+        '''
+        Name:
+            FakeU6.streamData(convert= bool) -> generator
+        Args:
+            convert: pass the result through processStreamData()
+        Returns:
+            A reading of packets_per_request packets for as long as the stream
+            runs: a dict of result, numPackets, errors, missed (scans) and
+            firstPacket like LabJackPython, and backlog, the samples left in
+            the device buffer when it was read.
+        '''
+        if not self.__streaming:
+            raise RuntimeError("Stream not started")
+
+        channels = len(self.__channel_numbers)
+        samples_per_packet = self.__samples_per_packet
+        sample_period = 1 / (self.__scan_frequency * channels)
+
+        while self.__streaming:
+            request_samples = self.packets_per_request * samples_per_packet
+            backlog = 0
+
+            if self.realtime:
+                ready = self.__start + (self.__sample + request_samples) * sample_period
+                delay = ready - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+                # Everything sampled but not read yet is in the device buffer
+                buffered = int((time.monotonic() - self.__start) / sample_period) - self.__sample
+                if buffered > self.buffer_samples:
+                    self.__missed += math.ceil((buffered - self.buffer_samples) / channels)
+                    buffered = self.buffer_samples
+                backlog = max(0, buffered - request_samples)
+
+            missed, missed_packet = self.__missed, self.__missed_packet
+            if missed:
+                self.__missed, self.__missed_packet = 0, 0
+                self.missed += missed
+
+            lost = self.__lost
+            if lost:
+                self.__lost = 0
+                self.__sample += lost * samples_per_packet
+                self.packets += lost
+                self.lost += lost
+
+            packets = self.__packets(backlog, missed, missed_packet)
+            errorcodes = packets[:, 11]
+            result = packets.tobytes()
+            reading = {
+                'result': result,
+                'numPackets': len(packets),
+                'errors': int(np.count_nonzero((errorcodes != 0) & (errorcodes != AUTO_RECOVER_END_OVERFLOW))),
+                'missed': missed,
+                'firstPacket': (self.packets - self.packets_per_request) % 256,
+                'backlog': backlog
+            }
+            if convert:
+                reading.update(self.processStreamData(result))
+            yield reading
+
+
+    def processStreamData(self, result: bytes, numBytes: int = None) -> dict:
+        '''
+        Name:
+            FakeU6.processStreamData(result= bytes, numBytes= int) -> dict
+        Args:
+            result: the 'result' of a streamData() reading
+        Returns:
+            A dict of 'AINX' -> list of volts. Packets do not have to end on
+            a scan boundary, the channel of the next sample is carried to
+            the next call.
+        '''
+        packet_size = numBytes or self.__packet_size()
+        packets = np.frombuffer(result, dtype=np.uint8).reshape(-1, packet_size)
+        raw = packets[:, HEADER_SIZE:packet_size - TRAILER_SIZE].copy().view('<u2').ravel()
+
+        channels = len(self.__channel_numbers)
+        index = (self.streamPacketOffset + np.arange(len(raw))) % channels
+        self.streamPacketOffset = (self.streamPacketOffset + len(raw)) % channels
+        volts = (raw.astype(np.float64) - 0x8000) / 0x8000 * self.__ranges[index]
+
+        return {
+            f"AIN{number}": volts[index == channel].tolist()
+            for channel, number in enumerate(self.__channel_numbers)
+        }
+
+
+    def __packet_size(self) -> int:
+        return HEADER_SIZE + 2 * self.__samples_per_packet + TRAILER_SIZE
+
+
+    def __packets(self, backlog: int, missed: int, missed_packet: int) -> np.ndarray:
+        channels = len(self.__channel_numbers)
+        count = self.packets_per_request
+        samples_per_packet = self.__samples_per_packet
+
+        # The missed scans are skipped in front of the auto recover packet
+        sample = self.__sample + np.arange(count * samples_per_packet)
+        sample[missed_packet * samples_per_packet:] += missed * channels
+        channel = sample % channels
+        times = (sample // channels) / self.__scan_frequency
+
+        fraction = np.empty(len(sample))
+        for i in range(channels):
+            rows = channel == i
+            fraction[rows] = self.signal(i, times[rows], self.__rng)
+        raw = np.clip(np.round(fraction * 0x8000 + 0x8000), 0, 0xFFFF).astype('<u2')
+
+        packets = np.zeros((count, self.__packet_size()), dtype=np.uint8)
+        packets[:, 1] = 0xF9
+        packets[:, 2] = 4 + samples_per_packet
+        packets[:, 3] = 0xC0
+        packets[:, 10] = (self.packets + np.arange(count)) % 256
+        packets[:, HEADER_SIZE:-TRAILER_SIZE] = raw.reshape(count, samples_per_packet).view(np.uint8)
+        packets[:, -TRAILER_SIZE] = min(100, 100 * backlog // self.buffer_samples)
+
+        if missed:
+            packets[missed_packet, 11] = AUTO_RECOVER_END_OVERFLOW
+            packets[missed_packet, 6:10] = np.frombuffer(struct.pack('<I', missed), dtype=np.uint8)
+
+        # Error packets around the auto recover packet
+        free = [i for i in range(count) if not (missed and i == missed_packet)]
+        errors, self.__errors = self.__errors[:len(free)], self.__errors[len(free):]
+        packets[free[:len(errors)], 11] = errors
+
+        self.__sample += count * samples_per_packet + missed * channels
+        self.packets += count
+        return packets
@@ -1,6 +1,14 @@
-import u6
-import json
+import time
+import signal
+import argparse
+import multiprocessing
+import numpy as np
 from thermocouple import *
+from conversion import ConversionEngine, ScanAssembler
+from ring_buffer import RingBufferWriter, ACQUISITION_STATUS
+from recording import RecordingWriter, WriteBehindRecorder, RECORDER_STATUS
+from archive import ArchiveWriter, ARCHIVE_STATUS, INSTRUMENTATION_ARCHIVE_PATH
+from stage_queue import StageQueue, SharedStatus, BLOCK, DROP_NEWEST, QUEUE_STATS
 
 # Gains
 X1    = 0b00000000
@@ -32,7 +40,19 @@ Overview:
   This file sets up the LJ in stream mode to acquire data at the fastest
   rate possible. All channels and their settings for each sensor are 
   configured here. Data produced by the LJ is consumed and written to
-  a file for later processing.
+  a binary recording (see recording.py) for later processing, and
+  published to a shared memory ring buffer (see ring_buffer.py) for the
+  websocket server.
+
+  Each of those is a stage in its own process, so a slow disk write never
+  delays the next read of the LJ (see stream()). The reader hands each
+  packet to conversion through a shared memory queue (see stage_queue.py)
+  and never waits on it. A packet it has to drop is marked as a gap like
+  one lost on USB. queue_sizes and queue_policies below set how much each
+  stage can fall behind and what happens when it does.
+
+  Run with --simulate to stream generated packets from a FakeU6 (see
+  fake_u6.py) when no LabJack is connected.
 
 
 Sensor Overview:
@@ -62,6 +82,12 @@ streamConfig():
   scan_frequency:
     The frequency in Hz to scan the channel list (ChannelNumbers). 
     The sample rate (Hz) = scan_frequency * num_channels.
+    Sample timestamps are derived from this clock: scan n of the stream
+    was taken at stream start + n / scan_frequency. Scans lost because the
+    LJ buffer overflowed (missed) or a packet never arrived (a jump in the
+    packet numbers) are skipped on the clock, marked in the recording with
+    a frame of NaN at the time of the first lost scan, and counted in the
+    ring buffer status with the LJ backlog (see ACQUISITION_STATUS).
 
   num_channels:
     Number of channels to stream. Equal to length of channel_numbers.
@@ -96,6 +122,19 @@ streamConfig():
     
       Set bit 7 for differential reading.
 
+  stream_mode:
+    'RAW' records every sample of every channel with its scan timestamp,
+    keeping transients such as ignition that packet averages smooth away.
+    'AVERAGE' records one average per packet. Either way the samples are
+    converted the same way and averaging is only a reduction on top.
+    At high scan rates raise samples_per_packet so fewer, larger packets
+    are processed.
+
+  publish_raw:
+    In RAW mode, also publish every sample to the websocket server. When
+    False the websocket server gets packet averages, which is plenty for
+    display.
+
 
 Adding a Sensor: 
     1) Add a new tuple to channel_settings with the LJ pin the sensor is
@@ -116,13 +155,13 @@ Adding a Sensor:
        for lookup in the LJ results dictionary. The LJ naming convention is 
        'AINX' where X is the pin number (1, 2, .. 56 etc)
 
-    4) Add a few lines of code to read and convert the voltage to SI:
+    4) Add a new row to the sensors table with the sensor name, the CHAN_XXX
+       variable, the GAIN and OFFSET from step 2 and the SI unit.
+       Thermocouples use None for GAIN and OFFSET and are linearized with
+       V_to_K:
 
-       if reading is not None:
-
-           # Add and fill out this line
-           SENSOR_NAME = values[CHAN_XXX]
-           converted['SENSOR_NAME'] = GAIN*SENSOR_NAME + OFFSET # etc...
+       sensors = [...,
+                  ('SENSOR_NAME', CHAN_XXX, GAIN, OFFSET, 'UNIT')]
 
         Thats it, Have fun with your new sensor!
     
@@ -135,6 +174,8 @@ scan_frequency   = 1000
 resolution_index = 2
 settling_factor  = 2
 samples_per_packet = 12
+stream_mode      = 'RAW'    # 'RAW' or 'AVERAGE'
+publish_raw      = False
 channel_settings = [(86, DIFF | X1000), # L_RUN_TANK (SEEMS GOOD. CHECK CAL)
                     (87, DIFF | X1000), # L_THRUST (VERY NOISY)
 
@@ -181,121 +222,547 @@ CHAN_T_POST_COMB  = 'AIN53'
 
 CHAN_SHUNT        = 'AIN82' # Not implemented yet on cart
 
+# Sensors converted for each packet: (NAME, CHANNEL, GAIN, OFFSET, UNIT)
+sensors = [('P_INJECTOR',   CHAN_P_INJECTOR,   GAIN_P_INJECTOR,   0, 'Pa'),
+           ('P_COMB_CHMBR', CHAN_P_COMB_CHMBR, GAIN_P_COMB_CHMBR, 0, 'Pa'),
+           ('P_N2O_FLOW',   CHAN_P_N2O_FLOW,   GAIN_P_N2O_FLOW,   0, 'Pa'),
+           ('P_N2_FLOW',    CHAN_P_N2_FLOW,    GAIN_P_N2_FLOW,    0, 'Pa'),
+           ('P_RUN_TANK',   CHAN_P_RUN_TANK,   GAIN_P_RUN_TANK,   0, 'Pa'),
+
+           ('L_RUN_TANK',   CHAN_L_RUN_TANK,   GAIN_L_RUN_TANK,   OFFSET_L_RUN_TANK, 'N'),
+           ('L_THRUST',     CHAN_L_THRUST,     GAIN_L_THRUST,     OFFSET_L_THRUST,   'N'),
+
+           ('T_RUN_TANK',   CHAN_T_RUN_TANK,   None, None, 'K'),
+           ('T_INJECTOR',   CHAN_T_INJECTOR,   None, None, 'K'),
+           ('T_COMB_CHMBR', CHAN_T_COMB_CHMBR, None, None, 'K'),
+           ('T_POST_COMB',  CHAN_T_POST_COMB,  None, None, 'K')]
+
+# Recording settings. float32 halves the file size, use float64 if the
+# extra precision is ever needed. See recording.py to convert to CSV.
+recording_path  = 'instrumentation_data.pdprec'
+recording_dtype = 'float32'
+
+# The recorder commits frames in groups, once recording_flush_bytes are
+# pending or the oldest is recording_flush_interval s old, and fsyncs every
+# recording_fsync_interval s (None leaves it to the OS). At most the two
+# intervals together of data is lost if the VC loses power.
+recording_flush_bytes    = 1 << 20
+recording_flush_interval = 0.1
+recording_fsync_interval = 0.5
+
+# The recording is also written to a compressed archive with a time index
+# (see archive.py), for reading back parts of a firing without the whole
+# file. Chunks of archive_chunk_duration s are compressed with
+# archive_compression, 'zlib' or 'lzma' (smaller, several times slower).
+# The websocket server answers HISTORY requests from this archive. None for
+# archive_path turns the archive off.
+archive_path           = INSTRUMENTATION_ARCHIVE_PATH
+archive_compression    = 'zlib'
+archive_chunk_duration = 1.0
+
+# Readings each pipeline queue holds, and what happens when it is full (see
+# stream() and stage_queue.py). The reader must never wait on the LJ, so
+# convert drops, and so does publish since the display can skip. record
+# blocks conversion rather than lose converted data, a slow disk then shows
+# up as drops on convert, each marked as a gap in the recording.
+queue_sizes    = {'convert': 256, 'record': 1024, 'publish': 64}
+queue_policies = {'convert': DROP_NEWEST, 'record': BLOCK, 'publish': DROP_NEWEST}
+
 #########  END USER ADJUSTABLE  #########
 
-# Set up the stream
-d = u6.U6()
-
-d.streamConfig(
-        ScanFrequency   = scan_frequency,
-        ChannelNumbers  = [x[0] for x in channel_settings],
-        ChannelOptions  = [x[1] for x in channel_settings],
-        NumChannels     = len(channel_settings),
-        ResolutionIndex = resolution_index,
-        SettlingFactor  = settling_factor,
-        SamplesPerPacket = samples_per_packet)
-
-# Get cold junction voltage using LJ internal temp sensor
-V_ref = get_ref_voltage(d.getTemperature())
-print("T_ref in K: ", d.getTemperature())
-print("V_ref in V: ", V_ref)
-
-# Avoid having to power cycle the LJ on restart
-try:
-    d.streamStop()
-except:
-    pass
-
-if samples_per_packet < len(channel_settings):
-    raise ValueError \
-            ("samples_per_packet: (" + str(samples_per_packet) + \
-             ") must be at least the number of channels: (" + \
-             str(len(channel_settings)) + ")!")
-
-# Stream data from the LJ
-if d is None:
-    print("No LabJack device connected. Exiting...")
-    exit()
-else:
+# Queues of the pipeline, named after the stage they feed
+STAGES = ('convert', 'record', 'publish')
+
+# Status of record_stage: the recorder, e.g. 'recorder_write_mb_per_s', then
+# the archive, e.g. 'archive_ratio'
+RECORD_STATUS = tuple(f"recorder_{name}" for name in RECORDER_STATUS) \
+    + tuple(f"archive_{name}" for name in ARCHIVE_STATUS)
+
+# Status published in the ring buffer: the acquisition, each of QUEUE_STATS
+# for every queue, e.g. 'convert_dropped', then RECORD_STATUS
+PIPELINE_STATUS = ACQUISITION_STATUS \
+    + tuple(f"{stage}_{name}" for stage in STAGES for name in QUEUE_STATS) \
+    + RECORD_STATUS
+
+# The most packets in one streamData() reading, LabJackPython reads 48
+MAX_PACKETS_PER_READING = 64
+
+# float64 words in front of each message: acquired, firstPacket, numPackets
+# and errors of a reading and the packets read_stage dropped before it, and
+# the acquired and converted marks and frame count of converted frames
+READING_HEADER_WORDS = 5
+FRAME_HEADER_WORDS = 3
+
+# errorcode of the first packet after the LJ buffer overflowed, bytes 6-9
+# hold the number of scans missed before it (section 5.2.14)
+AUTO_RECOVER_END_OVERFLOW = 60
+
+def open_device(simulate: bool = False):
+    '''
+    Name:
+        open_device(simulate= bool) -> u6.U6
+    Args:
+        simulate: use a FakeU6 instead of a connected LabJack
+    Returns:
+        The device to stream from
+    '''
+    if simulate:
+        from fake_u6 import FakeU6
+        return FakeU6()
+
+    # Only needed with hardware, so the pipeline runs without LabJackPython
+    import u6
+    return u6.U6()
+
+
+def check_settings() -> None:
+    if stream_mode not in ('RAW', 'AVERAGE'):
+        raise ValueError("stream_mode: (" + str(stream_mode) + ") must be 'RAW' or 'AVERAGE'!")
+
+    if samples_per_packet < len(channel_settings):
+        raise ValueError \
+                ("samples_per_packet: (" + str(samples_per_packet) + \
+                 ") must be at least the number of channels: (" + \
+                 str(len(channel_settings)) + ")!")
+
+
+def configure_stream(d) -> float:
+    '''
+    Name:
+        configure_stream(d= u6.U6) -> float
+    Args:
+        d: the device from open_device()
+    Returns:
+        The cold junction voltage from the LJ internal temp sensor
+    '''
+    d.streamConfig(
+            ScanFrequency   = scan_frequency,
+            ChannelNumbers  = [x[0] for x in channel_settings],
+            ChannelOptions  = [x[1] for x in channel_settings],
+            NumChannels     = len(channel_settings),
+            ResolutionIndex = resolution_index,
+            SettlingFactor  = settling_factor,
+            SamplesPerPacket = samples_per_packet)
+
+    # Get cold junction voltage using LJ internal temp sensor
+    V_ref = get_ref_voltage(d.getTemperature())
+    print("T_ref in K: ", d.getTemperature())
+    print("V_ref in V: ", V_ref)
+
+    # Avoid having to power cycle the LJ on restart
+    try:
+        d.streamStop()
+    except:
+        pass
+
+    return V_ref
+
+
+def stream(d, engine: ConversionEngine, V_ref: float, recording: RecordingWriter, ring: RingBufferWriter, stream_start: float, stream_start_monotonic: float) -> None:
+    '''
+    Name:
+        stream(d= u6.U6, engine= ConversionEngine, V_ref= float, recording= RecordingWriter, ring= RingBufferWriter, stream_start= float, stream_start_monotonic= float) -> None
+    Args:
+        stream_start: time.time() when the stream started, scan 0
+        stream_start_monotonic: time.monotonic() taken at the same moment
+    Desc:
+        Runs the acquisition pipeline until the stream stops. This process
+        only reads USB (read_stage). Conversion, recording and publishing
+        each run in a process forked from this one, with a StageQueue
+        between stages (see queue_sizes and queue_policies):
+
+            read_stage -convert-> convert_stage -record-> record_stage
+                                                -publish-> publish_stage
+
+        The children ignore Ctrl-C and finish everything queued once the
+        reader stops.
+    '''
+    channels = len(engine.channels)
+    packet_size = 14 + 2 * samples_per_packet
+    # Every scan, the partial scan carried in, and a gap marker in front of
+    # each packet at most
+    max_frames = MAX_PACKETS_PER_READING * samples_per_packet // channels + 2 + MAX_PACKETS_PER_READING
+    slot_sizes = {
+        'convert': 8 * READING_HEADER_WORDS + MAX_PACKETS_PER_READING * packet_size,
+        'record': 8 * (FRAME_HEADER_WORDS + len(ACQUISITION_STATUS) + max_frames * (1 + channels)),
+        'publish': 8 * (FRAME_HEADER_WORDS + len(ACQUISITION_STATUS) + max_frames * (1 + channels))
+    }
+    queues = {stage: StageQueue(queue_sizes[stage], slot_sizes[stage], queue_policies[stage], stage) for stage in STAGES}
+    record_status = SharedStatus(RECORD_STATUS)
+
+    # Anything buffered now would be written again by every child
+    recording.flush()
+
+    context = multiprocessing.get_context('fork')
+    stages = [
+        context.Process(target=run_stage, name='convert', args=(
+            convert_stage, d, engine, V_ref, queues, stream_start, stream_start_monotonic)),
+        context.Process(target=run_stage, name='record', args=(
+            record_stage, recording, queues['record'], channels, record_status)),
+        context.Process(target=run_stage, name='publish', args=(publish_stage, ring, queues, channels, record_status))
+    ]
+    for stage in stages:
+        stage.start()
+
+    try:
+        read_stage(d, queues['convert'], stages)
+    finally:
+        # Waits for room to end the stream as long as conversion is alive
+        while not queues['convert'].end(timeout=0.1) and stages[0].is_alive():
+            pass
+        join_stages(stages)
+        for queue in queues.values():
+            queue.close()
+        record_status.close()
+
+
+def join_stages(stages: list) -> None:
+    '''
+    Name:
+        join_stages(stages= list) -> None
+    Desc:
+        Waits for every stage to finish its queue. If one failed the rest
+        could wait on it forever, so they are stopped.
+    '''
+    while any(stage.is_alive() for stage in stages):
+        if any(stage.exitcode for stage in stages):
+            for stage in stages:
+                stage.terminate()
+        time.sleep(0.01)
+    for stage in stages:
+        stage.join()
+
+
+def run_stage(stage, *args) -> None:
+    '''
+    Name:
+        run_stage(stage= function, *args) -> None
+    Desc:
+        Entry point of each forked stage. Ctrl-C goes to the whole process
+        group, only the reader acts on it so the rest drain their queues.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stage(*args)
+
+
+def read_stage(d, readings: StageQueue, stages: list) -> None:
+    '''
+    Name:
+        read_stage(d= u6.U6, readings= StageQueue, stages= list) -> None
+    Desc:
+        Queues every reading with the time it arrived. Never waits for the
+        other stages: with DROP_NEWEST a reading that does not fit is
+        dropped, and conversion sees it as lost packets. Every reading
+        carries the count of packets dropped so far, the 8 bit packet
+        numbers wrap after 256.
+    '''
+    dropped = 0
+    for reading in d.streamData(convert=False):
+
+        # Reading is a dict of many things, one of which is the
+        # 'result' which can be passed to processStreamData() to
+        # give voltages.
+
+        if reading is None:
+            continue
+
+        # Stage marks for the websocket server's METRICS, see ring_buffer.py
+        acquired = time.monotonic()
+
+        header = np.array([acquired, reading['firstPacket'], reading['numPackets'], reading['errors'], dropped], dtype=np.float64)
+        if not readings.put(header, bytes(reading['result'])):
+            dropped += reading['numPackets']
+
+        if not all(stage.is_alive() for stage in stages):
+            raise RuntimeError("A pipeline stage exited, see its traceback above")
+
+
+def convert_stage(d, engine: ConversionEngine, V_ref: float, queues: dict, stream_start: float, stream_start_monotonic: float) -> None:
+    '''
+    Name:
+        convert_stage(d= u6.U6, engine= ConversionEngine, V_ref= float, queues= dict, stream_start= float, stream_start_monotonic= float) -> None
+    Desc:
+        Detects gaps, converts every complete scan to SI units, times it by
+        the scan clock, and queues the frames for the recorder and the
+        publisher. d is this process' copy of the device, only used to
+        decode packets.
+    '''
+    # Carries partial scans over to the next packet so no sample is dropped
+    scans = ScanAssembler(engine.channels, [f"AIN{x[0]}" for x in channel_settings])
+    status = {name: 0 for name in ACQUISITION_STATUS}
+    packet_size = 14 + 2 * samples_per_packet
+    next_packet = None
+    dropped_packets = 0
+
+    while len(message := queues['convert'].get()):
+        acquired, first_packet, num_packets, errors, dropped_total = \
+            message[:8 * READING_HEADER_WORDS].view(np.float64).tolist()
+        packets = message[8 * READING_HEADER_WORDS:].reshape(-1, packet_size)
+
+        # Packets read_stage dropped are counted, only the rest of a jump in
+        # the packet numbers was lost on USB
+        dropped, dropped_packets = int(dropped_total) - dropped_packets, int(dropped_total)
+        lost_packets = dropped
+        if next_packet is not None:
+            lost_packets += (int(first_packet) - next_packet - dropped) % 256
+        next_packet = (int(first_packet) + int(num_packets)) % 256
+
+        # The backlog byte of the newest packet, see section 5.2.14
+        status['backlog'] = int(packets[-1, -2])
+        status['backlog_max'] = max(status['backlog_max'], status['backlog'])
+        status['errors'] += errors
+
+        segments = decode_reading(d, engine, V_ref, scans, packets, lost_packets, status, stream_start)
+        queues['convert'].release()
+        converted = time.monotonic()
+
+        timestamps = np.concatenate([segment[1] for segment in segments])
+        samples = np.concatenate([segment[2] for segment in segments])
+        if len(samples):
+            status['lag'] = acquired - stream_start_monotonic - (scans.scans - 1) / scan_frequency
+
+        # Reduce to one value per channel when full rate is not needed, on
+        # each side of a gap
+        reduce = stream_mode == 'AVERAGE' or not publish_raw
+        averaged = [(gap, np.array([times.mean()]), engine.reduce(values)[np.newaxis])
+                    if reduce and len(values) else (gap, times[:0], values[:0])
+                    for gap, times, values in segments]
+        average_time = np.concatenate([segment[1] for segment in averaged])
+        average = np.concatenate([segment[2] for segment in averaged])
+
+        # A gap marker goes in front of the first frame after each gap
+        recorded_time, recorded = [], []
+        for gap, times, values in (segments if stream_mode == 'RAW' else averaged):
+            if gap is not None:
+                recorded_time.append([gap])
+                recorded.append(np.full((1, len(engine.channels)), np.nan))
+            recorded_time.append(times)
+            recorded.append(values)
+        recorded_time, recorded = np.concatenate(recorded_time), np.concatenate(recorded)
+
+        marks = (acquired, converted)
+        if len(recorded_time):
+            queues['record'].put(*frame_message(marks, status, recorded_time, recorded))
+
+        # Publish so the websocket can send to ground support
+        if stream_mode == 'RAW' and publish_raw:
+            queues['publish'].put(*frame_message(marks, status, timestamps, samples))
+        else:
+            queues['publish'].put(*frame_message(marks, status, average_time, average))
+
+    queues['record'].end()
+    queues['publish'].end()
+
+
+def record_stage(recording: RecordingWriter, frames: StageQueue, channels: int, record_status: SharedStatus) -> None:
+    '''
+    Name:
+        record_stage(recording= RecordingWriter, frames= StageQueue, channels= int, record_status= SharedStatus) -> None
+    Desc:
+        Appends every frame to the recording and the archive, the only
+        stage that touches the disk. A WriteBehindRecorder does the writes
+        and the ArchiveWriter compresses in its own thread, so the queue
+        keeps draining while the disk is busy.
+    '''
+    recorder = WriteBehindRecorder(recording, recording_flush_bytes, recording_flush_interval, recording_fsync_interval)
+    recorder.start()
+    archive = None
+    if archive_path is not None:
+        archive = ArchiveWriter(archive_path, recording.channels, recording.value_dtype, recording.metadata,
+                                archive_compression, archive_chunk_duration)
+        archive.start()
+
+    def report():
+        status = {f"recorder_{name}": value for name, value in recorder.status().items()}
+        if archive is not None:
+            status.update({f"archive_{name}": value for name, value in archive.status().items()})
+        record_status.set(status)
+
+    try:
+        while len(message := frames.get()):
+            marks, status, timestamps, values = parse_frame_message(message, channels)
+            recorder.write_frames(timestamps, values)
+            if archive is not None:
+                archive.write_frames(timestamps, values)
+            report()
+    finally:
+        try:
+            recorder.close()
+        finally:
+            if archive is not None:
+                archive.close()
+        report()
+
+
+def publish_stage(ring: RingBufferWriter, queues: dict, channels: int, record_status: SharedStatus) -> None:
+    '''
+    Name:
+        publish_stage(ring= RingBufferWriter, queues= dict, channels= int, record_status= SharedStatus) -> None
+    Desc:
+        Writes every frame and the status of the acquisition, each queue
+        and the record stage to the ring buffer for the websocket server
+    '''
+    while len(message := queues['publish'].get()):
+        marks, status, timestamps, values = parse_frame_message(message, channels)
+        status = dict(zip(ACQUISITION_STATUS, status.tolist()))
+        for stage, queue in queues.items():
+            status.update({f"{stage}_{name}": value for name, value in queue.stats().items()})
+        status.update(record_status.get())
+        ring.write_status(status)
+        if len(timestamps):
+            ring.write_frames(timestamps, values, marks)
+
+
+def frame_message(marks: tuple, status: dict, timestamps: np.ndarray, values: np.ndarray) -> tuple:
+    '''
+    Name:
+        frame_message(marks= tuple, status= dict, timestamps= np.ndarray, values= np.ndarray) -> tuple
+    Returns:
+        The parts of a frame message for StageQueue.put(): the acquired and
+        converted marks and the number of frames, each ACQUISITION_STATUS,
+        then the timestamps and the frames x channels values
+    '''
+    header = np.array([*marks, len(timestamps)] + [status[name] for name in ACQUISITION_STATUS], dtype=np.float64)
+    return header, np.ascontiguousarray(timestamps, dtype=np.float64), np.ascontiguousarray(values, dtype=np.float64)
+
+
+def parse_frame_message(message: np.ndarray, channels: int) -> tuple:
+    '''
+    Name:
+        parse_frame_message(message= np.ndarray, channels= int) -> (tuple, np.ndarray, np.ndarray, np.ndarray)
+    Returns:
+        Views of the marks, status, timestamps and values of a frame message
+    '''
+    words = message.view(np.float64)
+    count = int(words[2])
+    body = FRAME_HEADER_WORDS + len(ACQUISITION_STATUS)
+    return (
+        tuple(words[:2].tolist()),
+        words[FRAME_HEADER_WORDS:body],
+        words[body:body + count],
+        words[body + count:body + count * (1 + channels)].reshape(count, channels))
+
+
+def decode_reading(d, engine: ConversionEngine, V_ref: float, scans: ScanAssembler, packets: np.ndarray, lost_packets: int, status: dict, stream_start: float) -> list:
+    '''
+    Name:
+        decode_reading(d= u6.U6, engine= ConversionEngine, V_ref= float, scans= ScanAssembler, packets= np.ndarray, lost_packets= int, status= dict, stream_start= float) -> list
+    Args:
+        packets: the packets x bytes of a reading
+        lost_packets: packets lost in front of the reading
+    Returns:
+        A (gap, timestamps, samples) segment for the reading and every auto
+        recover packet in it. gap is the time of the gap marker in front of
+        the segment, None if nothing was lost before it.
+    Desc:
+        Converts every complete scan to SI units and times it by the scan
+        clock rather than when the packet arrived. An auto recover packet
+        can be anywhere in the reading, its missed scans are skipped right
+        before it.
+    '''
+    recovered = np.flatnonzero(packets[:, 11] == AUTO_RECOVER_END_OVERFLOW).tolist()
+    starts = sorted({0, *recovered})
+
+    segments = []
+    for start, end in zip(starts, starts[1:] + [len(packets)]):
+        missed = int(packets[start, 6:10].view('<u4')[0]) if start in recovered else 0
+        lost = lost_packets if start == 0 else 0
+        gap = detect_gap(d, scans, missed, lost, status, stream_start) if missed or lost else None
+
+        # LabJackPython decodes bytes
+        first_scan = scans.scans
+        values = d.processStreamData(packets[start:end].tobytes())
+        samples = engine.convert_samples(scans.push(values), V_ref)
+        timestamps = stream_start + (first_scan + np.arange(len(samples))) / scan_frequency
+        segments.append((gap, timestamps, samples))
+    return segments
+
+
+def detect_gap(d, scans: ScanAssembler, missed: int, lost_packets: int, status: dict, stream_start: float) -> float:
+    '''
+    Name:
+        detect_gap(d= u6.U6, scans= ScanAssembler, missed= int, lost_packets= int, status= dict, stream_start= float) -> float
+    Args:
+        missed: scans the LJ reported missed, its buffer overflowed because
+                the host fell behind
+        lost_packets: packets skipped in the packet numbers, never received
+                      or dropped by read_stage
+    Returns:
+        The time of the first lost scan, for the gap marker: a frame of NaN
+        in the recording
+    Desc:
+        Skips the lost samples so later scans keep their time on the scan
+        clock
+    '''
+    channels = len(channel_settings)
+    skipped = missed * channels + lost_packets * samples_per_packet
+
+    # processStreamData() counts the channel of each sample, move it past
+    # the samples it will never see
+    d.streamPacketOffset = (d.streamPacketOffset + lost_packets * samples_per_packet) % channels
+
+    gap_start = stream_start + scans.scans / scan_frequency
+    lost = scans.skip(skipped)
+
+    status['missed_scans'] += missed
+    status['lost_packets'] += lost_packets
+    status['gaps'] += 1
+    print(f"Gap of {lost} scans ({lost / scan_frequency:.3f} s): {missed} scans missed, {lost_packets} packets lost")
+    return gap_start
+
+
+def main(simulate: bool = False) -> None:
+    check_settings()
+
+    d = open_device(simulate)
+    if d is None:
+        print("No LabJack device connected. Exiting...")
+        return
+
+    V_ref = configure_stream(d)
+
+    # Stream data from the LJ
     d.streamStart()
 
-try:
-    with open('instrumentation_data.txt', 'w') as file:
-
-        # Contains sensor values in SI units
-        converted = {}
-
-        for reading in d.streamData(convert=False):
-
-            # Reading is a dict of many things, one of which is the
-            # 'result' which can be passed to processStreamData() to
-            # give voltages.
-
-            if reading is not None:
-
-                values = d.processStreamData(reading['result'])
-
-                # Extract values from each channel
-                P_INJECTOR   = values[CHAN_P_INJECTOR]
-                P_COMB_CHMBR = values[CHAN_P_COMB_CHMBR]
-                P_N2O_FLOW   = values[CHAN_P_N2O_FLOW]
-                P_N2_FLOW    = values[CHAN_P_N2_FLOW]
-                P_RUN_TANK   = values[CHAN_P_RUN_TANK]
-
-                L_RUN_TANK   = values[CHAN_L_RUN_TANK]
-                L_THRUST     = values[CHAN_L_THRUST]
-
-                T_RUN_TANK   = values[CHAN_T_RUN_TANK]
-                T_INJECTOR   = values[CHAN_T_INJECTOR]
-                T_COMB_CHMBR = values[CHAN_T_COMB_CHMBR]
-                T_POST_COMB  = values[CHAN_T_POST_COMB]
-
-                SHUNT        = values[CHAN_SHUNT]
-
-                # Convert voltage to sensor value in SI units and store in dict
-                
-                converted['P_INJECTOR'] = \
-                (sum(P_INJECTOR)/len(P_INJECTOR))*GAIN_P_INJECTOR
-
-                converted['P_COMB_CHMBR'] = \
-                (sum(P_COMB_CHMBR)/len(P_COMB_CHMBR))*GAIN_P_COMB_CHMBR
-
-                converted['P_N2O_FLOW'] = \
-                (sum(P_N2O_FLOW)/len(P_N2O_FLOW))*GAIN_P_N2O_FLOW
-
-                converted['P_N2_FLOW'] = \
-                (sum(P_N2_FLOW)/len(P_N2_FLOW))*GAIN_P_N2_FLOW
-
-                converted['P_RUN_TANK'] = \
-                (sum(P_RUN_TANK)/len(P_RUN_TANK))*GAIN_P_RUN_TANK
-
-                converted['L_RUN_TANK'] = \
-                (sum(L_RUN_TANK)/len(L_RUN_TANK))*GAIN_L_RUN_TANK+OFFSET_L_RUN_TANK
-
-                converted['L_THRUST'] = \
-                (sum(L_THRUST)/len(L_THRUST))*GAIN_L_THRUST+OFFSET_L_THRUST
-                # Thermocouples
-                converted['T_RUN_TANK'] = \
-                        V_to_K((sum(T_RUN_TANK)/len(T_RUN_TANK)), V_ref)
-
-                converted['T_INJECTOR'] = \
-                        V_to_K((sum(T_INJECTOR)/len(T_INJECTOR)), V_ref)
-
-                converted['T_COMB_CHMBR'] = \
-                        V_to_K((sum(T_COMB_CHMBR)/len(T_COMB_CHMBR)), V_ref)
-
-                converted['T_POST_COMB'] = \
-                        V_to_K((sum(T_POST_COMB)/len(T_POST_COMB)), V_ref)
-
-                # Write to file so websocket can send to ground support
-                file.write(f'{json.dumps(converted)}\n')
-                with open('tmp.txt', 'w') as tmp:
-                  tmp.write(f'{json.dumps(converted)}')
-                  tmp.write('\n!')
-except:
-    print("Interrupt signal received!")
-finally:
-    d.streamStop()
-    print("Stream stopped.\n")
-    d.close()
-
+    # Anchor the scan clock to the host once, every scan time is derived
+    # from it so the time axis does not jitter with USB or the scheduler
+    stream_start = time.time()
+    stream_start_monotonic = time.monotonic()
+
+    # Gains, offsets and thermocouple rows for every sensor, built once
+    engine = ConversionEngine(sensors)
+
+    # Hands each converted packet to the websocket server
+    ring = RingBufferWriter(engine.names, engine.units, status=PIPELINE_STATUS)
+
+    recording = RecordingWriter(recording_path, engine.schema(), recording_dtype, metadata={
+        'scan_frequency': scan_frequency,
+        'samples_per_packet': samples_per_packet,
+        'resolution_index': resolution_index,
+        'settling_factor': settling_factor,
+        'stream_mode': stream_mode,
+        'stream_start': stream_start,
+        'stream_start_monotonic': stream_start_monotonic,
+        'channel_settings': channel_settings,
+        'V_ref': V_ref,
+        'simulated': simulate
+    })
+
+    try:
+        stream(d, engine, V_ref, recording, ring, stream_start, stream_start_monotonic)
+    except KeyboardInterrupt:
+        print("Interrupt signal received!")
+    finally:
+        d.streamStop()
+        print("Stream stopped.\n")
+        d.close()
+        recording.close()
+        ring.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stream the LabJack to the recording and the websocket server")
+    parser.add_argument('--simulate', action='store_true', help="stream from a FakeU6 instead of a connected LabJack")
+    args = parser.parse_args()
+
+    main(args.simulate)
@@ -0,0 +1,466 @@
+'''
+Append-only binary recording format for test-fire data.
+
+A recording is a self describing header followed by fixed width frames, so
+a whole firing can be loaded with np.memmap without parsing anything:
+
+    magic        8 bytes  b'PDPREC01'
+    length       uint32   length of the JSON header in bytes
+    header       JSON     {"version", "dtype", "channels", "metadata"}
+    padding      zeros up to the next multiple of ALIGNMENT bytes
+    frames       [('timestamp', '<f8'), ('values', dtype, (num_channels,))]
+
+Each channel in the header is a dict with at least a 'name' and 'unit', plus
+whatever calibration the writer was given (gain, offset, LJ channel).
+
+WriteBehindRecorder moves the writes to a background thread and commits
+frames in large groups, with an optional periodic fsync.
+
+A frame with every value NaN is a gap marker: the scans from its timestamp
+up to the next frame were lost by the LabJack or on the way to the VC.
+
+Run as a script to convert a recording back to text:
+    python recording.py instrumentation_data.pdprec --csv out.csv
+    python recording.py instrumentation_data.pdprec --jsonl out.jsonl
+'''
+import io
+import os
+import sys
+import json
+import math
+import time
+import queue
+import struct
+import argparse
+import contextlib
+import threading
+import numpy as np
+
+MAGIC = b'PDPREC01'
+VERSION = 1
+ALIGNMENT = 64
+PREAMBLE_FORMAT = '<8sI'
+
+# WriteBehindRecorder writes once FLUSH_BYTES are pending or the oldest
+# pending frame is FLUSH_INTERVAL seconds old. With an fsync interval, at
+# most that long plus FLUSH_INTERVAL of data is lost on power loss.
+DEFAULT_FLUSH_BYTES = 1 << 20
+DEFAULT_FLUSH_INTERVAL = 0.1
+
+# CSV columns, see write_csv()
+CSV_TIMESTAMP_FORMAT = '%.6f'
+CSV_VALUE_FORMAT = '%.9g'
+
+# Statistics of a WriteBehindRecorder, see WriteBehindRecorder.status()
+RECORDER_STATUS = ('pending', 'pending_max', 'written_mb', 'write_mb_per_s', 'fsync_max')
+
+
+class RecordingError(Exception):
+    pass
+
+
+def frame_dtype(num_channels: int, value_dtype: str = 'float32') -> np.dtype:
+    '''
+    Name:
+        frame_dtype(num_channels= int, value_dtype= str) -> np.dtype
+    Args:
+        num_channels: number of values in each frame
+        value_dtype: 'float32' or 'float64'
+    Returns:
+        The structured dtype of one frame
+    '''
+    return np.dtype([
+        ('timestamp', '<f8'),
+        ('values', np.dtype(value_dtype).newbyteorder('<'), (num_channels,))])
+
+
+class RecordingWriter:
+    '''
+    Name:
+        RecordingWriter
+    Desc:
+        Writes the header on creation and then appends frames. Frames are
+        written straight from NumPy arrays so the cost per packet is one
+        buffered write no matter how many channels or samples it holds.
+
+    Public:
+        path: the recording file
+        channels: list of channel description dicts from the header
+        value_dtype: 'float32' or 'float64'
+        metadata: the metadata dict from the header
+        dtype: the structured dtype of one frame
+        frames_written: number of frames appended so far
+    '''
+    def __init__(self, path: str, channels: list, value_dtype: str = 'float32', metadata: dict = None):
+        if value_dtype not in ('float32', 'float64'):
+            raise RecordingError(f"Unsupported value dtype: {value_dtype}")
+
+        self.path = path
+        self.channels = channels
+        self.value_dtype = value_dtype
+        self.metadata = metadata or {}
+        self.dtype = frame_dtype(len(channels), value_dtype)
+        self.frames_written = 0
+
+        header = json.dumps({
+            'version': VERSION,
+            'dtype': value_dtype,
+            'channels': channels,
+            'metadata': self.metadata
+        }).encode()
+        preamble_size = struct.calcsize(PREAMBLE_FORMAT) + len(header)
+        padding = -preamble_size % ALIGNMENT
+
+        self.__file = open(path, 'wb', buffering=io.DEFAULT_BUFFER_SIZE * 64)
+        self.__file.write(struct.pack(PREAMBLE_FORMAT, MAGIC, len(header)))
+        self.__file.write(header)
+        self.__file.write(bytes(padding))
+
+
+    def write(self, timestamp: float, values) -> None:
+        '''
+        Name:
+            RecordingWriter.write(timestamp= float, values= list | np.ndarray) -> None
+        Args:
+            timestamp: the time of the frame
+            values: one value per channel
+        Desc:
+            Appends a single frame
+        '''
+        frame = np.empty(1, dtype=self.dtype)
+        frame['timestamp'] = timestamp
+        frame['values'] = values
+        self.__file.write(frame.tobytes())
+        self.frames_written += 1
+
+
+    def write_frames(self, timestamps, values) -> None:
+        '''
+        Name:
+            RecordingWriter.write_frames(timestamps= np.ndarray, values= np.ndarray) -> None
+        Args:
+            timestamps: array of N frame times
+            values: N x channels array of values
+        Desc:
+            Appends N frames in a single write
+        '''
+        self.append(self.encode(timestamps, values))
+
+
+    def encode(self, timestamps, values) -> np.ndarray:
+        '''
+        Name:
+            RecordingWriter.encode(timestamps= np.ndarray, values= np.ndarray) -> np.ndarray
+        Returns:
+            The N frames as an array of dtype, ready for append()
+        '''
+        frames = np.empty(len(timestamps), dtype=self.dtype)
+        frames['timestamp'] = timestamps
+        frames['values'] = values
+        return frames
+
+
+    def append(self, frames) -> None:
+        '''
+        Name:
+            RecordingWriter.append(frames= np.ndarray | bytes) -> None
+        Args:
+            frames: frames from encode(), or several joined as bytes
+        '''
+        self.__file.write(frames)
+        self.frames_written += (frames.nbytes if isinstance(frames, np.ndarray) else len(frames)) // self.dtype.itemsize
+
+
+    def flush(self) -> None:
+        self.__file.flush()
+
+
+    def sync(self) -> None:
+        '''
+        Name:
+            RecordingWriter.sync() -> None
+        Desc:
+            Flushes and waits for the disk to have every frame
+        '''
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+
+    def close(self) -> None:
+        self.__file.close()
+
+
+class WriteBehindRecorder(threading.Thread):
+    '''
+    Name:
+        WriteBehindRecorder
+    Desc:
+        Appends frames to a RecordingWriter from a background thread, so the
+        caller never waits on the disk. write() and write_frames() only
+        encode and queue the frames. The thread gathers them until
+        flush_bytes are pending or the oldest is flush_interval seconds
+        old, then commits the group with one write and one flush, and
+        fsyncs at most every fsync_interval seconds. Frames written but not
+        synced are synced once the interval is up even if no more come.
+
+        An error writing the file stops the thread and is raised by the
+        next write or close(), a recording is never silently cut short.
+
+    Public:
+        writer: the RecordingWriter written to
+        flush_bytes: bytes pending that trigger a write
+        flush_interval: the most seconds a frame waits to be written
+        fsync_interval: the most seconds between fsyncs, None for never
+        frames_queued: frames queued so far
+        frames_written: frames written so far
+        bytes_written: bytes written so far
+    '''
+    def __init__(
+        self,
+        writer: RecordingWriter,
+        flush_bytes: int = DEFAULT_FLUSH_BYTES,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        fsync_interval: float = None
+    ):
+        super().__init__(name="WriteBehindRecorder", daemon=True)
+        self.writer = writer
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.frames_queued = 0
+        self.frames_written = 0
+        self.bytes_written = 0
+
+        self.__queue = queue.SimpleQueue()
+        self.__pending_max = 0
+        self.__write_time = 0.0
+        self.__fsync_max = 0.0
+        self.__error = None
+
+
+    def write(self, timestamp: float, values) -> None:
+        self.write_frames(np.array([timestamp]), np.asarray(values)[np.newaxis])
+
+
+    def write_frames(self, timestamps, values) -> None:
+        '''
+        Name:
+            WriteBehindRecorder.write_frames(timestamps= np.ndarray, values= np.ndarray) -> None
+        Desc:
+            Queues N frames. The arrays are copied, they can be reused.
+        '''
+        if self.__error is not None:
+            raise self.__error
+        self.__queue.put(self.writer.encode(timestamps, values))
+        self.frames_queued += len(timestamps)
+        self.__pending_max = max(self.__pending_max, self.frames_queued - self.frames_written)
+
+
+    def status(self) -> dict:
+        '''
+        Name:
+            WriteBehindRecorder.status() -> dict
+        Returns:
+            Each of RECORDER_STATUS: frames queued but not written now and
+            at most, MB written, MB/s while writing, and the longest fsync
+            in seconds
+        '''
+        return {
+            'pending': self.frames_queued - self.frames_written,
+            'pending_max': self.__pending_max,
+            'written_mb': self.bytes_written / 1e6,
+            'write_mb_per_s': self.bytes_written / 1e6 / self.__write_time if self.__write_time else 0.0,
+            'fsync_max': self.__fsync_max
+        }
+
+
+    def run(self) -> None:
+        synced = time.monotonic()
+        unsynced = False
+        stopping = False
+        try:
+            while not stopping:
+                # Waits for frames, or for the next fsync of frames not
+                # synced yet
+                timeout = None
+                if unsynced and self.fsync_interval is not None:
+                    timeout = max(0.0, synced + self.fsync_interval - time.monotonic())
+                try:
+                    batch = [self.__queue.get(timeout=timeout)]
+                except queue.Empty:
+                    synced = self.__sync()
+                    unsynced = False
+                    continue
+
+                size = 0 if batch[0] is None else batch[0].nbytes
+                deadline = time.monotonic() + self.flush_interval
+                while size < self.flush_bytes and batch[-1] is not None:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        batch.append(self.__queue.get(timeout=remaining) if remaining > 0 else self.__queue.get_nowait())
+                    except queue.Empty:
+                        break
+                    if batch[-1] is not None:
+                        size += batch[-1].nbytes
+
+                if batch[-1] is None:
+                    batch.pop()
+                    stopping = True
+
+                started = time.monotonic()
+                if batch:
+                    self.writer.append(b''.join(batch))
+                    self.writer.flush()
+                    unsynced = True
+                if self.fsync_interval is not None and unsynced and (stopping or started - synced >= self.fsync_interval):
+                    synced = self.__sync()
+                    unsynced = False
+
+                self.__write_time += time.monotonic() - started
+                self.frames_written += sum(len(frames) for frames in batch)
+                self.bytes_written += size
+        except OSError as error:
+            self.__error = error
+
+
+    def __sync(self) -> float:
+        syncing = time.monotonic()
+        self.writer.sync()
+        synced = time.monotonic()
+        self.__fsync_max = max(self.__fsync_max, synced - syncing)
+        return synced
+
+
+    def close(self) -> None:
+        '''
+        Name:
+            WriteBehindRecorder.close() -> None
+        Desc:
+            Writes every frame already queued, then closes the recording
+        '''
+        if self.is_alive():
+            self.__queue.put(None)
+            self.join()
+        self.writer.close()
+        if self.__error is not None:
+            raise self.__error
+
+
+def read_header(path: str) -> tuple:
+    '''
+    Name:
+        read_header(path= str) -> (dict, int)
+    Args:
+        path: the recording file
+    Returns:
+        The decoded JSON header and the byte offset of the first frame
+    '''
+    with open(path, 'rb') as file:
+        preamble = file.read(struct.calcsize(PREAMBLE_FORMAT))
+        if len(preamble) < struct.calcsize(PREAMBLE_FORMAT):
+            raise RecordingError(f"{path} is too short to be a recording")
+
+        magic, length = struct.unpack(PREAMBLE_FORMAT, preamble)
+        if magic != MAGIC:
+            raise RecordingError(f"{path} is not a PDP recording")
+
+        header = json.loads(file.read(length))
+
+    preamble_size = struct.calcsize(PREAMBLE_FORMAT) + length
+    return header, preamble_size + (-preamble_size % ALIGNMENT)
+
+
+def open_recording(path: str) -> tuple:
+    '''
+    Name:
+        open_recording(path= str) -> (dict, np.memmap)
+    Args:
+        path: the recording file
+    Returns:
+        The header and a read only memmap of every complete frame. A frame
+        left half written by a power loss is ignored.
+    Desc:
+        frames['timestamp'] is the time axis and frames['values'][:, i] is
+        channel header['channels'][i]
+    '''
+    header, offset = read_header(path)
+    dtype = frame_dtype(len(header['channels']), header['dtype'])
+
+    with open(path, 'rb') as file:
+        file.seek(0, io.SEEK_END)
+        count = (file.tell() - offset) // dtype.itemsize
+
+    if count == 0:
+        return header, np.empty(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def to_csv(path: str, output) -> None:
+    '''
+    Name:
+        to_csv(path= str, output= file) -> None
+    Args:
+        path: the recording file
+        output: a text file to write to
+    Desc:
+        Writes a timestamp column and one column per channel
+    '''
+    header, frames = open_recording(path)
+    write_csv(output, [channel['name'] for channel in header['channels']], frames['timestamp'], frames['values'])
+
+
+def write_csv(output, names: list, timestamps, values) -> None:
+    '''
+    Name:
+        write_csv(output= file, names= list, timestamps= np.ndarray, values= np.ndarray) -> None
+    Args:
+        output: a text file to write to
+        names: the name of each channel
+        timestamps: N frame times
+        values: N x channels array of values
+    Desc:
+        Writes a header line, then a timestamp column and one column per
+        channel. Timestamps are written to the microsecond, 9 significant
+        digits would round a Unix time to 10 s.
+    '''
+    output.write(','.join(['timestamp'] + names) + '\n')
+    if len(timestamps):
+        np.savetxt(output, np.column_stack([timestamps, values]), delimiter=',',
+                   fmt=[CSV_TIMESTAMP_FORMAT] + [CSV_VALUE_FORMAT] * len(names))
+
+
+def to_json_lines(path: str, output) -> None:
+    '''
+    Name:
+        to_json_lines(path= str, output= file) -> None
+    Args:
+        path: the recording file
+        output: a text file to write to
+    Desc:
+        Writes one JSON object per frame in the same form the old
+        instrumentation_data.txt used, with an added timestamp. Gap markers
+        and other values that are not finite are null, NaN is not JSON.
+    '''
+    header, frames = open_recording(path)
+    names = [channel['name'] for channel in header['channels']]
+
+    for timestamp, values in zip(frames['timestamp'].tolist(), frames['values'].tolist()):
+        line = dict(zip(names, (value if math.isfinite(value) else None for value in values)))
+        line['timestamp'] = timestamp
+        output.write(json.dumps(line) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a PDP recording to text")
+    parser.add_argument('recording')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--csv', metavar='OUTPUT')
+    group.add_argument('--jsonl', metavar='OUTPUT')
+    args = parser.parse_args()
+
+    output_path = args.csv or args.jsonl
+    with (open(output_path, 'w') if output_path != '-' else contextlib.nullcontext(sys.stdout)) as output:
+        if args.csv:
+            to_csv(args.recording, output)
+        else:
+            to_json_lines(args.recording, output)
@@ -0,0 +1,378 @@
+'''
+Lock-free shared memory ring buffer of fixed size sample records.
+
+read_labjack.py is the single producer. Every record is a float64 timestamp
+followed by one float64 per channel. Any number of readers (the websocket
+server, one per client) attach by name and follow their own cursor, so there
+is no lock between the processes.
+
+The ring is a memory mapped file in /dev/shm, a RAM backed tmpfs on Linux,
+so handing off a sample never touches the disk.
+
+Each slot has a stamp that the writer sets to 2n+1 while record n is being
+written and 2n+2 once it is complete (a seqlock). A reader copies the slot
+and then checks the stamp again, so a record that was overwritten while it
+was being read is detected and counted as an overrun rather than returned
+torn.
+
+Every record also carries the time.monotonic() stage marks of the packet it
+came from (see STAGE_MARKS), so the websocket server can tell how long the
+sample spent in each stage before the handoff. CLOCK_MONOTONIC is shared by
+every process on the machine, so the marks compare with the server's clock.
+
+The writer also keeps the state of the acquisition (see
+ACQUISITION_STATUS, plus whatever status the writer was created with) at
+the end of the header, so the websocket server can report gaps and backlog
+even when no samples are flowing.
+
+Layout of the shared memory file:
+    header (HEADER_SIZE bytes):
+        magic, capacity, number of channels, write sequence, schema length,
+        schema (JSON object of the channel names, units and status names),
+        status: float64[number of status names] at the end
+    stamps: uint64[capacity]
+    slots:  float64[capacity, 1 + number of channels]
+    marks:  float64[capacity, len(STAGE_MARKS)]
+'''
+import os
+import mmap
+import json
+import time
+import struct
+import tempfile
+import numpy as np
+
+INSTRUMENTATION_RING_NAME = 'pdp_instrumentation'
+DEFAULT_CAPACITY = 4096
+
+MAGIC = b'PDPRING3'
+HEADER_SIZE = 4096
+HEADER_FORMAT = '<8sQQQI'
+SCHEMA_OFFSET = struct.calcsize(HEADER_FORMAT)
+
+# Index of the write sequence in the header when viewed as uint64
+WRITE_SEQ_INDEX = 3
+
+# Stage boundaries stamped on every record: when the packet was received
+# from the LabJack, when it was converted, and when it was written to the
+# ring. The writer stamps the handoff itself.
+STAGE_MARKS = ('acquired', 'converted', 'handoff')
+
+# State of the acquisition written by read_labjack.py after every packet:
+#   backlog: percent of the LabJack stream buffer in use
+#   backlog_max: the most backlog seen
+#   lag: seconds between the newest scan on the scan clock and its packet
+#        arriving, grows when the host falls behind or the clocks drift
+#   missed_scans: scans the LabJack reported missed after its buffer overflowed
+#   lost_packets: packets that never arrived, from gaps in the packet numbers
+#   gaps: number of gaps, each marked in the recording
+#   errors: packets with an errorcode
+ACQUISITION_STATUS = ('backlog', 'backlog_max', 'lag', 'missed_scans', 'lost_packets', 'gaps', 'errors')
+
+
+class RingBufferError(Exception):
+    pass
+
+
+def ring_path(name: str) -> str:
+    '''
+    Name:
+        ring_path(name= str) -> str
+    Desc:
+        Path of the ring file, in /dev/shm when available so it is RAM backed
+    '''
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+def _views(buffer: mmap.mmap, capacity: int, num_channels: int, num_status: int):
+    header = np.ndarray((HEADER_SIZE // 8,), dtype=np.uint64, buffer=buffer)
+    status = np.ndarray((num_status,), dtype=np.float64, buffer=buffer, offset=HEADER_SIZE - 8 * num_status)
+    stamps = np.ndarray((capacity,), dtype=np.uint64, buffer=buffer, offset=HEADER_SIZE)
+    slots = np.ndarray(
+        (capacity, 1 + num_channels), dtype=np.float64, buffer=buffer,
+        offset=HEADER_SIZE + 8 * capacity)
+    marks = np.ndarray(
+        (capacity, len(STAGE_MARKS)), dtype=np.float64, buffer=buffer,
+        offset=HEADER_SIZE + 8 * capacity * (2 + num_channels))
+    return header, status, stamps, slots, marks
+
+
+class RingBufferWriter:
+    '''
+    Name:
+        RingBufferWriter
+    Desc:
+        The single producer side of the ring buffer. Creates the ring file,
+        replacing any file left behind by a previous run.
+
+    Public:
+        channels: the channel names of each record
+        units: the unit of each channel
+        capacity: the number of records kept before the oldest is overwritten
+        status_names: the names of the status values, see write_status()
+    '''
+    def __init__(
+        self,
+        channels: list,
+        units: list = None,
+        name: str = INSTRUMENTATION_RING_NAME,
+        capacity: int = DEFAULT_CAPACITY,
+        status: tuple = ACQUISITION_STATUS
+    ):
+        self.channels = list(channels)
+        self.units = list(units) if units is not None else [''] * len(self.channels)
+        self.capacity = capacity
+        self.status_names = tuple(status)
+
+        schema = json.dumps({'channels': self.channels, 'units': self.units, 'status': self.status_names}).encode()
+        if SCHEMA_OFFSET + len(schema) > HEADER_SIZE - 8 * len(self.status_names):
+            raise RingBufferError(f"Channel schema is too large for the header ({len(schema)} bytes)")
+
+        size = HEADER_SIZE + 8 * capacity * (2 + len(self.channels) + len(STAGE_MARKS))
+        self.__path = ring_path(name)
+
+        # Build the new ring beside the old one so readers never see it half
+        # initialized, then swap it in
+        staging = f'{self.__path}.{os.getpid()}'
+        with open(staging, 'w+b') as file:
+            file.truncate(size)
+            self.__mmap = mmap.mmap(file.fileno(), size)
+        struct.pack_into(HEADER_FORMAT, self.__mmap, 0, MAGIC, capacity, len(self.channels), 0, len(schema))
+        self.__mmap[SCHEMA_OFFSET:SCHEMA_OFFSET + len(schema)] = schema
+        os.replace(staging, self.__path)
+
+        self.__header, self.__status, self.__stamps, self.__slots, self.__marks = \
+            _views(self.__mmap, capacity, len(self.channels), len(self.status_names))
+        self.__status_index = {name: i for i, name in enumerate(self.status_names)}
+        self.__sequence = 0
+
+
+    def write(self, timestamp: float, values, marks=None) -> None:
+        '''
+        Name:
+            RingBufferWriter.write(timestamp= float, values= list | np.ndarray, marks= tuple) -> None
+        Args:
+            timestamp: the time of the sample
+            values: one value per channel in the order of channels
+            marks: the acquired and converted stage marks, NaN if None
+        Desc:
+            Publishes one record. Never blocks, the oldest record is
+            overwritten once the ring is full.
+        '''
+        slot = self.__sequence % self.capacity
+        self.__stamps[slot] = 2 * self.__sequence + 1
+        self.__slots[slot, 0] = timestamp
+        self.__slots[slot, 1:] = values
+        self.__marks[slot, :-1] = np.nan if marks is None else marks
+        self.__marks[slot, -1] = time.monotonic()
+        self.__stamps[slot] = 2 * self.__sequence + 2
+
+        self.__sequence += 1
+        self.__header[WRITE_SEQ_INDEX] = self.__sequence
+
+
+    def write_frames(self, timestamps, values, marks=None) -> None:
+        '''
+        Name:
+            RingBufferWriter.write_frames(timestamps= np.ndarray, values= np.ndarray, marks= tuple) -> None
+        Args:
+            timestamps: array of N sample times
+            values: N x channels array of values
+            marks: the acquired and converted stage marks shared by the N
+                   records, NaN if None
+        Desc:
+            Publishes N records with a handful of vectorized copies instead
+            of N calls to write(). If N is larger than the ring only the
+            newest capacity records are kept, the rest count as overwritten.
+        '''
+        count = len(timestamps)
+        skipped = max(count - self.capacity, 0)
+        sequences = self.__sequence + np.arange(skipped, count, dtype=np.uint64)
+        slots = sequences % np.uint64(self.capacity)
+
+        self.__stamps[slots] = 2 * sequences + 1
+        self.__slots[slots, 0] = timestamps[skipped:]
+        self.__slots[slots, 1:] = values[skipped:]
+        self.__marks[slots, :-1] = np.nan if marks is None else marks
+        self.__marks[slots, -1] = time.monotonic()
+        self.__stamps[slots] = 2 * sequences + 2
+
+        self.__sequence += count
+        self.__header[WRITE_SEQ_INDEX] = self.__sequence
+
+
+    def write_status(self, status: dict) -> None:
+        '''
+        Name:
+            RingBufferWriter.write_status(status= dict) -> None
+        Args:
+            status: a value for some or all of the status names. Names the
+                    ring was not created with are ignored.
+        Desc:
+            Each value is a single aligned store, readers never see one torn
+        '''
+        for name, value in status.items():
+            index = self.__status_index.get(name)
+            if index is not None:
+                self.__status[index] = value
+
+
+    def close(self) -> None:
+        '''
+        Name:
+            RingBufferWriter.close() -> None
+        Desc:
+            Releases and removes the ring file
+        '''
+        del self.__header, self.__status, self.__stamps, self.__slots, self.__marks
+        self.__mmap.close()
+        os.remove(self.__path)
+
+
+class RingBufferReader:
+    '''
+    Name:
+        RingBufferReader
+    Desc:
+        A consumer of the ring buffer with its own cursor. Starts at the
+        newest record so only samples published after attaching are read.
+
+        The reader keeps the ring it attached to. A writer that restarts
+        replaces the file with a new ring, and one that stops removes it,
+        either way replaced() tells the reader to attach again.
+
+    Public:
+        channels: the channel names of each record
+        units: the unit of each channel
+        capacity: the number of records in the ring
+        cursor: the sequence number of the next record to read
+        overruns: total number of records lost because the reader fell behind
+        status_names: the names of the status values, see status()
+    '''
+    def __init__(self, name: str = INSTRUMENTATION_RING_NAME):
+        self.__path = ring_path(name)
+        with open(self.__path, 'rb') as file:
+            self.__mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(file.fileno())
+        self.__file_id = (stat.st_dev, stat.st_ino)
+
+        magic, capacity, num_channels, sequence, schema_length = \
+            struct.unpack_from(HEADER_FORMAT, self.__mmap, 0)
+        if magic != MAGIC:
+            self.__mmap.close()
+            raise RingBufferError(f"{name} is not an instrumentation ring buffer")
+
+        schema = json.loads(self.__mmap[SCHEMA_OFFSET:SCHEMA_OFFSET + schema_length])
+        self.channels = schema['channels']
+        self.units = schema['units']
+        self.status_names = tuple(schema['status'])
+        self.capacity = capacity
+        self.cursor = sequence
+        self.overruns = 0
+
+        self.__header, self.__status, self.__stamps, self.__slots, self.__marks = \
+            _views(self.__mmap, capacity, num_channels, len(self.status_names))
+
+
+    def read(self, max_records: int = None) -> tuple:
+        '''
+        Name:
+            RingBufferReader.read(max_records= int) -> (np.ndarray, int)
+        Args:
+            max_records: the most records to return, all available if None
+        Returns:
+            An array of records, one row of [timestamp, *values] each, and the
+            number of records that were overwritten before they could be read
+        '''
+        sequences, records, overrun = self.read_sequenced(max_records)
+        return records, overrun
+
+
+    def read_sequenced(self, max_records: int = None) -> tuple:
+        '''
+        Name:
+            RingBufferReader.read_sequenced(max_records= int) -> (np.ndarray, np.ndarray, int)
+        Args:
+            max_records: the most records to return, all available if None
+        Returns:
+            Like read(), with the sequence number of each record first so
+            consumers can number the samples they pass on
+        '''
+        head = int(self.__header[WRITE_SEQ_INDEX])
+        overrun = 0
+
+        if head - self.cursor > self.capacity:
+            overrun = head - self.capacity - self.cursor
+            self.cursor = head - self.capacity
+
+        count = head - self.cursor
+        if max_records is not None:
+            count = min(count, max_records)
+
+        sequences = np.arange(self.cursor, self.cursor + count, dtype=np.uint64)
+        slots = sequences % np.uint64(self.capacity)
+
+        before = self.__stamps[slots]
+        records = self.__slots[slots]
+        after = self.__stamps[slots]
+
+        valid = (before == after) & (after == 2 * sequences + 2)
+        if not valid.all():
+            overrun += int(count - valid.sum())
+            sequences = sequences[valid]
+            records = records[valid]
+
+        self.cursor += count
+        self.overruns += overrun
+        return sequences, records, overrun
+
+
+    def marks(self, sequences) -> np.ndarray:
+        '''
+        Name:
+            RingBufferReader.marks(sequences= np.ndarray) -> np.ndarray
+        Args:
+            sequences: sequence numbers returned by read_sequenced()
+        Returns:
+            One row of STAGE_MARKS per sequence. The marks are only for
+            timing, a record overwritten since it was read has the marks of
+            the newer record.
+        '''
+        return self.__marks[np.asarray(sequences, dtype=np.uint64) % np.uint64(self.capacity)]
+
+
+    def status(self) -> dict:
+        '''
+        Name:
+            RingBufferReader.status() -> dict
+        Returns:
+            The latest value of each status name
+        '''
+        return dict(zip(self.status_names, self.__status.tolist()))
+
+
+    def replaced(self) -> bool:
+        '''
+        Name:
+            RingBufferReader.replaced() -> bool
+        Returns:
+            True if the ring file was removed or replaced since attaching,
+            nothing more will be written to this ring
+        '''
+        try:
+            stat = os.stat(self.__path)
+        except FileNotFoundError:
+            return True
+        return (stat.st_dev, stat.st_ino) != self.__file_id
+
+
+    def close(self) -> None:
+        '''
+        Name:
+            RingBufferReader.close() -> None
+        Desc:
+            Detaches from the ring file
+        '''
+        del self.__header, self.__status, self.__stamps, self.__slots, self.__marks
+        self.__mmap.close()
@@ -0,0 +1,238 @@
+'''
+Bounded single producer, single consumer queue between the processes of the
+acquisition pipeline (see stream() in read_labjack.py).
+
+A queue is an anonymous shared memory mapping made before the stage
+processes are forked, so both sides map the same slots. put() copies a
+message straight into its slot and get() returns a view of the slot, so a
+message is copied once and never pickled.
+
+Each slot holds one message of at most slot_size bytes. The producer only
+moves head and the consumer only moves tail, so no lock is needed. The slot
+returned by get() stays with the consumer until its next get() or
+release(), the view must not be used after that.
+
+What put() does when the queue is full is the policy of the queue:
+    BLOCK         wait for the consumer, for stages that must not lose data
+    DROP_NEWEST   drop the new message and count it, for stages that must
+                  never wait
+
+An empty message ends the stream, see end().
+'''
+import mmap
+import time
+import numpy as np
+
+BLOCK       = "BLOCK"         # wait for the consumer to free a slot
+DROP_NEWEST = "DROP_NEWEST"   # drop the message that does not fit
+
+STAGE_POLICIES = (BLOCK, DROP_NEWEST)
+
+# Seconds to wait between polls of a full or empty queue
+STAGE_POLL_INTERVAL = 0.0005
+
+# Statistics of each queue, see StageQueue.stats()
+QUEUE_STATS = ('depth', 'max_depth', 'dropped', 'blocked')
+
+# Index of each uint64 word in the header
+HEAD_INDEX = 0
+TAIL_INDEX = 1
+DROPPED_INDEX = 2
+MAX_DEPTH_INDEX = 3
+BLOCKED_INDEX = 4   # microseconds put() waited
+HEADER_WORDS = 8
+
+
+class StageQueueError(Exception):
+    pass
+
+
+class StageQueue:
+    '''
+    Name:
+        StageQueue
+    Desc:
+        One queue between two stages. Make it in the parent, then use put()
+        in one process and get() in the other.
+
+    Public:
+        name: the stage the queue feeds, for logs and stats
+        capacity: messages held before put() applies the policy
+        slot_size: the largest message in bytes
+        policy: one of STAGE_POLICIES
+    '''
+    def __init__(self, capacity: int, slot_size: int, policy: str = BLOCK, name: str = ''):
+        if policy not in STAGE_POLICIES:
+            raise ValueError(f"Unknown stage policy {policy}, expected one of {STAGE_POLICIES}")
+
+        self.name = name
+        self.capacity = capacity
+        # Whole words, so float64 messages stay aligned in every slot
+        self.slot_size = -(-slot_size // 8) * 8
+        self.policy = policy
+
+        lengths_offset = 8 * HEADER_WORDS
+        slots_offset = lengths_offset + 8 * capacity
+        self.__mmap = mmap.mmap(-1, slots_offset + capacity * self.slot_size)
+        self.__header = np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=self.__mmap)
+        self.__lengths = np.ndarray((capacity,), dtype=np.uint64, buffer=self.__mmap, offset=lengths_offset)
+        self.__slots = np.ndarray((capacity, self.slot_size), dtype=np.uint8, buffer=self.__mmap, offset=slots_offset)
+        self.__held = False
+
+
+    def put(self, *parts, timeout: float = None) -> bool:
+        '''
+        Name:
+            StageQueue.put(*parts= np.ndarray | bytes, timeout= float) -> bool
+        Args:
+            parts: the message, written back to back into one slot
+            timeout: the most seconds a BLOCK queue waits, forever if None
+        Returns:
+            False if the message was dropped, by DROP_NEWEST or the timeout
+        '''
+        data = [np.frombuffer(part, dtype=np.uint8) for part in parts]
+        size = sum(len(part) for part in data)
+        if size > self.slot_size:
+            raise StageQueueError(f"{size} byte message does not fit the {self.slot_size} byte slots of {self.name}")
+
+        head = int(self.__header[HEAD_INDEX])
+        if head - int(self.__header[TAIL_INDEX]) >= self.capacity:
+            if self.policy == DROP_NEWEST or not self.__wait(head, timeout):
+                self.__header[DROPPED_INDEX] += 1
+                return False
+
+        slot = self.__slots[head % self.capacity]
+        offset = 0
+        for part in data:
+            slot[offset:offset + len(part)] = part
+            offset += len(part)
+        self.__lengths[head % self.capacity] = size
+
+        # Publish the message only once it is complete
+        self.__header[HEAD_INDEX] = head + 1
+        depth = head + 1 - int(self.__header[TAIL_INDEX])
+        if depth > self.__header[MAX_DEPTH_INDEX]:
+            self.__header[MAX_DEPTH_INDEX] = depth
+        return True
+
+
+    def end(self, timeout: float = None) -> bool:
+        '''
+        Name:
+            StageQueue.end(timeout= float) -> bool
+        Desc:
+            Queues the empty message that ends the stream. It waits for a
+            free slot whatever the policy, so the consumer always sees it.
+        '''
+        head = int(self.__header[HEAD_INDEX])
+        if head - int(self.__header[TAIL_INDEX]) >= self.capacity and not self.__wait(head, timeout):
+            return False
+        self.__lengths[head % self.capacity] = 0
+        self.__header[HEAD_INDEX] = head + 1
+        return True
+
+
+    def get(self, timeout: float = None) -> np.ndarray:
+        '''
+        Name:
+            StageQueue.get(timeout= float) -> np.ndarray
+        Args:
+            timeout: the most seconds to wait for a message, forever if None
+        Returns:
+            A uint8 view of the next message, empty at the end of the
+            stream, or None on timeout. Releases the previous message.
+        '''
+        self.release()
+        tail = int(self.__header[TAIL_INDEX])
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while int(self.__header[HEAD_INDEX]) == tail:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(STAGE_POLL_INTERVAL)
+
+        self.__held = True
+        slot = tail % self.capacity
+        return self.__slots[slot, :int(self.__lengths[slot])]
+
+
+    def release(self) -> None:
+        '''
+        Name:
+            StageQueue.release() -> None
+        Desc:
+            Hands the slot of the last get() back to the producer
+        '''
+        if self.__held:
+            self.__held = False
+            self.__header[TAIL_INDEX] = int(self.__header[TAIL_INDEX]) + 1
+
+
+    def stats(self) -> dict:
+        '''
+        Name:
+            StageQueue.stats() -> dict
+        Returns:
+            Each of QUEUE_STATS: messages queued now and at most, messages
+            dropped, and seconds put() spent waiting. Readable from either
+            process.
+        '''
+        header = self.__header.tolist()
+        return {
+            'depth': header[HEAD_INDEX] - header[TAIL_INDEX],
+            'max_depth': header[MAX_DEPTH_INDEX],
+            'dropped': header[DROPPED_INDEX],
+            'blocked': header[BLOCKED_INDEX] / 1e6
+        }
+
+
+    def close(self) -> None:
+        del self.__header, self.__lengths, self.__slots
+        self.__mmap.close()
+
+
+    def __wait(self, head: int, timeout: float) -> bool:
+        waited = time.monotonic()
+        deadline = None if timeout is None else waited + timeout
+        free = True
+        while head - int(self.__header[TAIL_INDEX]) >= self.capacity:
+            if deadline is not None and time.monotonic() >= deadline:
+                free = False
+                break
+            time.sleep(STAGE_POLL_INTERVAL)
+        self.__header[BLOCKED_INDEX] += int((time.monotonic() - waited) * 1e6)
+        return free
+
+
+class SharedStatus:
+    '''
+    Name:
+        SharedStatus
+    Desc:
+        A few values one stage reports for another to publish, in anonymous
+        shared memory like StageQueue. Each value is a single aligned
+        store, a reader never sees one torn.
+
+    Public:
+        names: the name of each value
+    '''
+    def __init__(self, names: tuple):
+        self.names = tuple(names)
+
+        self.__index = {name: i for i, name in enumerate(self.names)}
+        self.__mmap = mmap.mmap(-1, 8 * max(1, len(self.names)))
+        self.__values = np.ndarray((len(self.names),), dtype=np.float64, buffer=self.__mmap)
+
+
+    def set(self, values: dict) -> None:
+        for name, value in values.items():
+            self.__values[self.__index[name]] = value
+
+
+    def get(self) -> dict:
+        return dict(zip(self.names, self.__values.tolist()))
+
+
+    def close(self) -> None:
+        del self.__values
+        self.__mmap.close()
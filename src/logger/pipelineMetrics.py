@@ -0,0 +1,345 @@
+'''
+Rolling counters and stage latency histograms for the instrumentation and
+command pipelines.
+
+Each process has one registry, metrics. Code at a stage boundary counts
+events and observes the time since the previous boundary, both taken from
+time.monotonic() so times from different processes on the VC line up:
+
+    metrics.count('commands.written')
+    metrics.observe('command.queue', writing - command.received)
+
+An observation is a histogram bucket increment, cheap enough to leave on
+during a firing. Every metric keeps a total since start and the last
+complete window of METRICS_WINDOW seconds, so a snapshot shows both the
+whole run and what is happening now. A gauge is a level rather than an
+event, such as the LabJack backlog, and keeps its latest and largest value:
+
+    metrics.gauge('acquisition.backlog', status['backlog'])
+
+The registry is served to mission control with the METRICS websocket
+identifier (see Docs/ws-api.md) and locally as text:
+    curl localhost:8081
+'''
+import math
+import time
+import asyncio
+
+# Histogram buckets grow by HISTOGRAM_RATIO from HISTOGRAM_MIN seconds, so
+# percentiles are within 5% at any scale from microseconds to minutes
+HISTOGRAM_MIN = 0.000001
+HISTOGRAM_RATIO = 1.05
+
+# Seconds of each rolling window
+METRICS_WINDOW = 60.0
+
+
+class LatencyHistogram:
+    '''
+    Name:
+        LatencyHistogram
+    Desc:
+        Log scale histogram of latencies. Memory does not grow with the
+        number of samples, so it can run for a whole test day.
+
+    Public:
+        count: number of latencies added
+        max: the largest latency added, in seconds
+    '''
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self.__buckets = {}
+
+
+    def add(self, latency: float) -> None:
+        bucket = max(0, math.ceil(math.log(max(latency, HISTOGRAM_MIN) / HISTOGRAM_MIN, HISTOGRAM_RATIO)))
+        self.__buckets[bucket] = self.__buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, latency)
+
+
+    def percentile(self, percent: float) -> float:
+        '''
+        Name:
+            LatencyHistogram.percentile(percent= float) -> float
+        Args:
+            percent: 0 to 100
+        Returns:
+            The upper edge of the bucket holding the percentile in seconds,
+            never more than max. 0 if nothing was added.
+        '''
+        if not self.count:
+            return 0.0
+
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.__buckets):
+            seen += self.__buckets[bucket]
+            if seen >= rank:
+                return min(HISTOGRAM_MIN * HISTOGRAM_RATIO ** bucket, self.max)
+        return self.max
+
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000
+        }
+
+
+class RollingCounter:
+    '''
+    Name:
+        RollingCounter
+    Desc:
+        Counts events in total and per window
+
+    Public:
+        total: events counted since start
+    '''
+    def __init__(self, window: float = METRICS_WINDOW):
+        self.total = 0
+
+        self.__window = window
+        self.__start = time.monotonic()
+        self.__current = 0
+        self.__last = None
+
+
+    def add(self, count: int = 1) -> None:
+        self.__rotate()
+        self.total += count
+        self.__current += count
+
+
+    def summary(self) -> dict:
+        '''
+        Name:
+            RollingCounter.summary() -> dict
+        Returns:
+            The total and the rate per second over the last complete window,
+            or over the current one before the first window completes
+        '''
+        self.__rotate()
+        if self.__last is not None:
+            rate = self.__last / self.__window
+        else:
+            elapsed = time.monotonic() - self.__start
+            rate = self.__current / elapsed if elapsed else 0.0
+        return {'total': self.total, 'per_s': rate}
+
+
+    def __rotate(self) -> None:
+        now = time.monotonic()
+        if now - self.__start >= self.__window:
+            # A window with no events at all still counts as a window of 0
+            self.__last = self.__current if now - self.__start < 2 * self.__window else 0
+            self.__current = 0
+            self.__start = now
+
+
+class RollingHistogram:
+    '''
+    Name:
+        RollingHistogram
+    Desc:
+        Latency histogram of a stage in total and per window
+    '''
+    def __init__(self, window: float = METRICS_WINDOW):
+        self.total = LatencyHistogram()
+
+        self.__window = window
+        self.__start = time.monotonic()
+        self.__current = LatencyHistogram()
+        self.__last = None
+
+
+    def add(self, latency: float) -> None:
+        self.__rotate()
+        self.total.add(latency)
+        self.__current.add(latency)
+
+
+    def summary(self) -> dict:
+        '''
+        Name:
+            RollingHistogram.summary() -> dict
+        Returns:
+            The total summary, with the summary of the last complete window
+            (or the current one before the first completes) as 'window'
+        '''
+        self.__rotate()
+        summary = self.total.summary()
+        summary['window'] = (self.__current if self.__last is None else self.__last).summary()
+        return summary
+
+
+    def __rotate(self) -> None:
+        now = time.monotonic()
+        if now - self.__start >= self.__window:
+            self.__last = self.__current if now - self.__start < 2 * self.__window else LatencyHistogram()
+            self.__current = LatencyHistogram()
+            self.__start = now
+
+
+class Gauge:
+    '''
+    Name:
+        Gauge
+    Desc:
+        The latest and largest value of a level
+
+    Public:
+        value: the latest value
+        max: the largest value since start
+    '''
+    def __init__(self):
+        self.value = 0.0
+        self.max = 0.0
+
+
+    def set(self, value: float) -> None:
+        self.value = value
+        self.max = max(self.max, value)
+
+
+    def summary(self) -> dict:
+        return {'value': self.value, 'max': self.max}
+
+
+class PipelineMetrics:
+    '''
+    Name:
+        PipelineMetrics
+    Desc:
+        The registry of every counter, gauge and stage histogram in a
+        process.
+        Metrics are created the first time they are used.
+
+    Public:
+        window: seconds of each rolling window
+    '''
+    def __init__(self, window: float = METRICS_WINDOW):
+        self.window = window
+
+        self.__start = time.monotonic()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__stages = {}
+
+
+    def count(self, name: str, count: int = 1) -> None:
+        counter = self.__counters.get(name)
+        if counter is None:
+            counter = self.__counters[name] = RollingCounter(self.window)
+        counter.add(count)
+
+
+    def gauge(self, name: str, value: float) -> None:
+        gauge = self.__gauges.get(name)
+        if gauge is None:
+            gauge = self.__gauges[name] = Gauge()
+        gauge.set(value)
+
+
+    def observe(self, name: str, latency: float) -> None:
+        '''
+        Name:
+            PipelineMetrics.observe(name= str, latency= float) -> None
+        Args:
+            name: the stage, e.g. 'instrumentation.handoff'
+            latency: seconds spent in the stage. NaN, for a boundary that
+                     was not stamped, is ignored.
+        '''
+        if latency != latency:
+            return
+        stage = self.__stages.get(name)
+        if stage is None:
+            stage = self.__stages[name] = RollingHistogram(self.window)
+        stage.add(latency)
+
+
+    def reset(self) -> None:
+        self.__start = time.monotonic()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__stages = {}
+
+
+    def snapshot(self) -> dict:
+        '''
+        Name:
+            PipelineMetrics.snapshot() -> dict
+        Returns:
+            The uptime, window, and the summary of every counter, gauge and
+            stage
+        '''
+        return {
+            'uptime_s': time.monotonic() - self.__start,
+            'window_s': self.window,
+            'counters': {name: counter.summary() for name, counter in sorted(self.__counters.items())},
+            'gauges': {name: gauge.summary() for name, gauge in sorted(self.__gauges.items())},
+            'stages': {name: stage.summary() for name, stage in sorted(self.__stages.items())}
+        }
+
+
+    def text(self) -> str:
+        '''
+        Name:
+            PipelineMetrics.text() -> str
+        Returns:
+            The snapshot as one "name value" line per field, e.g.
+            stages.instrumentation.handoff.window.p99_ms 0.21
+        '''
+        lines = []
+
+        def flatten(prefix, value):
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    flatten(f"{prefix}.{key}" if prefix else key, item)
+            else:
+                lines.append(f"{prefix} {value:.6g}" if isinstance(value, float) else f"{prefix} {value}")
+
+        flatten('', self.snapshot())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = PipelineMetrics()
+
+
+async def serve_metrics(host: str, port: int, registry: PipelineMetrics = metrics) -> asyncio.AbstractServer:
+    '''
+    Name:
+        serve_metrics(host= str, port= int, registry= PipelineMetrics) -> asyncio.AbstractServer
+    Args:
+        host: the interface to listen on, keep this local
+        port: the port to listen on
+        registry: the metrics to serve
+    Returns:
+        The started server
+    Desc:
+        Answers every connection with registry.text() as a plain text HTTP
+        response, so the metrics can be read with curl or a browser
+    '''
+    async def answer(reader, writer):
+        try:
+            # The request is not needed, only wait for it so clients do not
+            # see the connection reset
+            await asyncio.wait_for(reader.readline(), 1)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        body = registry.text().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    return await asyncio.start_server(answer, host, port)
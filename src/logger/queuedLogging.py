@@ -0,0 +1,300 @@
+'''
+Logging that never blocks the event loop.
+
+Records are put on a queue by a QueueHandler and written to disk by a
+background writer thread, so a slow disk or terminal never delays a valve
+command or an instrumentation frame. The writer drains everything queued and
+writes it with one write and one flush per batch.
+
+Records can carry structured fields:
+
+    logger.info("Wrote to serial", extra={'fields': {'command': 'VC,ABORT', 'latency_ms': 0.2}})
+
+Text logs append the fields as JSON. The optional binary format writes each
+record as a fixed header and the raw message and fields, with no formatting
+on the writer thread:
+
+    magic        8 bytes  b'PDPLOG01'
+    record       '<dBHH'  created, level, message length, fields length
+                 message  UTF-8
+                 fields   JSON, empty if none
+
+Run as a script to print a binary log as text:
+    python queuedLogging.py serial.binlog
+'''
+import json
+import time
+import queue
+import struct
+import atexit
+import logging
+import argparse
+import threading
+from logging.handlers import QueueHandler
+
+TEXT_FORMAT = "TEXT"
+BINARY_FORMAT = "BINARY"
+
+BINARY_MAGIC = b'PDPLOG01'
+BINARY_RECORD_FORMAT = '<dBHH'
+
+TEXT_FORMATTER = logging.Formatter('[%(name)s] %(asctime)s [%(levelname)s]: %(message)s')
+
+# The writer waits up to FLUSH_INTERVAL seconds after a record arrives to
+# gather more before writing, and writes at most MAX_BATCH records at once
+FLUSH_INTERVAL = 0.05
+MAX_BATCH = 1024
+
+# Records below WARNING allowed per second per subsystem, and the burst
+# allowed above that rate. Warnings and errors are never rate limited.
+DEFAULT_RATE = 200
+DEFAULT_BURST = 1000
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Name:
+        RateLimitFilter
+    Desc:
+        Token bucket limit on the records of one subsystem, so a flood of
+        debug or info records can not fill the queue. The number of records
+        dropped is added to the fields of the next record let through.
+
+    Public:
+        rate: records per second
+        burst: the most records let through at once
+        suppressed: records dropped since the last one let through
+    '''
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.suppressed = 0
+
+        self.__tokens = burst
+        self.__last = time.monotonic()
+
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+        if self.__tokens < 1:
+            self.suppressed += 1
+            return False
+
+        self.__tokens -= 1
+        if self.suppressed:
+            record.fields = dict(getattr(record, 'fields', None) or {}, suppressed=self.suppressed)
+            self.suppressed = 0
+        return True
+
+
+class RecordQueueHandler(QueueHandler):
+    '''
+    Name:
+        RecordQueueHandler
+    Desc:
+        Puts records on the writer's queue. Only the message arguments are
+        merged on the calling thread, all formatting is left to the writer.
+    '''
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogWriter(threading.Thread):
+    '''
+    Name:
+        LogWriter
+    Desc:
+        The background thread that owns a log file. Records are written in
+        batches, one write and one flush per batch.
+
+    Public:
+        queue: the queue records are put on
+        log_format: TEXT_FORMAT or BINARY_FORMAT
+        written: number of records written
+    '''
+    def __init__(self, path: str, log_format: str = TEXT_FORMAT):
+        if log_format not in (TEXT_FORMAT, BINARY_FORMAT):
+            raise ValueError(f"Unknown log format: {log_format}")
+
+        super().__init__(name=f"LogWriter({path})", daemon=True)
+        self.queue = queue.SimpleQueue()
+        self.log_format = log_format
+        self.written = 0
+
+        self.__file = open(path, 'wb')
+        if log_format == BINARY_FORMAT:
+            self.__file.write(BINARY_MAGIC)
+        self.__encode = self.__encode_binary if log_format == BINARY_FORMAT else self.__encode_text
+
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < MAX_BATCH and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                batch.pop()
+                stopping = True
+
+            try:
+                self.__file.write(b''.join(map(self.__encode, batch)))
+                self.__file.flush()
+                self.written += len(batch)
+            except OSError:
+                # Nowhere left to report a logging failure, drop the batch
+                pass
+
+        self.__file.close()
+
+
+    def stop(self) -> None:
+        '''
+        Name:
+            LogWriter.stop() -> None
+        Desc:
+            Writes every record already queued, then closes the file
+        '''
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+
+    def __encode_text(self, record: logging.LogRecord) -> bytes:
+        text = TEXT_FORMATTER.format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + json.dumps(fields, default=str)
+        return (text + '\n').encode(errors='replace')
+
+
+    def __encode_binary(self, record: logging.LogRecord) -> bytes:
+        message = record.msg + '\n' + record.exc_text if record.exc_text else record.msg
+        message = message.encode(errors='replace')[:0xFFFF]
+        fields = getattr(record, 'fields', None)
+        fields = json.dumps(fields, default=str).encode()[:0xFFFF] if fields else b''
+        header = struct.pack(BINARY_RECORD_FORMAT, record.created, record.levelno, len(message), len(fields))
+        return header + message + fields
+
+
+def configure_log(
+    name: str,
+    path: str,
+    level: int = logging.INFO,
+    log_format: str = TEXT_FORMAT,
+    rate: float = DEFAULT_RATE,
+    burst: int = DEFAULT_BURST
+) -> logging.Logger:
+    '''
+    Name:
+        configure_log(name= str, path= str, level= int, log_format= str, rate= float, burst= int) -> logging.Logger
+    Args:
+        name: the subsystem, used as the logger name
+        path: the log file, truncated when its writer starts
+        level: the lowest level logged
+        log_format: TEXT_FORMAT or BINARY_FORMAT
+        rate: records below WARNING allowed per second, None for no limit
+        burst: records allowed at once above the rate
+    Returns:
+        The subsystem's logger. Logging on it only puts the record on a
+        queue, the file is written by a background thread.
+    Desc:
+        Loggers configured with the same path share one writer thread
+    '''
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = LogWriter(path, log_format)
+            writer.start()
+            _writers[path] = writer
+
+    handler = RecordQueueHandler(writer.queue)
+    if rate is not None:
+        handler.addFilter(RateLimitFilter(rate, burst))
+
+    logger = logging.getLogger(name)
+    for old in [h for h in logger.handlers if isinstance(h, RecordQueueHandler)]:
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+@atexit.register
+def shutdown() -> None:
+    '''
+    Name:
+        shutdown() -> None
+    Desc:
+        Writes out every queued record. Runs at exit.
+    '''
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.stop()
+
+
+def read_binary_log(path: str):
+    '''
+    Name:
+        read_binary_log(path= str) -> generator
+    Args:
+        path: a log written with BINARY_FORMAT
+    Returns:
+        A dict of created, levelname, message and fields for each record. A
+        record cut short by a crash ends the log.
+    '''
+    header_size = struct.calcsize(BINARY_RECORD_FORMAT)
+    with open(path, 'rb') as file:
+        if file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a binary log")
+
+        while True:
+            header = file.read(header_size)
+            if len(header) < header_size:
+                return
+            created, level, message_length, fields_length = struct.unpack(BINARY_RECORD_FORMAT, header)
+            body = file.read(message_length + fields_length)
+            if len(body) < message_length + fields_length:
+                return
+            yield {
+                'created': created,
+                'levelname': logging.getLevelName(level),
+                'message': body[:message_length].decode(errors='replace'),
+                'fields': json.loads(body[message_length:]) if fields_length else None
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print a binary log as text")
+    parser.add_argument('log')
+    args = parser.parse_args()
+
+    for entry in read_binary_log(args.log):
+        line = f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['created']))} [{entry['levelname']}]: {entry['message']}"
+        if entry['fields']:
+            line += ' ' + json.dumps(entry['fields'])
+        print(line)
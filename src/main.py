@@ -1,6 +1,35 @@
 from server.wss import WebSocketServer
 from serialInterface.serialInterface import SerialInterface
+from serialInterface.commandScheduler import CommandScheduler
 import asyncio
+import signal
+import json
+import time
+
+def dump_latency(serial: SerialInterface, scheduler: CommandScheduler) -> str:
+    '''
+    Name:
+        dump_latency(serial= SerialInterface, scheduler= CommandScheduler) -> str
+    Args:
+        serial: the serial interface
+        scheduler: the serial command scheduler
+    Returns:
+        The path of the dump
+    Desc:
+        Writes the command round trip latencies and scheduling latencies to
+        a timestamped JSON file, for comparing actuators between test days.
+        Triggered with: kill -USR1 <pid of main.py>
+    '''
+    path = time.strftime('latency-%Y%m%d-%H%M%S.json')
+    with open(path, 'w') as file:
+        json.dump({
+            'time': time.time(),
+            'round_trip': serial.latency_stats(),
+            'scheduling': scheduler.latency_stats()
+        }, file, indent=4)
+    print(f"Latency dumped to {path}")
+    return path
+
 
 def main() -> None:
     '''
@@ -12,8 +41,8 @@ def main() -> None:
     serial = None
     wss = None
     
-    serial_feedback_queue = asyncio.LifoQueue()
-    serial_command_queue = asyncio.LifoQueue()
+    serial_feedback_queue = asyncio.Queue()
+    serial_command_scheduler = CommandScheduler(serial_feedback_queue)
 
     try:
         serial = SerialInterface()
@@ -29,15 +58,24 @@ def main() -> None:
 
     event_loop = asyncio.get_event_loop() 
 
+    # Latencies are available to mission control as {"identifier": "STATUS"}
+    # and locally with SIGUSR1
+    wss.register_status("round_trip", serial.latency_stats)
+    wss.register_status("scheduling", serial_command_scheduler.latency_stats)
+    if hasattr(signal, "SIGUSR1"):
+        event_loop.add_signal_handler(
+            signal.SIGUSR1, dump_latency, serial, serial_command_scheduler)
+
     # WebSocket server task
     event_loop.create_task(wss.start_serial())
     
     # Serial sending and receiving tasks
     event_loop.create_task(serial.receive_loop(serial_feedback_queue))
-    event_loop.create_task(serial.send_async(serial_command_queue))
+    event_loop.create_task(serial.send_async(serial_command_scheduler))
+    event_loop.create_task(serial.watch_confirmations(serial_feedback_queue))
     
     event_loop.create_task(wss.serial_feedback_wss_handler(serial_feedback_queue))
-    event_loop.create_task(wss.wss_reception_handler(serial_command_queue))
+    event_loop.create_task(wss.wss_reception_handler(serial_command_scheduler))
     
     try:
         event_loop.run_forever()
@@ -0,0 +1,215 @@
+'''
+A simulated valve control Arduino on a Linux pseudo terminal.
+
+The simulator speaks the protocol in Docs/serial-api.md on the secondary
+side of a pty, so SerialInterface can open it like the real /dev/ttyACM0.
+Valve commands take actuation_delay seconds to complete, and a SUMMARY of
+every valve is sent each summary_interval seconds and whenever a valve
+finishes moving. Line noise and dropped bytes can be injected to exercise
+the framing and the unconfirmed command deadline.
+
+Run from src/ to point the VC at it by hand:
+    python -m serialInterface.arduinoSimulator --delay 0.5 --summary 1
+'''
+import os
+import tty
+import time
+import random
+import select
+import argparse
+import threading
+from .serialCommandTypes import Valves, DataTypes, DataValues, SOURCE_TAG
+from .serialFraming import SerialFramer, parse_message
+
+DEFAULT_ACTUATION_DELAY = 0.5
+DEFAULT_SUMMARY_INTERVAL = 1.0
+
+# The valves in a SUMMARY, in the order controlsFirmaware/Controls.ino sends
+# them. IGPRIME is commanded but never reported.
+SUMMARY_VALVES = (Valves.N2OF.value, Valves.N2OV.value, Valves.N2F.value, Valves.RTV.value,
+                  Valves.ERV.value, Valves.MEV.value, Valves.NCV.value)
+SILENT_VALVES = (Valves.IGPRIME.value,)
+
+# Where ABORT moves each valve, as in Controls.ino. N2OV and ERV open to vent.
+ABORT_STATE = {valve: DataValues.CLOSE.value for valve in SUMMARY_VALVES}
+ABORT_STATE[Valves.N2OV.value] = DataValues.OPEN.value
+ABORT_STATE[Valves.ERV.value] = DataValues.OPEN.value
+
+# Longest the simulation waits for a command before checking if it should stop
+POLL_INTERVAL = 0.05
+
+
+class ArduinoSimulator:
+    '''
+    Name:
+        ArduinoSimulator
+    Desc:
+        Simulated valve control Arduino. start() opens the pty and runs the
+        simulation on a background thread.
+
+        Behaves as controlsFirmaware/Controls.ino. CTRL commands move a
+        valve to the commanded state after actuation_delay. ABORT moves the
+        valves to ABORT_STATE and answers STATUS,ABORTED, as does every
+        other message until UNABORT. CONNECT and SUMMARY are answered with a
+        SUMMARY of the valves in SUMMARY_VALVES.
+
+    Public:
+        port: the path to open with SerialInterface, set by start()
+        actuation_delay: seconds a valve takes to move
+        summary_interval: seconds between periodic SUMMARY messages, 0 for
+                          only when a valve finishes moving
+        noise_rate: chance of a garbage line before each message
+        drop_rate: chance of dropping each byte sent
+        valve_state: the state of each valve
+        aborted: True between ABORT and UNABORT
+        received: every line received, in order
+    '''
+    def __init__(
+        self,
+        actuation_delay: float = DEFAULT_ACTUATION_DELAY,
+        summary_interval: float = DEFAULT_SUMMARY_INTERVAL,
+        noise_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        seed: int = None
+    ):
+        self.port = None
+        self.actuation_delay = actuation_delay
+        self.summary_interval = summary_interval
+        self.noise_rate = noise_rate
+        self.drop_rate = drop_rate
+        self.valve_state = {valve: DataValues.CLOSE.value for valve in SUMMARY_VALVES}
+        self.aborted = False
+        self.received = []
+
+        self.__random = random.Random(seed)
+        self.__moves = []
+        self.__primary = None
+        self.__secondary = None
+        self.__thread = None
+        self.__stop = threading.Event()
+
+
+    def start(self) -> str:
+        '''
+        Name:
+            ArduinoSimulator.start() -> str
+        Returns:
+            The path of the pty to open
+        '''
+        self.__primary, self.__secondary = os.openpty()
+        # Raw mode, so the pty does not echo or translate line endings
+        tty.setraw(self.__secondary)
+        self.port = os.ttyname(self.__secondary)
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name="ArduinoSimulator", daemon=True)
+        self.__thread.start()
+        return self.port
+
+
+    def stop(self) -> None:
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        os.close(self.__primary)
+        os.close(self.__secondary)
+
+
+    def send(self, line: str) -> None:
+        '''
+        Name:
+            ArduinoSimulator.send(line= str) -> None
+        Args:
+            line: a message without its line ending
+        Desc:
+            Sends a message to the VC, with noise and dropped bytes applied
+        '''
+        data = line.encode() + b'\r\n'
+        if self.noise_rate and self.__random.random() < self.noise_rate:
+            data = bytes(self.__random.randrange(33, 127) for _ in range(8)) + b'\r\n' + data
+        if self.drop_rate:
+            data = bytes(byte for byte in data if self.__random.random() >= self.drop_rate)
+        os.write(self.__primary, data)
+
+
+    def send_summary(self) -> None:
+        fields = ','.join(f"{valve},{state}" for valve, state in self.valve_state.items())
+        self.send(f"{SOURCE_TAG},{DataTypes.SUMMARY.value},{fields}")
+
+
+    def __run(self) -> None:
+        framer = SerialFramer()
+        next_summary = time.monotonic() + self.summary_interval
+
+        while not self.__stop.is_set():
+            deadlines = [move[0] for move in self.__moves]
+            if self.summary_interval:
+                deadlines.append(next_summary)
+            timeout = min([deadline - time.monotonic() for deadline in deadlines] + [POLL_INTERVAL])
+
+            readable, _, _ = select.select([self.__primary], [], [], max(timeout, 0))
+            if readable:
+                for line in framer.feed(os.read(self.__primary, 4096)):
+                    self.__handle(line)
+
+            now = time.monotonic()
+            finished = [move for move in self.__moves if move[0] <= now]
+            if finished:
+                self.__moves = [move for move in self.__moves if move[0] > now]
+                for _, valve, state in finished:
+                    self.valve_state[valve] = state
+                self.send_summary()
+
+            if self.summary_interval and now >= next_summary:
+                self.send_summary()
+                next_summary = now + self.summary_interval
+
+
+    def __handle(self, line: bytes) -> None:
+        self.received.append(line)
+        message = parse_message(line)
+
+        if message.data_type is DataTypes.UNABORT and self.aborted:
+            self.aborted = False
+            self.send(f"{SOURCE_TAG},{DataTypes.STATUS.value},CANCELLED ABORT")
+        elif message.data_type is DataTypes.ABORT or self.aborted:
+            self.aborted = True
+            self.send(f"{SOURCE_TAG},{DataTypes.STATUS.value},ABORTED")
+            self.__moves = []
+            for valve, state in ABORT_STATE.items():
+                self.__move(valve, state)
+        elif message.data_type is DataTypes.CTRL and len(message.fields) >= 2:
+            valve, state = (field.decode(errors='replace') for field in message.fields[:2])
+            if valve in self.valve_state:
+                self.__moves = [move for move in self.__moves if move[1] != valve]
+                self.__move(valve, state)
+            elif valve not in SILENT_VALVES:
+                self.send(f"{SOURCE_TAG},ERROR,UNKOWNVALVE")
+        elif message.data_type is DataTypes.CONNECT:
+            self.send(f"{SOURCE_TAG},{DataTypes.STATUS.value},ESTABLISH")
+            self.send_summary()
+        elif message.data_type is DataTypes.SUMMARY:
+            self.send_summary()
+        else:
+            self.send(f"{SOURCE_TAG},ERROR,UNKNOWNCOMMAND,{line.decode(errors='replace')}")
+
+
+    def __move(self, valve: str, state: str) -> None:
+        self.__moves.append((time.monotonic() + self.actuation_delay, valve, state))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated valve control Arduino on a pty")
+    parser.add_argument('--delay', type=float, default=DEFAULT_ACTUATION_DELAY, help="actuation delay in seconds")
+    parser.add_argument('--summary', type=float, default=DEFAULT_SUMMARY_INTERVAL, help="seconds between SUMMARY messages")
+    parser.add_argument('--noise', type=float, default=0.0, help="chance of a garbage line before each message")
+    parser.add_argument('--drop', type=float, default=0.0, help="chance of dropping each byte")
+    args = parser.parse_args()
+
+    simulator = ArduinoSimulator(args.delay, args.summary, args.noise, args.drop)
+    print(f"Simulated Arduino on {simulator.start()}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
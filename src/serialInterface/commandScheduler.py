@@ -0,0 +1,222 @@
+import json
+import time
+import asyncio
+from collections import deque
+from .serialCommandTypes import DataTypes, Valves, DataValues
+from logger.pipelineMetrics import metrics
+
+__name__ = "CommandScheduler"
+
+# Commands that jump ahead of every queued valve command
+PRIORITY_COMMANDS = (DataTypes.ABORT.value, DataTypes.UNABORT.value)
+
+# What a valve command can name
+VALVES = tuple(valve.value for valve in Valves)
+ACTIONS = tuple(action.value for action in DataValues)
+
+# Reported to mission control when a command is not written
+COALESCED = "COALESCED"     # replaced by a newer command for the same valve
+SUPPRESSED = "SUPPRESSED"   # the valve is already in the requested state
+ABORTED = "ABORTED"         # dropped from the queue by an ABORT
+
+
+class ScheduledCommand:
+    '''
+    Name:
+        ScheduledCommand
+    Desc:
+        A command from mission control waiting to be written to the serial
+        port, stamped with time.monotonic() at each stage boundary
+
+    Public:
+        message: the decoded JSON command
+        command: the command type, e.g. CTRL or ABORT
+        priority: True if the command is in the priority lane
+        received: when the command arrived from mission control
+        enqueued: when the command was queued
+        written: when the command was written to the serial port, None
+                 until then
+    '''
+    __slots__ = ('message', 'command', 'priority', 'received', 'enqueued', 'written')
+
+    def __init__(self, message: dict, priority: bool, received: float = None):
+        self.message = message
+        self.command = message.get('command')
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.received = self.enqueued if received is None else received
+        self.written = None
+
+
+class CommandScheduler:
+    '''
+    Name:
+        CommandScheduler
+    Desc:
+        Orders the commands from mission control for the serial port. Valve
+        commands are written first in, first out. ABORT and UNABORT skip
+        ahead of anything queued, so a safety command never waits behind
+        stale valve commands. An ABORT also drops every queued valve
+        command, nothing queued before it is written after it.
+
+        Only the latest intent for each valve is kept. A valve command put
+        while an older one for the same valve is still queued replaces it in
+        place, so it keeps the older command's position and the stepper
+        motors never run to a state that was already taken back.
+
+        The send loop awaits get(), which wakes the moment a command is
+        queued, instead of polling. The time from put() to the write is
+        recorded for every command type.
+
+        Commands that are coalesced, aborted, or suppressed by the send loop,
+        are reported on the reports queue in the same form as valve feedback.
+
+    Public:
+        pending: the number of commands waiting to be written
+        reports: the queue COALESCED, ABORTED and SUPPRESSED reports are
+                 put on
+    '''
+    def __init__(self, reports: asyncio.Queue = None):
+        self.reports = reports
+
+        self.__priority = deque()
+        self.__queue = deque()
+        self.__by_valve = {}
+        self.__ready = asyncio.Event()
+        self.__latency = {}
+
+
+    @property
+    def pending(self) -> int:
+        return len(self.__priority) + len(self.__queue)
+
+
+    def put(self, message, received: float = None) -> ScheduledCommand:
+        '''
+        Name:
+            CommandScheduler.put(message= str | dict, received= float) -> ScheduledCommand
+        Args:
+            message: the JSON command from mission control
+            received: time.monotonic() when the command arrived, now if None
+        Returns:
+            The queued command
+        Desc:
+            Queues a command without blocking. Commands without a valve are
+            aborts (see SerialInterface.send_async) and go in the priority
+            lane. A queued command for the same valve is replaced and
+            reported as COALESCED. An ABORT drops every queued valve
+            command and reports each as ABORTED. Raises ValueError if the message is not a
+            JSON command, or is a valve command without a known valve and
+            action, so nothing invalid reaches the send loop.
+        '''
+        if isinstance(message, (str, bytes)):
+            message = json.loads(message)
+        if not isinstance(message, dict) or 'command' not in message:
+            raise ValueError(f"Not a command: {message}")
+
+        priority = message['command'] in PRIORITY_COMMANDS or 'valve' not in message
+        if not priority:
+            if message['valve'] not in VALVES:
+                raise ValueError(f"Unknown valve: {message['valve']}")
+            if message.get('action') not in ACTIONS:
+                raise ValueError(f"Unknown action for {message['valve']}: {message.get('action')}")
+
+        if not priority and message['valve'] in self.__by_valve:
+            queued = self.__by_valve[message['valve']]
+            self.report(COALESCED, queued.message)
+            queued.message = message
+            queued.command = message['command']
+            queued.received = time.monotonic() if received is None else received
+            return queued
+
+        if message['command'] == DataTypes.ABORT.value:
+            while self.__queue:
+                self.report(ABORTED, self.__queue.popleft().message)
+            self.__by_valve.clear()
+
+        command = ScheduledCommand(message, priority, received)
+        if priority:
+            self.__priority.append(command)
+        else:
+            self.__queue.append(command)
+            self.__by_valve[message['valve']] = command
+        self.__ready.set()
+        return command
+
+
+    async def get(self) -> ScheduledCommand:
+        '''
+        Name:
+            CommandScheduler.get() -> ScheduledCommand
+        Returns:
+            The next command to write, priority commands first
+        Desc:
+            Waits until a command is queued
+        '''
+        while not self.pending:
+            self.__ready.clear()
+            await self.__ready.wait()
+
+        if self.__priority:
+            return self.__priority.popleft()
+
+        command = self.__queue.popleft()
+        del self.__by_valve[command.message['valve']]
+        return command
+
+
+    def report(self, status: str, message: dict) -> None:
+        '''
+        Name:
+            CommandScheduler.report(status= str, message= dict) -> None
+        Args:
+            status: COALESCED, ABORTED or SUPPRESSED
+            message: the command that was not written
+        Desc:
+            Tells mission control a valve command was not written
+        '''
+        metrics.count(f"commands.{status.lower()}")
+        if self.reports is not None:
+            self.reports.put_nowait({
+                'identifier': 'CONTROLS',
+                'command': status,
+                'valve': message.get('valve'),
+                'action': message.get('action')
+            })
+
+
+    def record_write(self, command: ScheduledCommand) -> float:
+        '''
+        Name:
+            CommandScheduler.record_write(command= ScheduledCommand) -> float
+        Args:
+            command: the command that was just written
+        Returns:
+            The time in seconds from put() to the write
+        '''
+        command.written = time.monotonic()
+        latency = command.written - command.enqueued
+
+        stats = self.__latency.setdefault(command.command, {
+            'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        stats['count'] += 1
+        stats['total'] += latency
+        stats['max'] = max(stats['max'], latency)
+        stats['last'] = latency
+        return latency
+
+
+    def latency_stats(self) -> dict:
+        '''
+        Name:
+            CommandScheduler.latency_stats() -> dict
+        Returns:
+            For each command type, the number written and the last, mean and
+            worst time from put() to the write in milliseconds
+        '''
+        return {command: {
+            'count': stats['count'],
+            'last_ms': stats['last'] * 1000,
+            'mean_ms': stats['total'] / stats['count'] * 1000,
+            'max_ms': stats['max'] * 1000
+        } for command, stats in self.__latency.items()}
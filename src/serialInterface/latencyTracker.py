@@ -0,0 +1,136 @@
+import time
+import asyncio
+from logger.pipelineMetrics import LatencyHistogram
+
+__name__ = "LatencyTracker"
+
+# Seconds a valve has to confirm a command in a SUMMARY before it is
+# reported as unconfirmed
+DEFAULT_DEADLINE = 10.0
+
+
+class LatencyTracker:
+    '''
+    Name:
+        LatencyTracker
+    Desc:
+        Matches each valve command written to the VC with the SUMMARY that
+        confirms it and keeps a latency histogram per valve. Times come
+        from time.monotonic() so clock changes do not skew them.
+
+        Only the newest command of each valve is tracked. A command
+        replaced by another for the same valve before it is confirmed is
+        counted as superseded. A command that is not confirmed within the
+        deadline is counted as unconfirmed and returned by expired().
+        wait() sleeps until the next deadline, or until sent() starts one.
+
+    Public:
+        deadline: seconds a command has to be confirmed
+    '''
+    def __init__(self, deadline: float = DEFAULT_DEADLINE):
+        self.deadline = deadline
+
+        self.__pending = {}
+        self.__histograms = {}
+        self.__unconfirmed = {}
+        self.__superseded = {}
+        self.__sent = asyncio.Event()
+
+
+    def sent(self, valve: str, action: str) -> None:
+        '''
+        Name:
+            LatencyTracker.sent(valve= str, action= str) -> None
+        Args:
+            valve: the valve the command was written for
+            action: the state commanded
+        '''
+        if valve in self.__pending:
+            self.__superseded[valve] = self.__superseded.get(valve, 0) + 1
+        self.__pending[valve] = (action, time.monotonic())
+        self.__sent.set()
+
+
+    def confirm(self, valve_state: dict) -> dict:
+        '''
+        Name:
+            LatencyTracker.confirm(valve_state= dict) -> dict
+        Args:
+            valve_state: the valve states after a SUMMARY
+        Returns:
+            valve -> latency in seconds of every command this SUMMARY confirmed
+        '''
+        now = time.monotonic()
+        confirmed = {}
+        for valve, (action, sent) in list(self.__pending.items()):
+            if valve_state.get(valve) == action:
+                del self.__pending[valve]
+                confirmed[valve] = now - sent
+                self.__histograms.setdefault(valve, LatencyHistogram()).add(now - sent)
+        return confirmed
+
+
+    def expired(self) -> list:
+        '''
+        Name:
+            LatencyTracker.expired() -> list
+        Returns:
+            (valve, action) of every command that passed the deadline
+            since the last call. They are no longer tracked.
+        '''
+        now = time.monotonic()
+        expired = []
+        for valve, (action, sent) in list(self.__pending.items()):
+            if now - sent > self.deadline:
+                del self.__pending[valve]
+                self.__unconfirmed[valve] = self.__unconfirmed.get(valve, 0) + 1
+                expired.append((valve, action))
+        return expired
+
+
+    def next_deadline(self) -> float:
+        '''
+        Name:
+            LatencyTracker.next_deadline() -> float
+        Returns:
+            Seconds until the oldest pending command passes the deadline,
+            None if nothing is pending
+        '''
+        if not self.__pending:
+            return None
+        oldest = min(sent for _, sent in self.__pending.values())
+        return max(0.0, oldest + self.deadline - time.monotonic())
+
+
+    async def wait(self) -> None:
+        '''
+        Name:
+            LatencyTracker.wait() -> None
+        Desc:
+            Waits until the oldest pending command passes the deadline. With
+            nothing pending, waits for the next sent() instead.
+        '''
+        self.__sent.clear()
+        try:
+            await asyncio.wait_for(self.__sent.wait(), self.next_deadline())
+        except asyncio.TimeoutError:
+            pass
+
+
+    def stats(self) -> dict:
+        '''
+        Name:
+            LatencyTracker.stats() -> dict
+        Returns:
+            For each valve the confirmed command count, p50/p95/p99 and max
+            latency in milliseconds, and the unconfirmed, superseded and
+            pending commands
+        '''
+        valves = set(self.__histograms) | set(self.__unconfirmed) | set(self.__superseded) | set(self.__pending)
+        stats = {}
+        for valve in sorted(valves):
+            stats[valve] = self.__histograms.get(valve, LatencyHistogram()).summary()
+            stats[valve]['unconfirmed'] = self.__unconfirmed.get(valve, 0)
+            stats[valve]['superseded'] = self.__superseded.get(valve, 0)
+            stats[valve]['pending'] = valve in self.__pending
+        return {'deadline_ms': self.deadline * 1000, 'valves': stats}
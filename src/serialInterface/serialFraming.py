@@ -0,0 +1,129 @@
+from .serialCommandTypes import Valves, DataTypes, DataValues
+
+__name__ = "SerialFraming"
+
+# Longest line kept while waiting for its newline. Anything longer is line
+# noise and is thrown away rather than growing the buffer forever.
+MAX_LINE_LENGTH = 1024
+
+# Lookup tables from the raw bytes of each field, built once so parsing a
+# line is a split and a few dict lookups
+DATA_TYPES = {data_type.value.encode(): data_type for data_type in DataTypes}
+DATA_VALUES = {value.value.encode(): value.value for value in DataValues}
+VALVES = {valve.value.encode(): valve.value for valve in Valves}
+
+
+class SerialFramer:
+    '''
+    Name:
+        SerialFramer
+    Desc:
+        Splits the raw bytes read from the serial port into lines. Reads can
+        end anywhere, so the bytes after the last newline are kept and
+        completed by the next feed().
+
+    Public:
+        discarded: number of bytes thrown away from lines over MAX_LINE_LENGTH
+    '''
+    def __init__(self):
+        self.discarded = 0
+        self.__buffer = bytearray()
+
+
+    def feed(self, data: bytes) -> list:
+        '''
+        Name:
+            SerialFramer.feed(data= bytes) -> list
+        Args:
+            data: bytes read from the serial port
+        Returns:
+            Every line completed by these bytes, without the line ending
+        '''
+        self.__buffer += data
+        if b'\n' not in data:
+            self.__check_length()
+            return []
+
+        *lines, rest = self.__buffer.split(b'\n')
+        self.__buffer = bytearray(rest)
+        self.__check_length()
+        return [bytes(line.rstrip(b'\r')) for line in lines if line.strip()]
+
+
+    def __check_length(self) -> None:
+        if len(self.__buffer) > MAX_LINE_LENGTH:
+            self.discarded += len(self.__buffer)
+            self.__buffer.clear()
+
+
+class SerialMessage:
+    '''
+    Name:
+        SerialMessage
+    Desc:
+        One parsed line of the serial protocol, see Docs/serial-api.md
+
+    Public:
+        raw: the line as received
+        source: the source tag, e.g. 'VC'
+        data_type: the DataTypes member, None if not recognised
+        fields: the raw fields after the data type
+    '''
+    __slots__ = ('raw', 'source', 'data_type', 'fields')
+
+    def __init__(self, raw: bytes, source: str, data_type: DataTypes, fields: list):
+        self.raw = raw
+        self.source = source
+        self.data_type = data_type
+        self.fields = fields
+
+
+def parse_message(line: bytes) -> SerialMessage:
+    '''
+    Name:
+        parse_message(line= bytes) -> SerialMessage
+    Args:
+        line: a line from SerialFramer.feed()
+    Returns:
+        The parsed message. data_type is None for lines that are not in the
+        protocol.
+    '''
+    fields = line.split(b',')
+    if fields and not fields[-1]:
+        fields.pop()
+
+    source = fields[0].decode(errors='replace') if fields else ''
+    data_type = DATA_TYPES.get(fields[1]) if len(fields) > 1 else None
+    return SerialMessage(line, source, data_type, fields[2:])
+
+
+def diff_summary(message: SerialMessage, valve_state: dict) -> tuple:
+    '''
+    Name:
+        diff_summary(message= SerialMessage, valve_state= dict) -> (dict, list)
+    Args:
+        message: a SUMMARY message of valve, state pairs
+        valve_state: valve -> state, updated in place
+    Returns:
+        Every valve whose state changed mapped to its new state, and the
+        fields that are not a known valve
+    Desc:
+        Walks the whole SUMMARY once so every change is reported together
+    '''
+    changes = {}
+    unknown = []
+    fields = message.fields
+
+    for label, value in zip(fields[0::2], fields[1::2]):
+        valve = VALVES.get(label)
+        if valve is None:
+            unknown.append(f"{label.decode(errors='replace')}={value.decode(errors='replace')}")
+            continue
+        state = DATA_VALUES.get(value) or value.decode(errors='replace')
+        if valve_state.get(valve) != state:
+            valve_state[valve] = state
+            changes[valve] = state
+
+    if len(fields) % 2:
+        unknown.append(fields[-1].decode(errors='replace'))
+    return changes, unknown
@@ -1,17 +1,29 @@
 # reference https://github.com/UVicRocketry/Hybrid-Controls-System/blob/33-comms-prot-fixing/src/MCC_GUI/comm.py
 import serial
-import logging
 from enum import Enum
 from .serialCommandTypes import Valves, DataTypes, DataLabels, DataValues, SOURCE_TAG
+from .commandScheduler import CommandScheduler, SUPPRESSED
+from .serialFraming import SerialFramer, parse_message, diff_summary
+from .latencyTracker import LatencyTracker
+from logger.queuedLogging import configure_log, TEXT_FORMAT
+from logger.pipelineMetrics import metrics
 import platform
 import asyncio
+import threading
 import json
+import time
 
 
 __name__ = "SerialInterface"
 
 OS = platform.system()
 
+# Format of serial.log, BINARY_FORMAT for a compact log (see logger/queuedLogging.py)
+LOG_FORMAT = TEXT_FORMAT
+
+# Longest the reader thread blocks in read() before checking if it should stop
+READ_TIMEOUT = 0.1
+
 class ResponseCommandType(Enum):
     SUMMARY = "SUMMARY"
     START_UP = "STARTUP"
@@ -31,6 +43,7 @@ class SerialInterface:
         The serial interface for the VC to communicate with the controls arduino
 
     Attributes:
+        port: the serial port to open, the VC mini PC's Arduino port if None
 
     Public:
         message_queue: the queue for messages
@@ -48,19 +61,29 @@ class SerialInterface:
         build_valve_message: builds a message
         __process_command: processes a command
     """
-    def __init__(self):
+    def __init__(self, port: str = None):
 
-        self.__logger = logging.getLogger(__name__)
-        self.__log_handler = None
+        self.__logger = None
         self.__configure_log()
 
         # lists all possible com ports
-        self.__port = None 
+        self.__port = port
         self.stream = None
         self.__init_stream()
 
         self._connected = False
 
+        self.__reader = None
+        self.__stop_reading = threading.Event()
+
+        # The last action written for each valve, and whether a SUMMARY has
+        # confirmed __valve_state yet. Until then it is only a guess.
+        self.__valve_commanded = {}
+        self.__valve_state_known = False
+
+        # Round trip time from writing a valve command to the SUMMARY that confirms it
+        self.__latency = LatencyTracker()
+
         self.__valve_state = {
             'N2OF': 'CLOSE',
             'N2OV': 'CLOSE',
@@ -79,13 +102,10 @@ class SerialInterface:
         Name:
             SerialInterface.configureLog() -> None
         Desc:
-            Configures the log file
+            Configures the log file. Records are written by a background
+            thread so logging never blocks the event loop.
         '''
-        self.__log_handler = logging.FileHandler('serial.log', mode='w')
-        formatter = logging.Formatter('[%(name)s] %(asctime)s [%(levelname)s]: %(message)s')
-        self.__log_handler.setFormatter(formatter)
-        self.__logger.addHandler(self.__log_handler)
-        self.__logger.setLevel(logging.INFO)
+        self.__logger = configure_log(__name__, 'serial.log', log_format=LOG_FORMAT)
         self.__logger.info("Serial Logger configured")
 
 
@@ -94,12 +114,15 @@ class SerialInterface:
         Name:
             SerialInterface._initstream() -> None
         Desc:
-            Initializes the serial port and sets the connection status
+            Initializes the serial port and sets the connection status. Opens
+            the port given to the constructor if any, e.g. the pty of an
+            ArduinoSimulator.
         '''
         try:
-            print("OS: ", OS)
-            self.__port = 'COM6' if str(OS) == 'Windows' else '/dev/ttyACM0' # update this to the correct port for the VC mini PC
-            self.stream = serial.Serial(port=self.__port, baudrate=115200, timeout=0.1)
+            self.__logger.info(f"OS: {OS}")
+            if self.__port is None:
+                self.__port = 'COM6' if str(OS) == 'Windows' else '/dev/ttyACM0' # update this to the correct port for the VC mini PC
+            self.stream = serial.Serial(port=self.__port, baudrate=115200, timeout=READ_TIMEOUT)
             self.__logger.info(f"Opened serial port: {self.__port}")
         except Exception as e:
             self.__logger.error(f"failed to open serial: {e}")
@@ -135,6 +158,9 @@ class SerialInterface:
             True if the port was closed successfully, False otherwise
         '''
         try: 
+            self.__stop_reading.set()
+            if self.__reader is not None:
+                self.__reader.join()
             self.stream.close()
             self._connected = False
             return True
@@ -189,50 +215,187 @@ class SerialInterface:
     
         return message
     
-    async def receive_loop(self, queue: asyncio.LifoQueue):
+    async def receive_loop(self, queue: asyncio.Queue):
         '''
         Name:
-            SerialInterface.receive_loop() -> None
+            SerialInterface.receive_loop(queue= asyncio.Queue) -> None
+        Args:
+            queue: the queue processed feedback is put on for the websocket
         Desc:
-            The main loop for receiving messages
+            The main loop for receiving messages. Reading the port blocks, so
+            a reader thread waits on it and hands each complete line to this
+            loop as soon as it arrives. Nothing blocks the event loop and
+            feedback is not held back by a polling interval.
+
+            Feedback carries the time.monotonic() its line was read as
+            'stages': {'read': ...}, for the websocket's METRICS. It is
+            removed before the feedback is sent.
         '''
+        lines = asyncio.Queue()
+        self.__stop_reading.clear()
+        self.__reader = threading.Thread(
+            target=self.__read_lines,
+            args=(asyncio.get_running_loop(), lines),
+            name="SerialReader",
+            daemon=True)
+        self.__reader.start()
+
         while True:
-            if self.message_pending:
-                message = self.receive()
-                print(f"[Serial] Received message: {message}")
-                if message:
-                    processed_message = self.__process_serial_feedback(message)
-                    print(f"[Serial] Processed Serial message: {processed_message}")
-                    await queue.put(processed_message)
-                queue.task_done()
+            read, line = await lines.get()
+            metrics.count('serial.lines')
+            metrics.observe('serial.dispatch', time.monotonic() - read)
+            feedback = self.__process_serial_feedback(line)
+            if feedback is not None:
+                feedback['stages'] = {'read': read}
+                await queue.put(feedback)
+
+
+    def __read_lines(self, loop: asyncio.AbstractEventLoop, lines: asyncio.Queue):
+        '''
+        Name:
+            SerialInterface.__read_lines(loop= asyncio.AbstractEventLoop, lines= asyncio.Queue) -> None
+        Args:
+            loop: the event loop running receive_loop()
+            lines: the queue receive_loop() waits on
+        Desc:
+            Runs on the reader thread. read() returns as soon as a byte
+            arrives, or after READ_TIMEOUT so close() can stop the thread.
+            The framer holds on to a line split across reads so it is never
+            handed on half received.
+        '''
+        framer = SerialFramer()
+        while not self.__stop_reading.is_set():
+            try:
+                data = self.stream.read(self.stream.in_waiting or 1)
+            except serial.SerialException as e:
+                self.__logger.error(f"Serial read failed: {e}")
+                return
+
+            read = time.monotonic()
+            for line in framer.feed(data):
+                self.__logger.info("VC Raw message received", extra={'fields': {'line': line.decode(errors='replace')}})
+                try:
+                    loop.call_soon_threadsafe(lines.put_nowait, (read, line))
+                except RuntimeError:
+                    # The event loop has been closed
+                    return
+
+
+    async def send_async(self, scheduler: CommandScheduler):
+        '''
+        Name:
+            SerialInterface.send_async(scheduler= CommandScheduler) -> None
+        Args:
+            scheduler: the scheduler mission control commands are put on
+        Desc:
+            The main loop for sending messages. Wakes as soon as a command is
+            scheduled and records how long it waited. Valve commands for the
+            state the valve is already in are not written and are reported
+            back as SUPPRESSED.
+        '''
+        while True:
+            scheduled = await scheduler.get()
+            try:
+                self.__write_scheduled(scheduler, scheduled)
+            except (KeyError, TypeError, ValueError) as e:
+                # One malformed command must never stop the loop, the next
+                # one may be an ABORT
+                self.__logger.error(f"Dropped invalid command {scheduled.message}: {e}")
+                metrics.count('commands.invalid')
+
+
+    def __write_scheduled(self, scheduler: CommandScheduler, scheduled) -> None:
+        '''
+        Name:
+            SerialInterface.__write_scheduled(scheduler= CommandScheduler, scheduled= ScheduledCommand) -> None
+        Desc:
+            Writes one scheduled command, or reports it as SUPPRESSED
+        '''
+        message_object = scheduled.message
+        if "valve" in message_object and self.__in_state(message_object['valve'], message_object['action']):
+            scheduler.report(SUPPRESSED, message_object)
+            self.__logger.info("Suppressed command", extra={'fields': {
+                'valve': message_object['valve'],
+                'action': message_object['action']}})
+            return
+
+        if "valve" in message_object:
+            command = self.build_valve_message(
+                message_object['command'],
+                message_object['valve'],
+                message_object['action'])
+        elif message_object['command'] == DataTypes.UNABORT.value:
+            command = f"{SOURCE_TAG},{DataTypes.UNABORT.value}\n"
+        else:
+            command = f"{SOURCE_TAG},{DataTypes.ABORT.value}\n"
 
-            await asyncio.sleep(0.1)
+        writing = time.monotonic()
+        if not self.__send(command):
+            self.__logger.error(f"Failed to write to serial: {command.strip()}")
+            metrics.count('commands.failed')
+            return
+        if "valve" in message_object:
+            self.__valve_commanded[message_object['valve']] = message_object['action']
+            self.__latency.sent(message_object['valve'], message_object['action'])
 
-    async def send_async(self, queue: asyncio.LifoQueue):
+        latency = scheduler.record_write(scheduled)
+        metrics.count('commands.written')
+        metrics.observe('command.queue', writing - scheduled.received)
+        metrics.observe('serial.write', scheduled.written - writing)
+        self.__logger.info("Wrote to serial", extra={'fields': {
+            'command': command.strip(),
+            'latency_ms': latency * 1000}})
+
+
+    async def watch_confirmations(self, queue: asyncio.Queue):
         '''
         Name:
-            SerialInterface.send_async() -> None
+            SerialInterface.watch_confirmations(queue= asyncio.Queue) -> None
+        Args:
+            queue: the feedback queue for the websocket
         Desc:
-            The main loop for sending messages
+            Reports every valve command that no SUMMARY confirmed within the
+            latency tracker's deadline as UNCONFIRMED. Sleeps until the next
+            deadline, or until a command is written, rather than polling.
         '''
         while True:
-            if not queue.empty():
-                message = await queue.get()
-                print(f"\n[Serial] Sending message: {message}\n")
-                message_object = json.loads(message)
-                command = ""
-                if "command" in message_object:
-                    if "valve" in message_object: 
-                        command = self.build_valve_message(
-                            message_object['command'], 
-                            message_object['valve'], 
-                            message_object['action'])
-                    else:
-                        command = "VC,ABORT\n"
-                    self.__logger.info(f"Writing to serial: {command}")
-                    self.stream.write(command.encode())
-                queue.task_done()
-            await asyncio.sleep(0.1)
+            await self.__latency.wait()
+
+            for valve, action in self.__latency.expired():
+                self.__logger.warning("Unconfirmed command", extra={'fields': {'valve': valve, 'action': action}})
+                await queue.put({
+                    'identifier': 'CONTROLS',
+                    'command': 'UNCONFIRMED',
+                    'valve': valve,
+                    'action': action
+                })
+
+
+    def latency_stats(self) -> dict:
+        '''
+        Name:
+            SerialInterface.latency_stats() -> dict
+        Returns:
+            The per valve command round trip latencies, see LatencyTracker.stats()
+        '''
+        return self.__latency.stats()
+
+
+    def __in_state(self, valve: str, action: str) -> bool:
+        '''
+        Name:
+            SerialInterface.__in_state(valve= str, action= str) -> bool
+        Args:
+            valve: the valve of a command
+            action: the action of a command
+        Returns:
+            True if the last SUMMARY reported the valve in this state and no
+            different command has been written to it since. Always False
+            before the first SUMMARY, when the state is not known.
+        '''
+        return (self.__valve_state_known
+                and self.__valve_state.get(valve) == action
+                and self.__valve_commanded.get(valve, action) == action)
 
 
     def build_valve_message(self, data_type, data_label, data_value, source_tag=SOURCE_TAG) -> str:
@@ -253,33 +416,41 @@ class SerialInterface:
         return f"VC,{data_type},{data_label},{data_value}\n"
 
 
-    def __process_serial_feedback(self, message):
+    def __process_serial_feedback(self, line: bytes) -> dict:
         '''
         Name:
-            SerialInterface.__process_command(message= str) -> None
+            SerialInterface.__process_serial_feedback(line= bytes) -> dict
         Args:
-            message: the message to process
+            line: a line from the VC without its line ending
+        Returns:
+            One FEEDBACK event with every valve the SUMMARY changed, or None
+            if nothing changed or the line is not a SUMMARY
         Desc:
-            Processes a message from the MCC
-        '''
-        is_message_processed = False
-        feedback = None
-        message
-        message_array = message.strip('\r\n').split(',')
-        print(f'message array {message_array}')
-        if message_array[1] == "SUMMARY":
-            for i in range(2, len(message_array), 2):
-                current_valve = message_array[i]
-                current_action = message_array[i + 1]
-                if self.__valve_state[current_valve] != current_action:
-                    self.__valve_state[current_valve] = current_action
-                    feedback = {
-                        'identifier': 'CONTROLS',
-                        'command': 'FEEDBACK',
-                        'valve': current_valve,
-                        'action': current_action   
-                    }
-                    return feedback
-                    self.__logger.info(f"Feedback: {valve} is {action}")
-                is_message_processed = True
-            return "No Change"
+            Processes a message from the VC
+        '''
+        message = parse_message(line)
+        if message.data_type is not DataTypes.SUMMARY:
+            if message.data_type is None:
+                self.__logger.warning(f"Unknown serial message: {line!r}")
+            return None
+
+        self.__valve_state_known = True
+        changes, unknown = diff_summary(message, self.__valve_state)
+        if unknown:
+            self.__logger.warning(f"Unknown valves in SUMMARY: {unknown}")
+
+        confirmed = self.__latency.confirm(self.__valve_state)
+        for latency in confirmed.values():
+            metrics.observe('command.confirm', latency)
+        if confirmed:
+            self.__logger.info("Confirmed", extra={'fields': {
+                valve: latency * 1000 for valve, latency in confirmed.items()}})
+        if not changes:
+            return None
+
+        self.__logger.info("Feedback", extra={'fields': changes})
+        return {
+            'identifier': 'CONTROLS',
+            'command': 'FEEDBACK',
+            'valves': changes
+        }
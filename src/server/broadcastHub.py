@@ -0,0 +1,417 @@
+import time
+import asyncio
+import websockets
+from collections import deque
+from server.frameEncoder import InstrumentationFrame, EnvelopeFrame
+from server.decimation import MinMaxDecimator
+from logger.pipelineMetrics import metrics
+
+__name__ = "BroadcastHub"
+
+# What to do with a new frame when a client's send queue is full
+DROP_OLDEST = "DROP_OLDEST"   # discard the oldest queued frame
+LATEST      = "LATEST"        # discard everything queued, keep only the newest
+DISCONNECT  = "DISCONNECT"    # close the connection, the client can reconnect
+
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, LATEST, DISCONNECT)
+
+DEFAULT_QUEUE_SIZE = 256
+
+# Close code sent to a client disconnected by the DISCONNECT policy (Try Again Later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class Subscriber:
+    '''
+    Name:
+        Subscriber
+    Desc:
+        One connected client of the hub. Frames are queued without awaiting
+        and a dedicated send loop drains the queue, so a slow client only
+        ever delays itself.
+
+        With batching enabled, samples are held until batch_size of them are
+        queued or the oldest has waited batch_interval seconds, then sent as
+        a single batch message. batch_size bounds the per message overhead
+        and batch_interval bounds the added latency.
+
+        Control messages (schemas, replies to requests) are sent ahead of
+        any queued frames and are never dropped.
+
+        A client that disconnects while a message is being sent ends the
+        send loop, takes no more frames and is passed to on_closed, which
+        the hub uses to unsubscribe it.
+
+    Public:
+        websocket: the client connection
+        queue_size: the most frames queued before the policy applies
+        policy: one of SLOW_CONSUMER_POLICIES
+        binary: send packed binary frames instead of JSON text
+        batch_size: the most samples in one message, 1 disables batching
+        batch_interval: the longest a sample waits for its batch in seconds
+        display_rate: envelope buckets per second, 0 for every sample
+        dropped: number of samples discarded for this client
+        messages_sent: number of websocket messages sent to this client
+        samples_sent: number of samples sent to this client
+    '''
+    def __init__(self, websocket, queue_size: int, policy: str, on_closed=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+        self.websocket = websocket
+        self.queue_size = queue_size
+        self.policy = policy
+        self.binary = False
+        self.batch_size = 1
+        self.batch_interval = 0
+        self.display_rate = 0
+        self.dropped = 0
+        self.messages_sent = 0
+        self.samples_sent = 0
+
+        self.__queue = deque()
+        self.__control = deque()
+        self.__ready = asyncio.Event()
+        self.__too_slow = False
+        self.__closed = False
+        self.__on_closed = on_closed
+        self.__oldest_sent = None
+
+        self.__stats_time = time.monotonic()
+        self.__stats_messages = 0
+        self.__stats_samples = 0
+
+
+    @property
+    def depth(self) -> int:
+        return len(self.__queue)
+
+
+    @property
+    def control_depth(self) -> int:
+        return len(self.__control)
+
+
+    @property
+    def batching(self) -> bool:
+        return self.batch_size > 1 or self.batch_interval > 0
+
+
+    def configure_batching(self, batch_size: int, batch_interval: float) -> None:
+        '''
+        Name:
+            Subscriber.configure_batching(batch_size= int, batch_interval= float) -> None
+        Args:
+            batch_size: the most samples in one message, 1 disables batching
+            batch_interval: the longest a sample waits for its batch in seconds
+        Desc:
+            The send queue is grown to hold at least two batches so the slow
+            consumer policy does not trigger on every batch
+        '''
+        if batch_size < 1 or batch_interval < 0:
+            raise ValueError("batch_size must be at least 1 and batch_interval at least 0")
+
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue_size = max(self.queue_size, 2 * batch_size)
+        self.__ready.set()
+
+
+    def send_control(self, message) -> None:
+        '''
+        Name:
+            Subscriber.send_control(message= str | bytes) -> None
+        Args:
+            message: the message to send
+        Desc:
+            Queues a message ahead of the frames. Changing the format or
+            batching and then queuing the new SCHEMA without awaiting in
+            between guarantees the client gets the schema before the first
+            message in the new layout. Dropped once the client has
+            disconnected.
+        '''
+        if self.__closed:
+            return
+        self.__control.append(message)
+        self.__ready.set()
+
+
+    def stats(self) -> dict:
+        '''
+        Name:
+            Subscriber.stats() -> dict
+        Returns:
+            Totals for this client and the messages/s and samples/s achieved
+            since the previous call to stats()
+        '''
+        now = time.monotonic()
+        elapsed = max(now - self.__stats_time, 1e-9)
+        stats = {
+            "messages_sent": self.messages_sent,
+            "samples_sent": self.samples_sent,
+            "dropped": self.dropped,
+            "queue_depth": len(self.__queue),
+            "messages_per_second": (self.messages_sent - self.__stats_messages) / elapsed,
+            "samples_per_second": (self.samples_sent - self.__stats_samples) / elapsed,
+            "batch_size": self.batch_size,
+            "batch_interval": self.batch_interval * 1000,
+            "display_rate": self.display_rate,
+            "policy": self.policy,
+            "binary": self.binary
+        }
+        self.__stats_time = now
+        self.__stats_messages = self.messages_sent
+        self.__stats_samples = self.samples_sent
+        return stats
+
+
+    def offer(self, frame) -> bool:
+        '''
+        Name:
+            Subscriber.offer(frame= InstrumentationFrame) -> bool
+        Args:
+            frame: the frame to send, shared with every other subscriber
+        Returns:
+            False if the client was too slow and is being disconnected
+        Desc:
+            Queues a frame without blocking, applying the slow consumer
+            policy when the queue is full
+        '''
+        if self.__too_slow or self.__closed:
+            return False
+
+        if len(self.__queue) >= self.queue_size:
+            if self.policy == DISCONNECT:
+                self.__too_slow = True
+                self.__ready.set()
+                return False
+            elif self.policy == LATEST:
+                self.dropped += len(self.__queue)
+                self.__queue.clear()
+            else:
+                self.__queue.popleft()
+                self.dropped += 1
+
+        self.__queue.append(frame)
+        self.__ready.set()
+        return True
+
+
+    async def run(self) -> None:
+        '''
+        Name:
+            Subscriber.run() -> None
+        Desc:
+            Sends queued frames until the client disconnects or is
+            disconnected for being too slow
+        '''
+        try:
+            await self.__send_loop()
+        except websockets.ConnectionClosed:
+            self.__closed = True
+            self.__queue.clear()
+            self.__control.clear()
+            if self.__on_closed is not None:
+                self.__on_closed(self)
+
+
+    async def __send_loop(self) -> None:
+        while True:
+            await self.__ready.wait()
+            self.__ready.clear()
+
+            if self.batching:
+                await self.__wait_for_batch()
+
+            if self.__too_slow:
+                await self.websocket.close(SLOW_CONSUMER_CLOSE_CODE, "Client too slow")
+                return
+
+            while self.__control or self.__queue:
+                if self.__control:
+                    await self.websocket.send(self.__control.popleft())
+                elif not self.batching:
+                    await self.__send_frame(self.__queue.popleft())
+                elif len(self.__queue) >= self.batch_size or self.__batch_due:
+                    await self.__send_batch()
+                else:
+                    # Partial batch, go back to waiting out its interval
+                    self.__ready.set()
+                    break
+
+            # One observation per wake up rather than per frame keeps the
+            # metrics cheap at full rate
+            if self.__oldest_sent is not None:
+                metrics.observe('instrumentation.send', time.monotonic() - self.__oldest_sent.published)
+                self.__oldest_sent = None
+
+
+    @property
+    def __batch_due(self) -> bool:
+        return time.monotonic() >= self.__queue[0].published + self.batch_interval
+
+
+    async def __wait_for_batch(self) -> None:
+        '''
+        Name:
+            Subscriber.__wait_for_batch() -> None
+        Desc:
+            Waits until a full batch is queued or the oldest queued sample
+            has waited batch_interval
+        '''
+        while self.__queue and len(self.__queue) < self.batch_size and not (self.__too_slow or self.__control):
+            remaining = self.__queue[0].published + self.batch_interval - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.__ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+            self.__ready.clear()
+
+
+    async def __send_frame(self, frame) -> None:
+        if self.binary:
+            await self.websocket.send(frame.binary, text=False)
+        else:
+            await self.websocket.send(frame.json, text=True)
+        self.messages_sent += 1
+        self.samples_sent += 1
+        if self.__oldest_sent is None:
+            self.__oldest_sent = frame
+
+
+    async def __send_batch(self) -> None:
+        frames = [self.__queue.popleft() for _ in range(min(self.batch_size, len(self.__queue)))]
+
+        encoder = frames[0].encoder
+        if self.binary:
+            await self.websocket.send(encoder.encode_batch_binary(frames), text=False)
+        else:
+            await self.websocket.send(encoder.encode_batch(frames), text=True)
+        self.messages_sent += 1
+        self.samples_sent += len(frames)
+        if self.__oldest_sent is None:
+            self.__oldest_sent = frames[0]
+
+
+class BroadcastHub:
+    '''
+    Name:
+        BroadcastHub
+    Desc:
+        Publish/subscribe hub for the instrumentation stream. A single
+        producer publishes each sample once and the hub hands the same
+        InstrumentationFrame to every subscriber's queue, so each wire format
+        is encoded at most once per sample.
+
+        Subscribers with a display rate are sent min/max envelopes instead.
+        There is one decimator per display rate in use, shared by every
+        subscriber at that rate.
+
+    Public:
+        queue_size: the default queue size of new subscribers
+        policy: the default slow consumer policy of new subscribers
+        subscribers: the connected subscribers
+    '''
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE, policy: str = DROP_OLDEST):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+        self.queue_size = queue_size
+        self.policy = policy
+        self.subscribers = set()
+
+        self.__decimators = {}
+
+
+    def subscribe(self, websocket, queue_size: int = None, policy: str = None) -> Subscriber:
+        '''
+        Name:
+            BroadcastHub.subscribe(websocket= websockets.ServerConnection, queue_size= int, policy= str) -> Subscriber
+        Args:
+            websocket: the client connection
+            queue_size: overrides the hub's default queue size
+            policy: overrides the hub's default slow consumer policy
+        Returns:
+            The new subscriber. Await Subscriber.run() to start sending.
+        '''
+        subscriber = Subscriber(
+            websocket,
+            queue_size or self.queue_size,
+            policy or self.policy,
+            self.unsubscribe)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+
+
+    def reset(self) -> None:
+        '''
+        Name:
+            BroadcastHub.reset() -> None
+        Desc:
+            Forgets the envelope buckets in progress, for a new stream that
+            may have other channels
+        '''
+        self.__decimators.clear()
+
+
+    def publish_records(self, encoder, sequences, records) -> None:
+        '''
+        Name:
+            BroadcastHub.publish_records(encoder= InstrumentationFrameEncoder, sequences= np.ndarray, records= np.ndarray) -> None
+        Args:
+            encoder: the encoder for the channel schema of the records
+            sequences: the sequence number of each record
+            records: rows of [timestamp, *values] from the ring buffer
+        Desc:
+            Publishes every record to full rate subscribers and the
+            envelope of the buckets they complete to the others
+        '''
+        full_rate = []
+        by_rate = {}
+        for subscriber in self.subscribers:
+            if subscriber.display_rate:
+                by_rate.setdefault(subscriber.display_rate, []).append(subscriber)
+            else:
+                full_rate.append(subscriber)
+
+        if full_rate and len(records):
+            for sequence, record in zip(sequences.tolist(), records.tolist()):
+                self.publish(InstrumentationFrame(encoder, sequence, record[0], record[1:]), full_rate)
+
+        for rate in list(self.__decimators):
+            if rate not in by_rate:
+                del self.__decimators[rate]
+
+        for rate, subscribers in by_rate.items():
+            if rate not in self.__decimators:
+                self.__decimators[rate] = MinMaxDecimator(rate)
+            timestamps, mins, maxs = self.__decimators[rate].update(records[:, 0], records[:, 1:])
+            if len(timestamps):
+                self.publish(EnvelopeFrame(encoder, timestamps, mins, maxs), subscribers)
+
+
+    def publish(self, frame, subscribers: list = None) -> None:
+        '''
+        Name:
+            BroadcastHub.publish(frame= InstrumentationFrame | EnvelopeFrame, subscribers= list) -> None
+        Args:
+            frame: the frame to send
+            subscribers: who to send it to, every subscriber if None
+        Desc:
+            Stamps the frame with the time it was published, which batching
+            clients use to bound how long it waits. Never awaits, so a slow
+            client can not stall the producer.
+            Subscribers that are too slow under the DISCONNECT policy are
+            removed and closed by their own send loop, subscribers whose
+            client has disconnected are removed.
+        '''
+        frame.published = time.monotonic()
+        for subscriber in list(self.subscribers if subscribers is None else subscribers):
+            if not subscriber.offer(frame):
+                self.unsubscribe(subscriber)
@@ -0,0 +1,75 @@
+import numpy as np
+
+__name__ = "Decimation"
+
+
+class MinMaxDecimator:
+    '''
+    Name:
+        MinMaxDecimator
+    Desc:
+        Streaming min/max envelope of every channel for live display. Time
+        is split into buckets of 1/rate seconds and each completed bucket is
+        reduced to the minimum and maximum of every channel, so a pressure
+        spike shorter than a display pixel still shows up in the plot.
+
+        Samples are fed a packet (or ring buffer read) at a time and each
+        update is a handful of vectorized reduceat calls no matter how many
+        samples or channels it holds. The bucket that is still filling is
+        carried over to the next update. NaN samples are ignored.
+
+    Public:
+        rate: buckets per second
+    '''
+    def __init__(self, rate: float):
+        if rate <= 0:
+            raise ValueError("Display rate must be positive")
+
+        self.rate = rate
+
+        self.__bucket = None
+        self.__min = None
+        self.__max = None
+
+
+    def update(self, timestamps: np.ndarray, values: np.ndarray) -> tuple:
+        '''
+        Name:
+            MinMaxDecimator.update(timestamps= np.ndarray, values= np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray)
+        Args:
+            timestamps: increasing sample times in seconds, one per row of values
+            values: samples x channels array
+        Returns:
+            The start time, per channel minimum and per channel maximum of
+            every bucket completed by these samples. All three are empty if
+            no bucket was completed.
+        '''
+        if len(timestamps) == 0:
+            return self.__empty(values.shape[1])
+
+        buckets = np.floor(np.asarray(timestamps) * self.rate).astype(np.int64)
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+
+        ids = buckets[starts]
+        mins = np.fmin.reduceat(values, starts, axis=0)
+        maxs = np.fmax.reduceat(values, starts, axis=0)
+
+        # Fold in the bucket carried over from the previous update
+        if self.__bucket is not None:
+            if ids[0] == self.__bucket:
+                mins[0] = np.fmin(mins[0], self.__min)
+                maxs[0] = np.fmax(maxs[0], self.__max)
+            else:
+                ids = np.concatenate(([self.__bucket], ids))
+                mins = np.vstack((self.__min, mins))
+                maxs = np.vstack((self.__max, maxs))
+
+        self.__bucket = ids[-1]
+        self.__min = mins[-1]
+        self.__max = maxs[-1]
+
+        return ids[:-1] / self.rate, mins[:-1], maxs[:-1]
+
+
+    def __empty(self, num_channels: int) -> tuple:
+        return np.empty(0), np.empty((0, num_channels)), np.empty((0, num_channels))
@@ -0,0 +1,277 @@
+import math
+import json
+import struct
+import numpy as np
+
+__name__ = "FrameEncoder"
+
+JSON_FORMAT = "JSON"
+BINARY_FORMAT = "BINARY"
+
+# Binary frames are a little endian sequence number and timestamp followed
+# by one float32 per channel in the order given by the SCHEMA message
+BINARY_HEADER_FORMAT = "<Qd"
+
+# Binary batches are a little endian sample count followed by column arrays:
+# uint64 sequence numbers, float64 timestamps, then float32 values for each
+# channel in turn
+BINARY_BATCH_HEADER_FORMAT = "<I"
+
+# Binary envelopes are a little endian bucket count followed by float64
+# bucket start times, then float32 minimums for each channel in turn and
+# float32 maximums for each channel in turn
+BINARY_ENVELOPE_HEADER_FORMAT = "<I"
+
+
+def finite_or_null(values: list) -> list:
+    '''
+    Name:
+        finite_or_null(values= list) -> list
+    Args:
+        values: Python floats
+    Returns:
+        The values with NaN and infinity replaced by None. json.dumps writes
+        those as NaN and Infinity, which JSON.parse rejects, None is null.
+    '''
+    if all(map(math.isfinite, values)):
+        return values
+    return [value if math.isfinite(value) else None for value in values]
+
+
+class InstrumentationFrameEncoder:
+    '''
+    Name:
+        InstrumentationFrameEncoder
+    Desc:
+        Encodes instrumentation samples to the frames sent to ground
+        support. The channel names never change while the server runs, so
+        everything except the values is rendered once into a template and
+        each sample only formats its floats into it. The JSON output is
+        identical to json.dumps of the same message, except that NaN and
+        infinity are sent as null in every JSON message.
+
+        Clients that negotiate the binary format are sent a SCHEMA message
+        once and then packed frames of BINARY_HEADER_FORMAT followed by a
+        float32 per channel.
+
+        Clients that batch samples get one message per batch with every
+        field as a column array, in either format. Clients with a display
+        rate get min/max envelopes laid out the same way.
+
+    Public:
+        channels: the channel names, in record order
+        units: the unit of each channel
+    '''
+    def __init__(self, channels: list, units: list = None):
+        self.channels = list(channels)
+        self.units = list(units) if units is not None else [''] * len(self.channels)
+
+        self.__binary = struct.Struct(BINARY_HEADER_FORMAT + 'f' * len(self.channels))
+
+        fields = ', '.join(f'{json.dumps(channel).replace("%", "%%")}: %s' for channel in self.channels)
+        self.__template = '{"identifier": "INSTRUMENTATION", "data": {' + fields + '}}'
+
+
+    def encode(self, values: list) -> bytes:
+        '''
+        Name:
+            InstrumentationFrameEncoder.encode(values= list) -> bytes
+        Args:
+            values: one Python float per channel
+        Returns:
+            The UTF-8 encoded frame, ready to send as a text message
+        Desc:
+            NaN and infinity are not valid JSON, e.g. a thermocouple out of
+            range, samples that contain them are formatted as null
+        '''
+        if all(map(math.isfinite, values)):
+            text = self.__template % tuple(map(float.__repr__, values))
+        else:
+            text = self.__template % tuple(map(json.dumps, finite_or_null(values)))
+        return text.encode()
+
+
+    def encode_binary(self, sequence: int, timestamp: float, values: list) -> bytes:
+        '''
+        Name:
+            InstrumentationFrameEncoder.encode_binary(sequence= int, timestamp= float, values= list) -> bytes
+        Args:
+            sequence: the sample number, gaps mean samples were dropped
+            timestamp: the time of the sample
+            values: one float per channel
+        Returns:
+            The packed frame, ready to send as a binary message
+        '''
+        return self.__binary.pack(sequence, timestamp, *values)
+
+
+    def encode_batch(self, frames: list) -> bytes:
+        '''
+        Name:
+            InstrumentationFrameEncoder.encode_batch(frames= list) -> bytes
+        Args:
+            frames: the InstrumentationFrames in the batch
+        Returns:
+            The JSON INSTRUMENTATION_BATCH message with column arrays
+        '''
+        columns = zip(*(frame.values for frame in frames))
+        return json.dumps({
+            "identifier": "INSTRUMENTATION_BATCH",
+            "sequence": [frame.sequence for frame in frames],
+            "timestamp": [frame.timestamp for frame in frames],
+            "data": dict(zip(self.channels, (finite_or_null(list(column)) for column in columns)))
+        }).encode()
+
+
+    def encode_batch_binary(self, frames: list) -> bytes:
+        '''
+        Name:
+            InstrumentationFrameEncoder.encode_batch_binary(frames= list) -> bytes
+        Args:
+            frames: the InstrumentationFrames in the batch
+        Returns:
+            The packed batch, see BINARY_BATCH_HEADER_FORMAT
+        '''
+        return b''.join((
+            struct.pack(BINARY_BATCH_HEADER_FORMAT, len(frames)),
+            np.array([frame.sequence for frame in frames], dtype='<u8').tobytes(),
+            np.array([frame.timestamp for frame in frames], dtype='<f8').tobytes(),
+            np.array([frame.values for frame in frames], dtype='<f4').T.tobytes()))
+
+
+    def encode_envelope(self, timestamps: np.ndarray, mins: np.ndarray, maxs: np.ndarray) -> bytes:
+        '''
+        Name:
+            InstrumentationFrameEncoder.encode_envelope(timestamps= np.ndarray, mins= np.ndarray, maxs= np.ndarray) -> bytes
+        Args:
+            timestamps: start time of each bucket
+            mins: buckets x channels array of minimums
+            maxs: buckets x channels array of maximums
+        Returns:
+            The JSON INSTRUMENTATION_ENVELOPE message with column arrays
+        '''
+        return json.dumps({
+            "identifier": "INSTRUMENTATION_ENVELOPE",
+            "timestamp": timestamps.tolist(),
+            "min": dict(zip(self.channels, map(finite_or_null, mins.T.tolist()))),
+            "max": dict(zip(self.channels, map(finite_or_null, maxs.T.tolist())))
+        }).encode()
+
+
+    def encode_envelope_binary(self, timestamps: np.ndarray, mins: np.ndarray, maxs: np.ndarray) -> bytes:
+        '''
+        Name:
+            InstrumentationFrameEncoder.encode_envelope_binary(timestamps= np.ndarray, mins= np.ndarray, maxs= np.ndarray) -> bytes
+        Args:
+            timestamps: start time of each bucket
+            mins: buckets x channels array of minimums
+            maxs: buckets x channels array of maximums
+        Returns:
+            The packed envelope, see BINARY_ENVELOPE_HEADER_FORMAT
+        '''
+        return b''.join((
+            struct.pack(BINARY_ENVELOPE_HEADER_FORMAT, len(timestamps)),
+            timestamps.astype('<f8').tobytes(),
+            mins.astype('<f4').T.tobytes(),
+            maxs.astype('<f4').T.tobytes()))
+
+
+    def schema(self, batched: bool = False, envelope: bool = False) -> str:
+        '''
+        Name:
+            InstrumentationFrameEncoder.schema(batched= bool, envelope= bool) -> str
+        Args:
+            batched: describe batches rather than single frames
+            envelope: describe min/max envelopes rather than samples
+        Returns:
+            The SCHEMA message describing the layout of binary messages
+        '''
+        schema = {
+            "identifier": "SCHEMA",
+            "format": BINARY_FORMAT,
+            "batched": batched,
+            "envelope": envelope,
+            "fields": ["sequence", "timestamp"] + self.channels,
+            "types": ["uint64", "float64"] + ["float32"] * len(self.channels),
+            "units": ["", "s"] + self.units
+        }
+        if envelope:
+            schema["struct"] = BINARY_ENVELOPE_HEADER_FORMAT
+            schema["size"] = struct.calcsize(BINARY_ENVELOPE_HEADER_FORMAT)
+        elif batched:
+            schema["struct"] = BINARY_BATCH_HEADER_FORMAT
+            schema["size"] = struct.calcsize(BINARY_BATCH_HEADER_FORMAT)
+        else:
+            schema["struct"] = self.__binary.format
+            schema["size"] = self.__binary.size
+        return json.dumps(schema)
+
+
+class InstrumentationFrame:
+    '''
+    Name:
+        InstrumentationFrame
+    Desc:
+        One sample published through the hub. Each wire format is encoded
+        the first time a client needs it and then shared by every other
+        client using that format.
+    '''
+    __slots__ = ('encoder', 'sequence', 'timestamp', 'values', 'published', '_json', '_binary')
+
+    def __init__(self, encoder: InstrumentationFrameEncoder, sequence: int, timestamp: float, values: list):
+        self.encoder = encoder
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.values = values
+        self.published = 0
+        self._json = None
+        self._binary = None
+
+
+    @property
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = self.encoder.encode(self.values)
+        return self._json
+
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = self.encoder.encode_binary(self.sequence, self.timestamp, self.values)
+        return self._binary
+
+
+class EnvelopeFrame:
+    '''
+    Name:
+        EnvelopeFrame
+    Desc:
+        The min/max envelope of the buckets completed by one read of the
+        ring buffer. Shared by every client with the same display rate and
+        encoded at most once per wire format.
+    '''
+    __slots__ = ('encoder', 'timestamps', 'mins', 'maxs', 'published', '_json', '_binary')
+
+    def __init__(self, encoder: InstrumentationFrameEncoder, timestamps: np.ndarray, mins: np.ndarray, maxs: np.ndarray):
+        self.encoder = encoder
+        self.timestamps = timestamps
+        self.mins = mins
+        self.maxs = maxs
+        self.published = 0
+        self._json = None
+        self._binary = None
+
+
+    @property
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = self.encoder.encode_envelope(self.timestamps, self.mins, self.maxs)
+        return self._json
+
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = self.encoder.encode_envelope_binary(self.timestamps, self.mins, self.maxs)
+        return self._binary
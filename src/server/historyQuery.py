@@ -0,0 +1,171 @@
+import json
+import math
+import struct
+import numpy as np
+from instrumentation.archive import ArchiveReader, ArchiveError
+from server.frameEncoder import finite_or_null
+
+__name__ = "HistoryQuery"
+
+# Most points in one HISTORY message. Encoding a JSON message holds the GIL,
+# keep it short next to the live stream.
+HISTORY_MESSAGE_POINTS = 1000
+HISTORY_BINARY_MESSAGE_POINTS = 20000
+
+# Point count in front of a binary HISTORY message
+BINARY_HISTORY_HEADER_FORMAT = '<I'
+
+
+class HistoryArchive:
+    '''
+    Name:
+        HistoryArchive
+    Desc:
+        The archive every HISTORY query reads, kept open between queries.
+        While read_labjack.py is writing it each query only indexes the
+        chunks written since the last one, rather than walking the whole
+        firing again. A new firing replaces the archive, queries still
+        reading the previous one keep their reader.
+
+    Public:
+        path: the archive file
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.__reader = None
+
+
+    def reader(self) -> ArchiveReader:
+        '''
+        Name:
+            HistoryArchive.reader() -> ArchiveReader
+        Returns:
+            The reader of the archive at path, with its index up to date
+        '''
+        if self.__reader is not None and self.__reader.replaced():
+            self.__reader = None
+        try:
+            if self.__reader is None:
+                self.__reader = ArchiveReader(self.path)
+            else:
+                self.__reader.refresh()
+        except (OSError, ArchiveError) as e:
+            raise ValueError(f"No archive to answer from: {e}")
+        return self.__reader
+
+
+class HistoryQuery:
+    '''
+    Name:
+        HistoryQuery
+    Desc:
+        One HISTORY request, answered from the archive written by
+        read_labjack.py (see instrumentation/archive.py). Creating it checks
+        the request and brings the archive index up to date. messages() then
+        reads the archive one chunk at a time and yields the reply. Neither
+        touches the event loop, both are meant to run in a worker thread.
+
+        Binary clients get each HISTORY message as a JSON header followed
+        by the packed points, the same column layout as their envelopes.
+
+        Frames still on their way to the archive are not in it yet, the
+        last second or two of a running firing comes from the live stream.
+
+    Public:
+        id: the id of the request, echoed in every reply so a client can
+            tell overlapping requests apart
+        channel: the channel name
+        start, end: the time window in seconds, inclusive
+        resolution: seconds of each point, 0 for every frame. Rounded up to
+                    whole archive chunks from the chunk duration up.
+        binary: reply in the binary format
+        points: points yielded so far
+    '''
+    def __init__(self, archive: HistoryArchive, request: dict, binary: bool = False):
+        self.binary = binary
+        self.id = request.get("id")
+        self.channel = request.get("channel")
+        self.start = float(request.get("start", -math.inf))
+        self.end = float(request.get("end", math.inf))
+        self.points = 0
+
+        resolution = float(request.get("resolution", 0))
+        if not isinstance(self.channel, str):
+            raise ValueError("channel must be the name of a channel")
+        if resolution < 0:
+            raise ValueError("resolution must be at least 0")
+        if self.end < self.start:
+            raise ValueError("end must not be before start")
+
+        self.__reader = archive.reader()
+        names = [channel['name'] for channel in self.__reader.channels]
+        if self.channel not in names:
+            raise ValueError(f"Unknown channel: {self.channel}")
+        self.__index = names.index(self.channel)
+        self.resolution = self.__reader.resolution(resolution)
+
+
+    def messages(self):
+        '''
+        Name:
+            HistoryQuery.messages() -> generator
+        Returns:
+            The reply, a tuple of messages to send back to back for every
+            HISTORY_MESSAGE_POINTS (HISTORY_BINARY_MESSAGE_POINTS) points,
+            then a HISTORY_END message. See Docs/ws-api.md.
+        '''
+        size = HISTORY_BINARY_MESSAGE_POINTS if self.binary else HISTORY_MESSAGE_POINTS
+        pending, count = [], 0
+        for block in self.__reader.resample(self.__index, self.start, self.end, self.resolution):
+            pending.append(block)
+            count += len(block[0])
+            if count < size:
+                continue
+
+            # Send every full message, keep the rest for the next block
+            block = tuple(np.concatenate(column) for column in zip(*pending))
+            rest = count % size
+            for i in range(0, count - rest, size):
+                yield self.__message(tuple(column[i:i + size] for column in block))
+            pending, count = [tuple(column[count - rest:] for column in block)], rest
+
+        if count:
+            yield self.__message(tuple(np.concatenate(column) for column in zip(*pending)))
+
+        yield (json.dumps({
+            "identifier": "HISTORY_END",
+            "id": self.id,
+            "channel": self.channel,
+            "resolution": self.resolution,
+            "points": self.points
+        }),)
+
+
+    def __message(self, block: tuple) -> tuple:
+        timestamps, minimum, maximum, mean = block
+        self.points += len(timestamps)
+
+        message = {
+            "identifier": "HISTORY",
+            "id": self.id,
+            "channel": self.channel,
+            "resolution": self.resolution
+        }
+        if self.binary:
+            columns = (mean,) if not self.resolution else (minimum, maximum, mean)
+            message["format"] = "BINARY"
+            message["points"] = len(timestamps)
+            return (json.dumps(message), b''.join((
+                struct.pack(BINARY_HISTORY_HEADER_FORMAT, len(timestamps)),
+                timestamps.astype('<f8').tobytes(),
+                *(column.astype('<f4').tobytes() for column in columns))))
+
+        # Gaps are null, NaN is not JSON
+        message["timestamp"] = timestamps.tolist()
+        if self.resolution:
+            message["min"] = finite_or_null(minimum.tolist())
+            message["max"] = finite_or_null(maximum.tolist())
+            message["mean"] = finite_or_null(mean.tolist())
+        else:
+            message["data"] = finite_or_null(mean.tolist())
+        return (json.dumps(message),)
@@ -1,23 +1,33 @@
-import math
 import time
+import random
 
-TEMPERATURE_SENSOR_RANGE    = range(273, 300)
-PRESSURE_SENSOR_RANGE       = range(1, 100)
-LOAD_SENSOR_RANGE           = range(0, 15)
+# Packet averaged values only. To run the whole acquisition pipeline without
+# hardware use instrumentation/fake_u6.py (read_labjack.py --simulate).
 
-def labjack_mock():
+TEMPERATURE_SENSOR_RANGE    = (273, 300)
+PRESSURE_SENSOR_RANGE       = (1, 100)
+LOAD_SENSOR_RANGE           = (0, 15)
+
+SENSOR_RANGES = {
+    'P_INJECTOR': PRESSURE_SENSOR_RANGE,
+    'P_COMB_CHMBR': PRESSURE_SENSOR_RANGE,
+    'P_N2O_FLOW': PRESSURE_SENSOR_RANGE,
+    'P_N2_FLOW': PRESSURE_SENSOR_RANGE,
+    'P_RUN_TANK': PRESSURE_SENSOR_RANGE,
+    'L_RUN_TANK': LOAD_SENSOR_RANGE,
+    'L_THRUST': LOAD_SENSOR_RANGE,
+    'T_RUN_TANK': TEMPERATURE_SENSOR_RANGE,
+    'T_INJECTOR': TEMPERATURE_SENSOR_RANGE,
+    'T_COMB_CHMBR': TEMPERATURE_SENSOR_RANGE,
+    'T_POST_COMB': TEMPERATURE_SENSOR_RANGE,
+}
+
+def labjack_mock() -> dict:
+    '''
+    Name:
+        labjack_mock() -> dict
+    Returns:
+        A dict of sensor name -> random value, one packet a millisecond
+    '''
     time.sleep(0.001)
-    return {
-        'P_INJECTOR': math.randint(PRESSURE_SENSOR_RANGE),
-        'P_COMB_CHMBR': math.randint(PRESSURE_SENSOR_RANGE),
-        'P_N2O_FLOW': math.randint(PRESSURE_SENSOR_RANGE),
-        'P_N2_FLOW': math.randint(PRESSURE_SENSOR_RANGE),
-        'P_RUN_TANK': math.randint(PRESSURE_SENSOR_RANGE),
-        'L_RUN_TANK': math.randint(LOAD_SENSOR_RANGE),
-        'L_THRUST': math.randint(LOAD_SENSOR_RANGE),
-        'T_RUN_RANK': math.randint(TEMPERATURE_SENSOR_RANGE),
-        'T_INJECTOR': math.randint(TEMPERATURE_SENSOR_RANGE),
-        'T_COMB_CHMBR': math.randint(TEMPERATURE_SENSOR_RANGE),
-        'T_POST_COMB': math.randint(TEMPERATURE_SENSOR_RANGE),
-        'SHUNT': math.randint(TEMPERATURE_SENSOR_RANGE),
-    }
\ No newline at end of file
+    return {name: random.uniform(*value_range) for name, value_range in SENSOR_RANGES.items()}
@@ -1,4 +1,10 @@
+import os
+import sys
 import asyncio
+
+# wss.py imports modules from the instrumentation and server packages in src/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from wss import WebSocketServer
 
 __name__ = "TestServer"
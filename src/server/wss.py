@@ -3,8 +3,16 @@ import asyncio
 import time
 import websockets
 import json
-import logging
 import platform
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation.ring_buffer import RingBufferReader, INSTRUMENTATION_RING_NAME
+from instrumentation.archive import INSTRUMENTATION_ARCHIVE_PATH
+from server.broadcastHub import BroadcastHub, DEFAULT_QUEUE_SIZE, DROP_OLDEST, SLOW_CONSUMER_POLICIES
+from server.frameEncoder import InstrumentationFrameEncoder, JSON_FORMAT, BINARY_FORMAT
+from server.historyQuery import HistoryArchive, HistoryQuery
+from logger.queuedLogging import configure_log, TEXT_FORMAT
+from logger.pipelineMetrics import metrics, serve_metrics
 # from .instrumentationMock import labjack_mock as lj_mock
 # from .serailMock import serial_feedback_mock as serial_mock
 
@@ -18,7 +26,28 @@ HOST_TEST = "localhost"
 PORT_SERIAL = 8080
 PORT_INSTRUMENTATION = 8888
 
-INSTRUMENTATION_FILE_DATA_PATH = '/home/uvr/Documents/GitHub/PDP-Monitoring-System/src/instrumentation/tmp.txt'
+# Plain text METRICS, served on localhost only
+PORT_METRICS_SERIAL = 8081
+PORT_METRICS_INSTRUMENTATION = 8889
+
+# Format of ws-server.log, BINARY_FORMAT for a compact log (see logger/queuedLogging.py)
+LOG_FORMAT = TEXT_FORMAT
+
+# Seconds to wait between polls of the instrumentation ring buffer
+INSTRUMENTATION_POLL_INTERVAL = 0.0005
+
+# Most seconds a CONFIGURE waits for acquisition to start before it is
+# answered with an ERROR
+CONFIGURE_TIMEOUT = 5.0
+
+# Seconds without samples before checking if read_labjack.py restarted
+# with a new ring buffer
+RING_CHECK_INTERVAL = 1.0
+
+# HISTORY replies queued on a client at once. The next message is only read
+# from the archive once the client has taken the previous ones, so a long
+# reply never holds up that client's live frames for long.
+HISTORY_QUEUED_MESSAGES = 2
 
 INSTRUMENTATION_WS_TYPE = "INSTRUMENTATION_WS"
 SERIAL_WS_TYPE = "SERIAL_WS"
@@ -36,7 +65,35 @@ class VCFeedback:
         self.action = action
 
 class WebSocketServer:
-    def __init__(self, ws_type: str, test_mode: bool = False):
+    def __init__(
+        self,
+        ws_type: str,
+        test_mode: bool = False,
+        client_queue_size: int = DEFAULT_QUEUE_SIZE,
+        slow_consumer_policy: str = DROP_OLDEST,
+        host: str = None,
+        port: int = None,
+        ring_name: str = INSTRUMENTATION_RING_NAME,
+        metrics_port: int = None,
+        archive_path: str = INSTRUMENTATION_ARCHIVE_PATH
+    ):
+        '''
+        Name:
+            WebSocketServer(ws_type= str, test_mode= bool, client_queue_size= int, slow_consumer_policy= str, host= str, port= int, ring_name= str, metrics_port= int, archive_path= str)
+        Args:
+            ws_type: INSTRUMENTATION_WS_TYPE or SERIAL_WS_TYPE
+            test_mode: serve on localhost with mock data
+            client_queue_size: frames queued per instrumentation client
+            slow_consumer_policy: what to do when an instrumentation client's
+                queue is full, see broadcastHub.py
+            host: serve on this host instead of the production or test host
+            port: serve on this port instead of the default for ws_type
+            ring_name: the instrumentation ring buffer to attach to
+            metrics_port: serve the text metrics on this local port
+                instead of the default for ws_type
+            archive_path: the instrumentation archive HISTORY requests are
+                answered from
+        '''
         self.__ws_type = ws_type
         self.__test_mode = test_mode
         self.__host = HOST_PRODUCTION
@@ -47,33 +104,52 @@ class WebSocketServer:
 
         if self.__ws_type == INSTRUMENTATION_WS_TYPE:
             self.__port = PORT_INSTRUMENTATION
+            self.__metrics_port = PORT_METRICS_INSTRUMENTATION
         else:
             self.__port = PORT_SERIAL
+            self.__metrics_port = PORT_METRICS_SERIAL
+
+        if host is not None:
+            self.__host = host
+        if port is not None:
+            self.__port = port
+        if metrics_port is not None:
+            self.__metrics_port = metrics_port
+        self.__ring_name = ring_name
+        self.__history_archive = HistoryArchive(archive_path)
 
         print(f'type:{self.__ws_type}, port:{self.__port}, host:{self.__host}')
         
         self.__wss_instance = None
 
-        self.__logger = logging.getLogger(__name__)
-        self.__log_handler = None
+        self.__logger = None
 
-        self.__incoming_queue = asyncio.LifoQueue()
+        self.__incoming_queue = asyncio.Queue()
         self.__configure_log()
 
+        self.__hub = BroadcastHub(client_queue_size, slow_consumer_policy)
+        self.__encoder = None
+        self.__encoder_ready = asyncio.Event()
+
+        self.__status_sources = {}
+
+        # A single worker reads the archive for every HISTORY request in
+        # turn, one chunk at a time, so queries share one core at most and
+        # never run on the event loop
+        self.__history_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self.__history_queries = {}
+
 
     def __configure_log(self):
         '''
         Name:
             WebSocketServer.__configure_log() -> None
         Desc:
-            Configures the log file
+            Configures the log file. Records are written by a background
+            thread so logging never blocks the event loop.
         '''
-        self.__log_handler = logging.FileHandler('ws-server.log', mode='w')
-        formatter = logging.Formatter('[%(name)s] %(asctime)s [%(levelname)s]: %(message)s')
-        self.__log_handler.setFormatter(formatter)
-        self.__logger.addHandler(self.__log_handler)
-        self.__logger.setLevel(logging.INFO)
-        self.__logger.info("WS Logger configured\n")
+        self.__logger = configure_log(__name__, 'ws-server.log', log_format=LOG_FORMAT)
+        self.__logger.info("WS Logger configured")
 
 
     async def __serial_handler(self, websocket):
@@ -92,34 +168,322 @@ class WebSocketServer:
         }))
         self.__logger.info(f"VC Connected")
         async for message in websocket:
-            await self.__incoming_queue.put(message)
-            self.__incoming_queue.task_done()
-            await asyncio.sleep(0)
+            request = self.__request_identifier(message)
+            if request == "STATUS":
+                await websocket.send(json.dumps({
+                    "identifier": "STATUS",
+                    "data": self.status()
+                }))
+                continue
+            elif request == "METRICS":
+                await websocket.send(json.dumps({
+                    "identifier": "METRICS",
+                    "data": metrics.snapshot()
+                }))
+                continue
+            # Stamped on arrival, the first stage boundary of a command
+            await self.__incoming_queue.put((time.monotonic(), message))
+
+
+    def register_status(self, name: str, source) -> None:
+        '''
+        Name:
+            WebSocketServer.register_status(name= str, source= callable) -> None
+        Args:
+            name: the key of the source in STATUS replies
+            source: called with no arguments, returns a JSON serializable value
+        Desc:
+            Adds a source to the replies to {"identifier": "STATUS"} requests
+        '''
+        self.__status_sources[name] = source
+
+
+    def status(self) -> dict:
+        '''
+        Name:
+            WebSocketServer.status() -> dict
+        Returns:
+            The current value of every registered status source
+        '''
+        return {name: source() for name, source in self.__status_sources.items()}
+
+
+    def __request_identifier(self, message) -> str:
+        '''
+        Name:
+            WebSocketServer.__request_identifier(message= str) -> str
+        Returns:
+            "STATUS" or "METRICS" if the message is that request, None for
+            anything else. Commands are not parsed twice.
+        '''
+        if '"STATUS"' not in message and '"METRICS"' not in message:
+            return None
+        try:
+            request = json.loads(message)
+        except ValueError:
+            return None
+        if not isinstance(request, dict) or request.get("identifier") not in ("STATUS", "METRICS"):
+            return None
+        return request["identifier"]
     
     
     async def __instrumentation_handler(self, websocket):
         '''
-        ame:
-            WebSocketServer.__handler(websocket=websockets.WebSocketServerProtocol, path= str) -> None
+        Name:
+            WebSocketServer.__instrumentation_handler(websocket= websockets.ServerConnection) -> None
         Args:
             websocket: the websocket connection
         Desc:
-            Handles the websocket requests and serial feedback to send over the websocket
+            Subscribes the client to the instrumentation hub and sends it
+            frames until it disconnects. Messages from the client configure
+            its stream, see __handle_instrumentation_request
+        '''
+        subscriber = self.__hub.subscribe(websocket)
+        sender = asyncio.create_task(subscriber.run())
+        self.__logger.info(f"Instrumentation client connected: {websocket.remote_address}")
+        try:
+            async for message in websocket:
+                await self.__handle_instrumentation_request(subscriber, message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+            query = self.__history_queries.pop(subscriber, None)
+            if query is not None:
+                query.cancel()
+            self.__hub.unsubscribe(subscriber)
+            self.__logger.info(
+                f"Instrumentation client disconnected: {websocket.remote_address}, "
+                f"sent {subscriber.samples_sent} samples in {subscriber.messages_sent} messages, "
+                f"dropped {subscriber.dropped}")
+
+
+    async def __handle_instrumentation_request(self, subscriber, message):
+        '''
+        Name:
+            WebSocketServer.__handle_instrumentation_request(subscriber= Subscriber, message= str) -> None
+        Args:
+            subscriber: the client's hub subscription
+            message: the message received from the client
+        Desc:
+            Handles CONFIGURE, STATS, METRICS and HISTORY requests, see Docs/ws-api.md. Replies
+            are queued on the subscriber so they stay in order with frames.
+            A HISTORY request replaces the client's previous one if it is
+            still being answered.
+        '''
+        try:
+            request = json.loads(message)
+            identifier = request.get("identifier")
+        except (TypeError, ValueError, AttributeError):
+            self.__logger.warning(f"Invalid instrumentation request: {message}")
+            return
+
+        if identifier == "CONFIGURE":
+            # The channels, and so the SCHEMA, are only known once
+            # acquisition starts
+            try:
+                await asyncio.wait_for(self.__encoder_ready.wait(), CONFIGURE_TIMEOUT)
+            except asyncio.TimeoutError:
+                subscriber.send_control(json.dumps({"identifier": "ERROR", "data": "Acquisition has not started"}))
+                return
+            try:
+                self.__configure_instrumentation_client(subscriber, request)
+            except (TypeError, ValueError) as e:
+                subscriber.send_control(json.dumps({"identifier": "ERROR", "data": str(e)}))
+        elif identifier == "STATS":
+            subscriber.send_control(json.dumps({"identifier": "STATS", "data": subscriber.stats()}))
+        elif identifier == "METRICS":
+            subscriber.send_control(json.dumps({"identifier": "METRICS", "data": metrics.snapshot()}))
+        elif identifier == "HISTORY":
+            previous = self.__history_queries.pop(subscriber, None)
+            if previous is not None:
+                previous.cancel()
+            self.__history_queries[subscriber] = asyncio.create_task(self.__send_history(subscriber, request))
+
+
+    async def __send_history(self, subscriber, request: dict):
+        '''
+        Name:
+            WebSocketServer.__send_history(subscriber= Subscriber, request= dict) -> None
+        Args:
+            subscriber: the client's hub subscription
+            request: the HISTORY request
+        Desc:
+            Answers a HISTORY request from the archive (see historyQuery.py).
+            The archive is read in the history worker, one message at a
+            time, and the next message is only read once fewer than
+            HISTORY_QUEUED_MESSAGES are waiting for this client. Neither the
+            live stream nor other clients wait on the query.
+        '''
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            query = await loop.run_in_executor(self.__history_executor, HistoryQuery, self.__history_archive, request, subscriber.binary)
+        except (TypeError, ValueError) as e:
+            subscriber.send_control(json.dumps({"identifier": "ERROR", "data": str(e)}))
+            return
+
+        messages = query.messages()
+
+        try:
+            while (reply := await loop.run_in_executor(self.__history_executor, next, messages, None)) is not None:
+                while subscriber.control_depth >= HISTORY_QUEUED_MESSAGES:
+                    await asyncio.sleep(INSTRUMENTATION_POLL_INTERVAL)
+                # Queued together, so a binary message directly follows its header
+                for message in reply:
+                    subscriber.send_control(message)
+        except Exception as e:
+            self.__logger.error(f"HISTORY request {request} failed: {e}")
+            subscriber.send_control(json.dumps({"identifier": "ERROR", "data": f"HISTORY failed: {e}"}))
+            return
+        finally:
+            # Queued behind a read of this query still running in the worker
+            self.__history_executor.submit(messages.close)
+            if self.__history_queries.get(subscriber) is asyncio.current_task():
+                del self.__history_queries[subscriber]
+
+        metrics.count('instrumentation.history_points', query.points)
+        metrics.observe('instrumentation.history', time.monotonic() - started)
+        self.__logger.info(
+            f"HISTORY {query.channel} [{query.start}, {query.end}] at {query.resolution} s: "
+            f"{query.points} points in {time.monotonic() - started:.3f} s")
+
+
+    def __configure_instrumentation_client(self, subscriber, request: dict):
+        '''
+        Name:
+            WebSocketServer.__configure_instrumentation_client(subscriber= Subscriber, request= dict) -> None
+        Args:
+            subscriber: the client's hub subscription
+            request: the CONFIGURE request. Fields that are left out keep
+                their current value.
+        Desc:
+            Applies the format, batching, display rate and slow consumer
+            policy of the request. Binary clients are sent a SCHEMA message describing the
+            new layout before their first message in it.
+        '''
+        wire_format = request.get("format", BINARY_FORMAT if subscriber.binary else JSON_FORMAT)
+        if wire_format not in (JSON_FORMAT, BINARY_FORMAT):
+            raise ValueError(f"Unknown format: {wire_format}")
+
+        policy = request.get("policy", subscriber.policy)
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+        batch_size = int(request.get("batch_size", subscriber.batch_size))
+        batch_interval = float(request.get("batch_interval", subscriber.batch_interval * 1000)) / 1000
+
+        display_rate = float(request.get("display_rate", subscriber.display_rate))
+        if display_rate < 0:
+            raise ValueError("display_rate must be at least 0")
+        if display_rate and (batch_size > 1 or batch_interval > 0):
+            raise ValueError("display_rate can not be combined with batching")
+
+        subscriber.configure_batching(batch_size, batch_interval)
+        subscriber.display_rate = display_rate
+        subscriber.policy = policy
+        subscriber.binary = wire_format == BINARY_FORMAT
+        if subscriber.binary:
+            subscriber.send_control(self.__encoder.schema(
+                batched=subscriber.batching,
+                envelope=bool(subscriber.display_rate)))
+
+
+    async def __instrumentation_producer(self):
+        '''
+        Name:
+            WebSocketServer.__instrumentation_producer() -> None
+        Desc:
+            Reads new samples from the ring buffer and publishes each one once
+            to every connected client through the hub. When no samples come
+            for RING_CHECK_INTERVAL and read_labjack.py has replaced or
+            removed the ring, attaches to the new one.
+        '''
+        reader = await self.__attach_instrumentation()
+        checked = time.monotonic()
+        try:
+            while True:
+                if time.monotonic() - checked >= RING_CHECK_INTERVAL:
+                    checked = time.monotonic()
+                    if reader.replaced():
+                        self.__logger.warning("Instrumentation ring buffer replaced, attaching again")
+                        metrics.count('instrumentation.reattach')
+                        reader.close()
+                        reader = None
+                        reader = await self.__attach_instrumentation()
+                        checked = time.monotonic()
+
+                sequences, records, overrun = reader.read_sequenced()
+                if overrun:
+                    self.__logger.warning(f"Instrumentation producer fell behind, {overrun} samples lost")
+                    metrics.count('instrumentation.overrun', overrun)
+                if len(records):
+                    checked = time.monotonic()
+                    self.__observe_stages(reader, sequences, records)
+                for name, value in reader.status().items():
+                    metrics.gauge(f'acquisition.{name}', value)
+                if self.__hub.subscribers and len(records):
+                    published = time.monotonic()
+                    self.__hub.publish_records(self.__encoder, sequences, records)
+                    metrics.observe('instrumentation.publish', time.monotonic() - published)
+                await asyncio.sleep(INSTRUMENTATION_POLL_INTERVAL)
+        finally:
+            if reader is not None:
+                reader.close()
+
+
+    def __observe_stages(self, reader: RingBufferReader, sequences, records) -> None:
+        '''
+        Name:
+            WebSocketServer.__observe_stages(reader= RingBufferReader, sequences= np.ndarray, records= np.ndarray) -> None
+        Desc:
+            Adds the stage times of the newest record read to the metrics.
+            Its scan time is moved onto the monotonic clock to time the
+            LabJack transfer, the stream timestamps are wall clock.
+        '''
+        read = time.monotonic()
+        acquired, converted, handoff = reader.marks(sequences[-1:])[0].tolist()
+        scanned = float(records[-1, 0]) + read - time.time()
+
+        metrics.count('instrumentation.samples', len(records))
+        metrics.observe('instrumentation.transfer', acquired - scanned)
+        metrics.observe('instrumentation.convert', converted - acquired)
+        metrics.observe('instrumentation.record', handoff - converted)
+        metrics.observe('instrumentation.handoff', read - handoff)
+
+
+    async def __attach_instrumentation(self) -> RingBufferReader:
+        '''
+        Name:
+            WebSocketServer.__attach_instrumentation() -> RingBufferReader
+        Desc:
+            Attaches to the ring buffer published by read_labjack.py, waiting
+            for acquisition to start if it has not yet. Every attach gets a
+            new encoder, binary clients are sent its SCHEMA if the channels
+            changed.
         '''
-        print("instrumentation handler")
         while True:
-            with open(INSTRUMENTATION_FILE_DATA_PATH, 'r') as file:
-                lines = file.readlines()
-                if len(lines) > 1:
-                    await websocket.send(json.dumps({
-                        "identifier": "INSTRUMENTATION",
-                        "data": json.loads(lines[0])
-                    })) 
-                    await asyncio.sleep(0.001)
+            try:
+                reader = RingBufferReader(self.__ring_name)
+                break
+            except FileNotFoundError:
+                await asyncio.sleep(1)
+
+        previous = self.__encoder
+        self.__encoder = InstrumentationFrameEncoder(reader.channels, reader.units)
+        self.__encoder_ready.set()
+        self.__hub.reset()
+        if previous is not None and (previous.channels, previous.units) != (self.__encoder.channels, self.__encoder.units):
+            for subscriber in self.__hub.subscribers:
+                if subscriber.binary:
+                    subscriber.send_control(self.__encoder.schema(
+                        batched=subscriber.batching,
+                        envelope=bool(subscriber.display_rate)))
+        return reader
 
 
     async def __test_instrumentation__handler(self, websocket):
-        print("Test Instrumentation Handler")
+        self.__logger.info("Test Instrumentation Handler")
         while True:
             packet = lj_mock()
             await websocket.send(json.dumps({
@@ -130,24 +494,36 @@ class WebSocketServer:
 
 
     async def __test_serial_handler(self, websocket):
-        print("Test Serial Handler")
+        self.__logger.info("Test Serial Handler")
         while True:
             async for message in websocket:
                 packet = json.loads(message)
                 await websocket.send(json.dumps(serial_mock(valve=packet['valve'], action='TRANSIT')))
-                print(f"Sent: {packet['valve']} TRANSIT")
+                self.__logger.info("Sent", extra={'fields': {'valve': packet['valve'], 'action': 'TRANSIT'}})
                 time.sleep(3)
                 feedback = serial_mock(valve=packet['valve'], action=packet['action'])
-                print(f"Sent: {feedback}")
+                self.__logger.info("Sent", extra={'fields': feedback})
                 await websocket.send(json.dumps(feedback))
             await asyncio.sleep(0)
 
 
-    async def wss_reception_handler(self, queue):
+    async def wss_reception_handler(self, scheduler):
+        '''
+        Name:
+            WebSocketServer.wss_reception_handler(scheduler= CommandScheduler) -> None
+        Args:
+            scheduler: the serial command scheduler
+        Desc:
+            Schedules the commands received from mission control in the order
+            they arrived
+        '''
         while True:
-            message = await self.__incoming_queue.get()
-            await queue.put(message)
-            await asyncio.sleep(0)
+            received, message = await self.__incoming_queue.get()
+            metrics.count('commands.received')
+            try:
+                scheduler.put(message, received)
+            except ValueError as e:
+                self.__logger.error(f"Dropped invalid command {message}: {e}")
 
     
     async def serial_feedback_wss_handler(self, queue):
@@ -165,12 +541,16 @@ class WebSocketServer:
                 try:
                     # Try to get feedback from the serial queue. if none available then continue to the next iteration
                     feedback = await queue.get() 
-                    self.__logger.info(f"Received from serial feedback: {feedback}")
+                    stages = feedback.pop('stages', None)
+                    self.__logger.info("Received from serial feedback", extra={'fields': feedback})
             
                     await self.__wss_instance.send(json.dumps({
                         "identifier": "FEEDBACK",
                         "data": feedback
                     }))
+                    metrics.count('feedback.sent')
+                    if stages is not None:
+                        metrics.observe('feedback.send', time.monotonic() - stages['read'])
 
                 except asyncio.QueueEmpty:
                     await asyncio.sleep(0)
@@ -192,6 +572,23 @@ class WebSocketServer:
         await self.__wss_instance.send(message)
 
 
+    async def __serve_metrics(self):
+        '''
+        Name:
+            WebSocketServer.__serve_metrics() -> asyncio.AbstractServer | contextlib.nullcontext
+        Returns:
+            The started metrics server, or an empty context if it could not start
+        Desc:
+            The metrics are diagnostics only, so a metrics port that is already
+            in use is logged and the websocket keeps serving without them
+        '''
+        try:
+            return await serve_metrics(HOST_TEST, self.__metrics_port)
+        except OSError as e:
+            self.__logger.warning(f"Metrics server not started on port {self.__metrics_port}: {e}")
+            return contextlib.nullcontext()
+
+
     async def start_serial(self):
         '''
         Name:
@@ -200,7 +597,7 @@ class WebSocketServer:
             Starts the websocket server
         '''
         handler = self.__serial_handler if not self.__test_mode else self.__test_serial_handler
-        async with websockets.serve(handler, self.__host, self.__port):
+        async with websockets.serve(handler, self.__host, self.__port), await self.__serve_metrics():
             await asyncio.Future()
 
     async def start_instrumentation(self):
@@ -211,5 +608,8 @@ class WebSocketServer:
             Starts the websocket server
         '''
         handler = self.__instrumentation_handler if not self.__test_mode else self.__test_instrumentation__handler
-        async with websockets.serve(handler, self.__host, self.__port):
-            await asyncio.Future()
+        async with websockets.serve(handler, self.__host, self.__port), await self.__serve_metrics():
+            if not self.__test_mode:
+                await self.__instrumentation_producer()
+            else:
+                await asyncio.Future()
@@ -0,0 +1,493 @@
+'''
+End to end benchmarks of the instrumentation and command paths on simulated
+devices, so runs can be compared across changes.
+
+Instrumentation: a FakeU6 is streamed through read_labjack.stream() in its
+own process (the USB reader, with the conversion, recording and publishing
+stages forked from it, like on the cart). A WebSocketServer in this process publishes the ring to N loopback
+clients in a third process. Each run reports the samples/s acquired and
+delivered, missed scans, dropped frames, the latency from the scan time of
+a sample to its arrival at a client, and the CPU and peak RSS of each
+process. With --max-throughput the FakeU6 is not paced by its clock and
+the reader waits for conversion instead of dropping, which measures the
+most samples/s the pipeline can sustain.
+
+Commands: a websocket client sends valve commands through the serial
+WebSocketServer, CommandScheduler and SerialInterface to an ArduinoSimulator
+on a pty, and times each one until the FEEDBACK that confirms it arrives.
+
+Run from src/:
+    python test/benchmark.py --rates 1000,5000 --channels 11 --clients 4 --duration 5
+
+Results are written as JSON to --output (benchmark-<time>.json by default).
+Logs and recordings go to a temporary directory.
+'''
+import io
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SRC)
+# read_labjack.py and the modules it imports use sibling imports
+sys.path.append(os.path.join(SRC, 'instrumentation'))
+
+import websockets
+from server.frameEncoder import BINARY_HEADER_FORMAT
+from logger.pipelineMetrics import metrics
+
+DEFAULT_RATES = [1000]
+DEFAULT_CHANNELS = [11]
+DEFAULT_CLIENTS = 1
+DEFAULT_DURATION = 5.0
+DEFAULT_COMMANDS = 100
+
+# Seconds to keep clients connected after acquisition stops, so frames
+# still in flight are delivered
+DRAIN_TIME = 0.5
+
+# SamplesPerPacket can not be raised above this on the U6
+MAX_SAMPLES_PER_PACKET = 25
+
+
+def process_usage(cpu_start: float, wall_start: float) -> dict:
+    '''
+    Name:
+        process_usage(cpu_start= float, wall_start= float) -> dict
+    Args:
+        cpu_start: time.process_time() at the start of the run
+        wall_start: time.perf_counter() at the start of the run
+    Returns:
+        CPU seconds and percent of one core used since the start, and the
+        peak RSS of the process in MB (None where unavailable)
+    '''
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    rss = None
+    if resource is not None:
+        # KB on Linux, bytes on macOS
+        scale = 1 / 1024 ** 2 if sys.platform == 'darwin' else 1 / 1024
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return {'cpu_s': cpu, 'cpu_percent': 100 * cpu / wall if wall else 0.0, 'rss_peak_mb': rss}
+
+
+def percentiles(latencies: list) -> dict:
+    '''
+    Name:
+        percentiles(latencies= list) -> dict
+    Args:
+        latencies: seconds
+    Returns:
+        count, p50/p95/p99 and max in milliseconds
+    '''
+    if not len(latencies):
+        return {'count': 0, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    ms = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {'count': len(ms), 'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(ms.max())}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def benchmark_sensors(count: int) -> tuple:
+    '''
+    Name:
+        benchmark_sensors(count= int) -> (list, list)
+    Args:
+        count: number of channels to stream
+    Returns:
+        channel_settings and sensors for read_labjack.py. The cart's sensors
+        are used first, more channels are single ended volts.
+    '''
+    import read_labjack
+
+    options = dict(read_labjack.channel_settings)
+    sensors = read_labjack.sensors[:count]
+    channel_settings = [(int(sensor[1][3:]), options[int(sensor[1][3:])]) for sensor in sensors]
+
+    used = {number for number, _ in channel_settings}
+    spare = (number for number in range(14) if number not in used)
+    while len(sensors) < count:
+        number = next(spare)
+        channel_settings.append((number, read_labjack.SING | read_labjack.X1))
+        sensors.append((f'V_AIN{number}', f'AIN{number}', 1.0, 0, 'V'))
+    return channel_settings, sensors
+
+
+def acquisition_worker(settings: dict, ready, go, results) -> None:
+    '''
+    Name:
+        acquisition_worker(settings= dict, ready= Event, go= Event, results= Queue) -> None
+    Desc:
+        Runs read_labjack.stream() on a FakeU6 in its own process. The ring
+        is created before ready is set and streaming starts when go is set.
+    '''
+    import read_labjack
+    from fake_u6 import FakeU6
+    from conversion import ConversionEngine
+    from ring_buffer import RingBufferWriter, RingBufferReader
+    from recording import RecordingWriter, open_recording
+    from stage_queue import BLOCK
+
+    channel_settings, sensors = benchmark_sensors(settings['channels'])
+    read_labjack.scan_frequency = settings['scan_frequency']
+    read_labjack.channel_settings = channel_settings
+    read_labjack.sensors = sensors
+    read_labjack.samples_per_packet = min(MAX_SAMPLES_PER_PACKET, max(read_labjack.samples_per_packet, len(sensors)))
+    read_labjack.stream_mode = 'RAW'
+    read_labjack.publish_raw = settings['publish_raw']
+    if settings['max_throughput']:
+        read_labjack.queue_policies = dict(read_labjack.queue_policies, convert=BLOCK)
+    read_labjack.check_settings()
+
+    d = FakeU6(realtime=not settings['max_throughput'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        V_ref = read_labjack.configure_stream(d)
+
+    engine = ConversionEngine(sensors)
+    ring = RingBufferWriter(engine.names, engine.units, name=settings['ring_name'], status=read_labjack.PIPELINE_STATUS)
+    status = RingBufferReader(settings['ring_name'])
+    read_labjack.archive_path = settings['archive_path']
+    recording = RecordingWriter(settings['recording_path'], engine.schema(), read_labjack.recording_dtype)
+    ready.set()
+    go.wait()
+
+    d.streamStart()
+    stream_start, stream_start_monotonic = time.time(), time.monotonic()
+    stop = threading.Timer(settings['duration'], d.streamStop)
+    stop.start()
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    try:
+        read_labjack.stream(d, engine, V_ref, recording, ring, stream_start, stream_start_monotonic)
+    finally:
+        elapsed = time.perf_counter() - wall_start
+        usage = process_usage(cpu_start, wall_start)
+        d.close()
+        recording.close()
+        pipeline = status.status()
+        status.close()
+        ring.close()
+
+    if resource is not None:
+        stages = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage['stages_cpu_percent'] = 100 * (stages.ru_utime + stages.ru_stime) / elapsed
+
+    # Samples that made it through every stage to the recording
+    header, frames = open_recording(settings['recording_path'])
+    gaps = int(np.isnan(frames['values']).all(axis=1).sum())
+    samples = (len(frames) - gaps) * len(sensors)
+    results.put({
+        'elapsed_s': elapsed,
+        'samples': samples,
+        'samples_per_s': samples / elapsed,
+        'frames_recorded': len(frames) - gaps,
+        'gaps': gaps,
+        'missed_scans': d.missed,
+        'pipeline': pipeline,
+        **usage
+    })
+
+
+def client_worker(port: int, clients: int, realtime: bool, ready, stop, results) -> None:
+    '''
+    Name:
+        client_worker(port= int, clients= int, realtime= bool, ready= Event, stop= Event, results= Queue) -> None
+    Desc:
+        Connects clients to the instrumentation server in their own process,
+        asks for binary frames and counts them until stop is set. Latency is
+        only measured when the samples are timed by a real time clock.
+    '''
+    async def client(stats):
+        async with websockets.connect(f'ws://localhost:{port}', max_size=None) as websocket:
+            await websocket.send(json.dumps({'identifier': 'CONFIGURE', 'format': 'BINARY'}))
+            stats['connected'] = True
+            last = None
+            async for message in websocket:
+                if isinstance(message, str):
+                    continue
+                received = time.time()
+                sequence, timestamp = struct.unpack_from(BINARY_HEADER_FORMAT, message)
+                if last is not None and sequence != last + 1:
+                    stats['dropped'] += sequence - last - 1
+                last = sequence
+                stats['samples'] += 1
+                if realtime:
+                    stats['latencies'].append(received - timestamp)
+
+    async def run():
+        stats = [{'connected': False, 'samples': 0, 'dropped': 0, 'latencies': []} for _ in range(clients)]
+        tasks = [asyncio.create_task(client(s)) for s in stats]
+        while not all(s['connected'] for s in stats):
+            await asyncio.sleep(0.01)
+        ready.set()
+
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        usage = process_usage(cpu_start, wall_start)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        results.put({
+            'clients': [{
+                'samples': s['samples'],
+                'dropped': s['dropped'],
+                'latency': percentiles(s['latencies'])
+            } for s in stats],
+            **usage
+        })
+
+    asyncio.run(run())
+
+
+async def wait_event(event, timeout: float = 30) -> None:
+    if not await asyncio.get_running_loop().run_in_executor(None, event.wait, timeout):
+        raise TimeoutError("Benchmark process did not start")
+
+
+async def run_instrumentation(settings: dict, directory: str) -> dict:
+    '''
+    Name:
+        run_instrumentation(settings= dict, directory= str) -> dict
+    Args:
+        settings: scan_frequency, channels, clients, duration, publish_raw
+                  and max_throughput of the run
+        directory: where the recording is written
+    Returns:
+        The settings, the results of each process and the server's stage
+        metrics
+    '''
+    from server.wss import WebSocketServer, INSTRUMENTATION_WS_TYPE
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    acquisition_ready, go, clients_ready, stop = (context.Event() for _ in range(4))
+
+    port = free_port()
+    worker_settings = dict(
+        settings,
+        ring_name=f"pdp_benchmark_{os.getpid()}",
+        recording_path=os.path.join(directory, 'benchmark.pdprec'),
+        archive_path=os.path.join(directory, 'benchmark.pdparc'))
+
+    acquisition = context.Process(target=acquisition_worker, args=(worker_settings, acquisition_ready, go, results))
+    acquisition.start()
+    await wait_event(acquisition_ready)
+
+    metrics.reset()
+    wss = WebSocketServer(INSTRUMENTATION_WS_TYPE, host='localhost', port=port, ring_name=worker_settings['ring_name'], metrics_port=free_port())
+    server = asyncio.create_task(wss.start_instrumentation())
+
+    clients = context.Process(target=client_worker, args=(port, settings['clients'], not settings['max_throughput'], clients_ready, stop, results))
+    clients.start()
+    await wait_event(clients_ready)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    go.set()
+    await asyncio.get_running_loop().run_in_executor(None, acquisition.join)
+    await asyncio.sleep(DRAIN_TIME)
+    usage = process_usage(cpu_start, wall_start)
+    stop.set()
+    await asyncio.get_running_loop().run_in_executor(None, clients.join)
+
+    server.cancel()
+    await asyncio.gather(server, return_exceptions=True)
+
+    run = {'settings': settings, 'server': usage, 'metrics': metrics.snapshot()}
+    for _ in range(2):
+        result = results.get(timeout=5)
+        run['clients' if 'clients' in result else 'acquisition'] = result
+
+    acquired = run['acquisition']
+    target = settings['scan_frequency'] * settings['channels']
+    delivered = [c['samples'] for c in run['clients']['clients']]
+    run['summary'] = {
+        'target_samples_per_s': None if settings['max_throughput'] else target,
+        'acquired_samples_per_s': acquired['samples_per_s'],
+        'sustained': None if settings['max_throughput'] else acquired['missed_scans'] == 0 and acquired['samples_per_s'] >= 0.95 * target,
+        'delivered_frames_per_client': min(delivered) if delivered else 0,
+        'frames_dropped': sum(c['dropped'] for c in run['clients']['clients'])
+    }
+    return run
+
+
+async def run_commands(count: int, actuation_delay: float) -> dict:
+    '''
+    Name:
+        run_commands(count= int, actuation_delay= float) -> dict
+    Args:
+        count: valve commands to send
+        actuation_delay: seconds the simulated valves take to move
+    Returns:
+        Latency from sending each command over the websocket to receiving
+        the FEEDBACK that confirms it, and the VC's own latency statistics
+    '''
+    from server.wss import WebSocketServer, SERIAL_WS_TYPE
+    from serialInterface.serialInterface import SerialInterface
+    from serialInterface.commandScheduler import CommandScheduler
+    from serialInterface.arduinoSimulator import ArduinoSimulator, SUMMARY_VALVES
+
+    simulator = ArduinoSimulator(actuation_delay=actuation_delay, summary_interval=0)
+    simulator.start()
+    serial = SerialInterface(port=simulator.port)
+    feedback = asyncio.Queue()
+    scheduler = CommandScheduler(feedback)
+
+    port = free_port()
+    metrics.reset()
+    wss = WebSocketServer(SERIAL_WS_TYPE, host='localhost', port=port, metrics_port=free_port())
+    tasks = [asyncio.create_task(task) for task in (
+        wss.start_serial(),
+        serial.receive_loop(feedback),
+        serial.send_async(scheduler),
+        serial.watch_confirmations(feedback),
+        wss.serial_feedback_wss_handler(feedback),
+        wss.wss_reception_handler(scheduler))]
+
+    # Only the valves the VC reports can be confirmed
+    valves = list(SUMMARY_VALVES)
+    latencies = []
+    unconfirmed = 0
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    try:
+        for _ in range(100):
+            try:
+                websocket = await websockets.connect(f'ws://localhost:{port}')
+                break
+            except OSError:
+                await asyncio.sleep(0.01)
+        async with websocket:
+            await websocket.recv()
+            for i in range(count):
+                valve = valves[i % len(valves)]
+                action = 'OPEN' if (i // len(valves)) % 2 == 0 else 'CLOSE'
+                sent = time.perf_counter()
+                await websocket.send(json.dumps({'command': 'CTRL', 'valve': valve, 'action': action}))
+                try:
+                    while True:
+                        message = json.loads(await asyncio.wait_for(websocket.recv(), actuation_delay + 5))
+                        data = message.get('data') or {}
+                        if data.get('command') == 'FEEDBACK' and data['valves'].get(valve) == action:
+                            latencies.append(time.perf_counter() - sent)
+                            break
+                except asyncio.TimeoutError:
+                    unconfirmed += 1
+    finally:
+        usage = process_usage(cpu_start, wall_start)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        serial.close()
+        simulator.stop()
+
+    return {
+        'settings': {'commands': count, 'actuation_delay': actuation_delay},
+        'websocket_round_trip': percentiles(latencies),
+        'unconfirmed': unconfirmed,
+        'serial_round_trip': serial.latency_stats(),
+        'scheduling': scheduler.latency_stats(),
+        'metrics': metrics.snapshot(),
+        'process': usage
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmarks(args, directory: str) -> dict:
+    report = {
+        'time': time.time(),
+        'revision': git_revision(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'instrumentation': [],
+        'commands': None
+    }
+
+    for channels in args.channels:
+        runs = [(rate, False) for rate in args.rates]
+        if args.max_throughput:
+            runs.append((max(args.rates), True))
+        for rate, max_throughput in runs:
+            run = await run_instrumentation({
+                'scan_frequency': rate,
+                'channels': channels,
+                'clients': args.clients,
+                'duration': args.duration,
+                'publish_raw': not args.averaged,
+                'max_throughput': max_throughput
+            }, directory)
+            summary = run['summary']
+            print(f"{channels} channels x {rate:g} Hz{' (max throughput)' if max_throughput else ''}: "
+                  f"{summary['acquired_samples_per_s']:.0f} samples/s acquired, "
+                  f"{run['acquisition']['missed_scans']} scans missed, "
+                  f"{summary['frames_dropped']} frames dropped")
+            report['instrumentation'].append(run)
+
+    if args.commands and hasattr(os, 'openpty'):
+        report['commands'] = await run_commands(args.commands, args.actuation_delay)
+        round_trip = report['commands']['websocket_round_trip']
+        print(f"{round_trip['count']} commands: p50 {round_trip['p50_ms']} ms, p99 {round_trip['p99_ms']} ms")
+
+    return report
+
+
+def comma_separated(kind):
+    return lambda text: [kind(value) for value in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the instrumentation and command paths on simulated devices")
+    parser.add_argument('--rates', type=comma_separated(float), default=DEFAULT_RATES, help="scan frequencies in Hz, comma separated")
+    parser.add_argument('--channels', type=comma_separated(int), default=DEFAULT_CHANNELS, help=f"channel counts, comma separated, at most {MAX_SAMPLES_PER_PACKET}")
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS, help="instrumentation websocket clients")
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help="seconds to stream each run")
+    parser.add_argument('--averaged', action='store_true', help="publish packet averages instead of every sample")
+    parser.add_argument('--max-throughput', action='store_true', help="also stream as fast as possible, without the device clock")
+    parser.add_argument('--commands', type=int, default=DEFAULT_COMMANDS, help="valve commands to time, 0 to skip")
+    parser.add_argument('--actuation-delay', type=float, default=0.0, help="seconds the simulated valves take to move")
+    parser.add_argument('--output', default=time.strftime('benchmark-%Y%m%d-%H%M%S.json'), help="JSON results file")
+    args = parser.parse_args()
+
+    if max(args.channels) > MAX_SAMPLES_PER_PACKET:
+        parser.error(f"at most {MAX_SAMPLES_PER_PACKET} channels")
+
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # serial.log and ws-server.log are written to the working directory
+        os.chdir(directory)
+        try:
+            report = asyncio.run(run_benchmarks(args, directory))
+        finally:
+            os.chdir(cwd)
+
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f"Results written to {output}")
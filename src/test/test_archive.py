@@ -0,0 +1,156 @@
+import os
+import time
+import tempfile
+import unittest
+import numpy as np
+from instrumentation.archive import ArchiveWriter, ArchiveReader, ArchiveError, LZMA
+
+CHANNELS = [{'name': 'P_INJECTOR', 'unit': 'Pa', 'gain': 2.0},
+            {'name': 'T_INJECTOR', 'unit': 'K', 'gain': None}]
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.pdparc')
+
+        # 10 s at 100 Hz starting half way through a chunk, with a gap marker
+        self.timestamps = 1000.5 + np.arange(1000) / 100
+        self.values = np.column_stack([np.arange(1000.0), 300.0 + np.arange(1000) % 7])
+        self.values[300] = np.nan
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, compression='zlib', start=True):
+        archive = ArchiveWriter(self.path, CHANNELS, 'float64', {'scan_frequency': 100}, compression, chunk_duration=1.0)
+        if start:
+            archive.start()
+        # Batches that do not line up with the chunks
+        for i in range(0, 1000, 73):
+            archive.write_frames(self.timestamps[i:i + 73], self.values[i:i + 73])
+        return archive
+
+    def test_round_trip(self):
+        for compression in ('zlib', LZMA):
+            archive = self.write(compression)
+            archive.close()
+            self.assertGreater(archive.status()['ratio'], 1)
+
+            reader = ArchiveReader(self.path)
+            self.assertEqual(reader.channels, CHANNELS)
+            self.assertEqual(reader.header['metadata']['scan_frequency'], 100)
+            timestamps, values = reader.read()
+            reader.close()
+            np.testing.assert_array_equal(timestamps, self.timestamps)
+            np.testing.assert_array_equal(values, self.values)
+
+    def test_chunks_and_statistics(self):
+        self.write().close()
+        reader = ArchiveReader(self.path)
+
+        # Half a chunk, then whole seconds
+        self.assertEqual(len(reader.index), 11)
+        self.assertEqual(reader.index['frames'].tolist(), [50] + [100] * 9 + [50])
+        self.assertEqual(reader.index['start'][1], 1001.0)
+
+        # The gap marker is left out of the statistics
+        entry = reader.index[3]
+        self.assertEqual(entry['min'][0], 250.0)
+        self.assertEqual(entry['max'][0], 349.0)
+        self.assertAlmostEqual(entry['mean'][0], np.nanmean(self.values[250:350, 0]))
+        reader.close()
+
+    def test_range_reads_only_overlapping_chunks(self):
+        self.write().close()
+        reader = ArchiveReader(self.path)
+
+        self.assertEqual(len(reader.chunks(1003.2, 1004.5)), 2)
+        timestamps, values = reader.read(1003.2, 1004.5, channels=[1])
+        reader.close()
+
+        inside = (self.timestamps >= 1003.2) & (self.timestamps <= 1004.5)
+        np.testing.assert_array_equal(timestamps, self.timestamps[inside])
+        np.testing.assert_array_equal(values, self.values[inside][:, [1]])
+
+    def test_resample(self):
+        self.write().close()
+        reader = ArchiveReader(self.path)
+
+        # Every frame
+        blocks = list(reader.resample(0, 1003.2, 1004.5))
+        timestamps = np.concatenate([block[0] for block in blocks])
+        self.assertEqual(len(blocks), 2)
+        np.testing.assert_array_equal(timestamps, self.timestamps[(self.timestamps >= 1003.2) & (self.timestamps <= 1004.5)])
+
+        # Bins of 0.75 s straddle the chunks, the gap marker at 1003.5 is
+        # left out of its bin
+        blocks = list(reader.resample(0, 1002.0, 1004.0, 0.75))
+        timestamps, minimum, maximum, mean = (np.concatenate(column) for column in zip(*blocks))
+        self.assertEqual(timestamps.tolist(), [1002.0, 1002.75, 1003.5])
+        self.assertEqual(minimum.tolist(), [150.0, 225.0, 301.0])
+        self.assertEqual(maximum.tolist(), [224.0, 299.0, 350.0])
+        self.assertEqual(mean.tolist(), [187.0, 262.0, 325.5])
+
+        # From the index alone, rounded up to whole chunks
+        self.assertEqual(reader.resolution(1.5), 2.0)
+        timestamps, minimum, maximum, mean = next(reader.resample(1, resolution=1.5))
+        reader.close()
+        self.assertEqual(timestamps.tolist(), [1000.0, 1002.0, 1004.0, 1006.0, 1008.0, 1010.0])
+        self.assertEqual(minimum.tolist(), [300.0] * 6)
+        self.assertEqual(maximum.tolist(), [306.0] * 6)
+        self.assertAlmostEqual(mean[1], np.nanmean(self.values[150:350, 1]))
+
+    def test_index_rebuilt_without_trailer(self):
+        archive = self.write(start=False)
+        archive.close()
+
+        # Cut off the index and half of the last chunk, as a power loss would
+        reader = ArchiveReader(self.path)
+        last = reader.index[-1]
+        reader.close()
+        with open(self.path, 'r+b') as file:
+            file.truncate(int(last['offset']) + int(last['size']) // 2)
+
+        reader = ArchiveReader(self.path)
+        timestamps, values = reader.read()
+        reader.close()
+        self.assertEqual(len(reader.index), 10)
+        np.testing.assert_array_equal(timestamps, self.timestamps[:950])
+
+    def test_refresh_while_writing(self):
+        archive = self.write()
+        while archive.chunks_written < archive.chunks_queued:
+            time.sleep(0.01)
+        reader = ArchiveReader(self.path)
+        self.assertEqual(len(reader.index), 10)
+        self.assertEqual(reader.read()[0][-1], self.timestamps[949])
+
+        archive.close()
+        reader.refresh()
+        self.assertEqual(len(reader.index), 11)
+        np.testing.assert_array_equal(reader.read()[0], self.timestamps)
+        reader.close()
+
+    def test_replaced_not_truncated(self):
+        self.write().close()
+        reader = ArchiveReader(self.path)
+        self.assertFalse(reader.replaced())
+
+        # The next firing, the open reader still reads the previous one
+        archive = ArchiveWriter(self.path, CHANNELS, 'float64')
+        self.assertTrue(reader.replaced())
+        np.testing.assert_array_equal(reader.read()[0], self.timestamps)
+        archive.close()
+        reader.close()
+        reader = ArchiveReader(self.path)
+        self.assertEqual(len(reader.index), 0)
+        reader.close()
+
+    def test_not_an_archive(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'PDPREC01' + bytes(16))
+        with self.assertRaises(ArchiveError):
+            ArchiveReader(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import asyncio
+import unittest
+import websockets
+from server.broadcastHub import BroadcastHub, DROP_OLDEST, LATEST, DISCONNECT
+
+class FakeEncoder:
+    def encode_batch(self, frames):
+        return [frame.json for frame in frames]
+
+class FakeFrame:
+    encoder = FakeEncoder()
+
+    def __init__(self, value):
+        self.json = value
+        self.binary = value
+        self.published = 0
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def send(self, message, text=None):
+        self.sent.append(message)
+
+    async def close(self, code, reason):
+        self.closed = code
+
+class ClosedWebSocket(FakeWebSocket):
+    async def send(self, message, text=None):
+        # The client went away while the frame was on its way
+        await asyncio.sleep(0)
+        raise websockets.ConnectionClosed(None, None)
+
+class TestBroadcastHub(unittest.IsolatedAsyncioTestCase):
+    async def test_publish_to_all(self):
+        hub = BroadcastHub()
+        sockets = [FakeWebSocket(), FakeWebSocket()]
+        tasks = [asyncio.create_task(hub.subscribe(ws).run()) for ws in sockets]
+        for i in range(3):
+            hub.publish(FakeFrame(i))
+        await asyncio.sleep(0)
+        for ws in sockets:
+            self.assertEqual(ws.sent, [0, 1, 2])
+        for task in tasks:
+            task.cancel()
+
+    def test_drop_oldest(self):
+        subscriber = BroadcastHub(queue_size=2, policy=DROP_OLDEST).subscribe(FakeWebSocket())
+        for i in range(5):
+            subscriber.offer(FakeFrame(i))
+        self.assertEqual(subscriber.depth, 2)
+        self.assertEqual(subscriber.dropped, 3)
+
+    async def test_latest(self):
+        ws = FakeWebSocket()
+        subscriber = BroadcastHub(queue_size=2, policy=LATEST).subscribe(ws)
+        for i in range(5):
+            subscriber.offer(FakeFrame(i))
+        task = asyncio.create_task(subscriber.run())
+        await asyncio.sleep(0)
+        self.assertEqual(ws.sent, [4])
+        task.cancel()
+
+    async def test_disconnect_slow_client(self):
+        hub = BroadcastHub(queue_size=2, policy=DISCONNECT)
+        slow, fast = FakeWebSocket(), FakeWebSocket()
+        slow_subscriber = hub.subscribe(slow)
+        fast_task = asyncio.create_task(hub.subscribe(fast).run())
+        for i in range(3):
+            hub.publish(FakeFrame(i))
+            await asyncio.sleep(0)
+        self.assertNotIn(slow_subscriber, hub.subscribers)
+        await slow_subscriber.run()
+        self.assertEqual(slow.closed, 1013)
+        self.assertEqual(fast.sent, [0, 1, 2])
+        fast_task.cancel()
+
+    async def test_client_closed_during_publish(self):
+        hub = BroadcastHub()
+        closed, connected = ClosedWebSocket(), FakeWebSocket()
+        tasks = [asyncio.create_task(hub.subscribe(ws).run()) for ws in (closed, connected)]
+        hub.publish(FakeFrame(0))
+        hub.publish(FakeFrame(1))
+        await asyncio.sleep(0.01)
+
+        # The send loop ended cleanly and the hub forgot the subscriber
+        self.assertTrue(tasks[0].done())
+        self.assertIsNone(tasks[0].exception())
+        self.assertEqual([subscriber.websocket for subscriber in hub.subscribers], [connected])
+
+        hub.publish(FakeFrame(2))
+        await asyncio.sleep(0)
+        self.assertEqual(connected.sent, [0, 1, 2])
+        tasks[1].cancel()
+
+    async def test_batch_size(self):
+        hub = BroadcastHub()
+        ws = FakeWebSocket()
+        subscriber = hub.subscribe(ws)
+        subscriber.configure_batching(3, 10)
+        task = asyncio.create_task(subscriber.run())
+        for i in range(7):
+            hub.publish(FakeFrame(i))
+            await asyncio.sleep(0)
+        self.assertEqual(ws.sent, [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(subscriber.samples_sent, 6)
+        task.cancel()
+
+    async def test_batch_interval(self):
+        hub = BroadcastHub()
+        ws = FakeWebSocket()
+        subscriber = hub.subscribe(ws)
+        subscriber.configure_batching(100, 0.02)
+        task = asyncio.create_task(subscriber.run())
+        hub.publish(FakeFrame(0))
+        hub.publish(FakeFrame(1))
+        await asyncio.sleep(0.01)
+        self.assertEqual(ws.sent, [])
+        await asyncio.sleep(0.03)
+        self.assertEqual(ws.sent, [[0, 1]])
+        self.assertEqual(subscriber.stats()['messages_sent'], 1)
+        task.cancel()
+
+    async def test_control_before_frames(self):
+        ws = FakeWebSocket()
+        subscriber = BroadcastHub().subscribe(ws)
+        subscriber.offer(FakeFrame(0))
+        subscriber.send_control('SCHEMA')
+        task = asyncio.create_task(subscriber.run())
+        await asyncio.sleep(0)
+        self.assertEqual(ws.sent, ['SCHEMA', 0])
+        task.cancel()
+
+if __name__ == '__main__':
+    unittest.main()
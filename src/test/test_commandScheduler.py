@@ -0,0 +1,103 @@
+import json
+import asyncio
+import unittest
+from serialInterface.commandScheduler import CommandScheduler, COALESCED, SUPPRESSED, ABORTED
+
+def valve_command(valve, action):
+    return json.dumps({'command': 'CTRL', 'valve': valve, 'action': action})
+
+class TestCommandScheduler(unittest.TestCase):
+    def setUp(self):
+        self.reports = asyncio.Queue()
+        self.scheduler = CommandScheduler(self.reports)
+
+    def drain(self):
+        async def drain():
+            return [await self.scheduler.get() for _ in range(self.scheduler.pending)]
+        return asyncio.run(drain())
+
+    def test_first_in_first_out(self):
+        self.scheduler.put(valve_command('MEV', 'OPEN'))
+        self.scheduler.put(valve_command('NCV', 'OPEN'))
+        self.scheduler.put(valve_command('RTV', 'CLOSE'))
+        self.assertEqual([c.message['valve'] for c in self.drain()], ['MEV', 'NCV', 'RTV'])
+
+    def test_abort_skips_the_queue(self):
+        self.scheduler.put(valve_command('MEV', 'OPEN'))
+        self.scheduler.put(valve_command('NCV', 'OPEN'))
+        self.scheduler.put('{"command": "UNABORT"}')
+        commands = self.drain()
+        self.assertEqual([c.command for c in commands], ['UNABORT', 'CTRL', 'CTRL'])
+        self.assertTrue(commands[0].priority)
+
+    def test_abort_drops_the_queue(self):
+        self.scheduler.put(valve_command('MEV', 'OPEN'))
+        self.scheduler.put(valve_command('NCV', 'OPEN'))
+        self.scheduler.put('{"command": "ABORT"}')
+        self.assertEqual([c.command for c in self.drain()], ['ABORT'])
+
+        reports = [self.reports.get_nowait() for _ in range(self.reports.qsize())]
+        self.assertEqual([(r['command'], r['valve'], r['action']) for r in reports],
+                         [(ABORTED, 'MEV', 'OPEN'), (ABORTED, 'NCV', 'OPEN')])
+
+        # The valves can be queued again
+        self.scheduler.put(valve_command('MEV', 'CLOSE'))
+        self.assertEqual(self.scheduler.pending, 1)
+        self.assertTrue(self.reports.empty())
+
+    def test_get_wakes_on_put(self):
+        async def run():
+            waiter = asyncio.create_task(self.scheduler.get())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            self.scheduler.put('{"command": "UNABORT"}')
+            return await asyncio.wait_for(waiter, 1)
+        self.assertEqual(asyncio.run(run()).command, 'UNABORT')
+
+    def test_coalesce_per_valve(self):
+        self.scheduler.put(valve_command('MEV', 'OPEN'))
+        self.scheduler.put(valve_command('NCV', 'OPEN'))
+        self.scheduler.put(valve_command('MEV', 'CLOSE'))
+        commands = self.drain()
+        self.assertEqual([(c.message['valve'], c.message['action']) for c in commands],
+                         [('MEV', 'CLOSE'), ('NCV', 'OPEN')])
+        report = self.reports.get_nowait()
+        self.assertEqual((report['command'], report['valve'], report['action']), (COALESCED, 'MEV', 'OPEN'))
+        self.assertTrue(self.reports.empty())
+
+    def test_valve_queued_again_after_get(self):
+        self.scheduler.put(valve_command('MEV', 'OPEN'))
+        self.drain()
+        self.scheduler.put(valve_command('MEV', 'CLOSE'))
+        self.assertEqual(self.scheduler.pending, 1)
+        self.assertTrue(self.reports.empty())
+
+    def test_report(self):
+        self.scheduler.report(SUPPRESSED, {'command': 'CTRL', 'valve': 'MEV', 'action': 'OPEN'})
+        self.assertEqual(self.reports.get_nowait()['command'], SUPPRESSED)
+
+    def test_latency_stats(self):
+        self.scheduler.put('{"command": "ABORT"}')
+        command = self.drain()[0]
+        latency = self.scheduler.record_write(command)
+        stats = self.scheduler.latency_stats()['ABORT']
+        self.assertEqual(stats['count'], 1)
+        self.assertAlmostEqual(stats['last_ms'], latency * 1000)
+
+    def test_invalid_command(self):
+        with self.assertRaises(ValueError):
+            self.scheduler.put('not json')
+        with self.assertRaises(ValueError):
+            self.scheduler.put('{"valve": "MEV"}')
+
+        # Valve commands need a known valve and action
+        for message in ({'command': 'CTRL', 'valve': 'MEV'},
+                        {'command': 'CTRL', 'valve': 'MEV', 'action': 'AJAR'},
+                        {'command': 'CTRL', 'valve': 'XYZ', 'action': 'OPEN'},
+                        {'command': 'CTRL', 'valve': ['MEV'], 'action': 'OPEN'}):
+            with self.assertRaises(ValueError):
+                self.scheduler.put(json.dumps(message))
+        self.assertEqual(self.scheduler.pending, 0)
+
+if __name__ == '__main__':
+    unittest.main()
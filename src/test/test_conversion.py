@@ -0,0 +1,119 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'instrumentation'))
+
+from conversion import ConversionEngine, ScanAssembler
+import numpy as np
+from thermocouple import V_to_K, V_to_K_array
+
+SENSORS = [('P_INJECTOR', 'AIN82', 100.0, 0, 'Pa'),
+           ('L_THRUST',   'AIN87', 10.0, -2.0, 'N'),
+           ('T_INJECTOR', 'AIN57', None, None, 'K')]
+
+class TestConversionEngine(unittest.TestCase):
+    def setUp(self):
+        self.engine = ConversionEngine(SENSORS)
+
+    def test_gains_and_offsets(self):
+        values = {'AIN82': [1.0, 3.0], 'AIN87': [0.5, 0.5], 'AIN57': [0.001, 0.001]}
+        converted = self.engine.convert(values, 0.0)
+        self.assertEqual(list(converted), ['P_INJECTOR', 'L_THRUST', 'T_INJECTOR'])
+        self.assertAlmostEqual(converted['P_INJECTOR'], 200.0)
+        self.assertAlmostEqual(converted['L_THRUST'], 3.0)
+        self.assertAlmostEqual(converted['T_INJECTOR'], V_to_K(0.001, 0.0))
+
+    def test_stack_keeps_complete_scans(self):
+        values = {'AIN82': [1.0, 2.0], 'AIN87': [1.0], 'AIN57': [1.0, 2.0]}
+        self.assertEqual(self.engine.stack(values).shape, (3, 1))
+
+    def test_thermocouples_ignore_out_of_range_samples(self):
+        values = {'AIN82': [0.0, 0.0], 'AIN87': [0.0, 0.0], 'AIN57': [0.001, 1.0]}
+        converted = self.engine.convert(values, 0.0)
+        self.assertAlmostEqual(converted['T_INJECTOR'], V_to_K(0.001, 0.0))
+
+    def test_convert_samples_keeps_every_sample(self):
+        samples = np.array([[1.0, 3.0], [0.5, 1.5], [0.001, 1.0]])
+        converted = self.engine.convert_samples(samples, 0.0)
+        self.assertEqual(converted.shape, (2, 3))
+        self.assertEqual(converted[:, 0].tolist(), [100.0, 300.0])
+        self.assertEqual(converted[:, 1].tolist(), [3.0, 13.0])
+        self.assertTrue(np.isnan(converted[1, 2]))
+
+    def test_reduce_matches_convert(self):
+        values = {'AIN82': [1.0, 3.0], 'AIN87': [0.5, 1.5], 'AIN57': [0.001, 0.002]}
+        samples = self.engine.convert_samples(self.engine.stack(values), 0.0)
+        self.assertEqual(self.engine.reduce(samples).tolist(), list(self.engine.convert(values, 0.0).values()))
+
+class TestScanAssembler(unittest.TestCase):
+    def test_partial_scans_carry_over(self):
+        scans = ScanAssembler(['AIN0', 'AIN1'])
+        first = scans.push({'AIN0': [1.0, 3.0], 'AIN1': [2.0]})
+        self.assertEqual(first.tolist(), [[1.0], [2.0]])
+        second = scans.push({'AIN0': [5.0], 'AIN1': [4.0, 6.0]})
+        self.assertEqual(second.tolist(), [[3.0, 5.0], [4.0, 6.0]])
+        self.assertEqual(scans.scans, 3)
+
+    def test_skip_drops_scans_across_the_gap(self):
+        # Stream order AIN1 first, the assembler rows are in sensor order
+        scans = ScanAssembler(['AIN0', 'AIN1', 'AIN2'], ['AIN1', 'AIN0', 'AIN2'])
+        scans.push({'AIN0': [2.0], 'AIN1': [1.0, 4.0], 'AIN2': [3.0]})
+
+        # Scan 1 has AIN1, the gap takes the rest of it, scan 2 and AIN1 of
+        # scan 3, so scans 1 to 3 are lost and AIN0 starts the next packet
+        self.assertEqual(scans.skip(6), 3)
+        samples = scans.push({'AIN0': [12.0, 15.0], 'AIN1': [14.0], 'AIN2': [13.0, 16.0]})
+        self.assertEqual(samples.tolist(), [[15.0], [14.0], [16.0]])
+        self.assertEqual(scans.scans, 5)
+
+    def test_skip_whole_scans(self):
+        scans = ScanAssembler(['AIN0', 'AIN1'])
+        scans.push({'AIN0': [1.0], 'AIN1': [2.0]})
+        self.assertEqual(scans.skip(4), 2)
+        self.assertEqual(scans.push({'AIN0': [7.0], 'AIN1': [8.0]}).tolist(), [[7.0], [8.0]])
+        self.assertEqual(scans.scans, 4)
+
+# The NIST K-type inverse coefficients in C per mV**n, evaluated as a plain
+# power series like the original per sample V_to_K
+POWER_SERIES = [
+    (-5.891, 0.0, [0, 25.173462, -1.1662878, -1.0833638, -0.89773540, -0.37342377,
+                   -0.086632643, -0.010450598, -0.00051920577, 0]),
+    (0.0, 20.644, [0, 25.08355, 0.07860106, -0.2503131, 0.08315270, -0.01228034,
+                   0.0009804036, -0.00004413030, 0.000001057734, -0.00000001052755]),
+    (20.644, 54.886, [-131.8058, 48.30222, -1.646031, 0.05464731, -0.0009650715,
+                      0.000008802193, -0.00000003110810, 0, 0, 0])]
+
+def power_series_K(voltage):
+    mV = voltage * 1000
+    for low, high, coeffs in POWER_SERIES:
+        if low <= mV < high:
+            return sum(c * mV**n for n, c in enumerate(coeffs)) + 273.15
+
+class TestThermocouple(unittest.TestCase):
+    def test_matches_power_series(self):
+        # Both edges of every segment and points inside them
+        voltages = [-0.005890, -0.0045, -0.002, -1e-9, 0.0, 1e-9, 0.004, 0.012, 0.020643,
+                    0.020644, 0.020645, 0.03, 0.045, 0.054885]
+        kelvin = V_to_K_array(voltages, 0.0)
+        for voltage, k in zip(voltages, kelvin):
+            self.assertAlmostEqual(k, power_series_K(voltage), places=9, msg=voltage)
+
+    def test_nist_table(self):
+        # NIST ITS-90 K-type table, mV at the temperature in C. The inverse
+        # polynomials are within 0.06 C of it
+        table = {-200: -5.891, -100: -3.554, 0: 0.0, 100: 4.096, 250: 10.153,
+                 500: 20.644, 750: 31.213, 1000: 41.276, 1300: 52.410}
+        kelvin = V_to_K_array(np.array(list(table.values())) / 1000, 0.0)
+        for celsius, k in zip(table, kelvin):
+            self.assertAlmostEqual(k - 273.15, celsius, delta=0.1, msg=celsius)
+
+        # The cold junction voltage is added before converting
+        self.assertAlmostEqual(V_to_K(0.004096 - 0.001, 0.001) - 273.15, 100, delta=0.1)
+
+    def test_out_of_range(self):
+        self.assertTrue(np.isnan(V_to_K_array([0.06], 0.0)[0]))
+        self.assertEqual(V_to_K(0.06, 0.0), 0)
+
+if __name__ == '__main__':
+    unittest.main()
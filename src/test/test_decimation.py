@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+from server.decimation import MinMaxDecimator
+
+class TestMinMaxDecimator(unittest.TestCase):
+    def test_envelope_keeps_spikes(self):
+        decimator = MinMaxDecimator(10)
+        timestamps = np.arange(0, 0.3, 0.001)
+        values = np.zeros((len(timestamps), 2))
+        values[150, 0] = 1000.0
+        values[160, 1] = -5.0
+        times, mins, maxs = decimator.update(timestamps, values)
+        np.testing.assert_allclose(times, [0.0, 0.1])
+        self.assertEqual(maxs[1, 0], 1000.0)
+        self.assertEqual(mins[1, 1], -5.0)
+        times, mins, maxs = decimator.update(np.array([0.31]), np.zeros((1, 2)))
+        np.testing.assert_allclose(times, [0.2])
+
+    def test_incremental_matches_single_update(self):
+        timestamps = np.linspace(0, 1, 1001)
+        values = np.random.default_rng(0).normal(size=(1001, 3))
+        whole = MinMaxDecimator(20).update(timestamps, values)
+
+        decimator = MinMaxDecimator(20)
+        parts = [decimator.update(timestamps[i:i + 12], values[i:i + 12]) for i in range(0, 1001, 12)]
+        np.testing.assert_allclose(np.concatenate([p[0] for p in parts]), whole[0])
+        np.testing.assert_allclose(np.vstack([p[1] for p in parts]), whole[1])
+        np.testing.assert_allclose(np.vstack([p[2] for p in parts]), whole[2])
+
+    def test_nan_ignored(self):
+        decimator = MinMaxDecimator(1)
+        values = np.array([[1.0], [np.nan], [3.0], [0.0]])
+        times, mins, maxs = decimator.update(np.array([0.1, 0.2, 0.3, 1.5]), values)
+        self.assertEqual((mins[0, 0], maxs[0, 0]), (1.0, 3.0))
+
+if __name__ == '__main__':
+    unittest.main()
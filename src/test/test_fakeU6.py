@@ -0,0 +1,234 @@
+import os
+import io
+import sys
+import tempfile
+import unittest
+import contextlib
+import numpy as np
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'instrumentation'))
+
+from fake_u6 import FakeU6, AUTO_RECOVER_END_OVERFLOW
+from conversion import ScanAssembler, ConversionEngine
+from ring_buffer import RingBufferWriter, RingBufferReader, ACQUISITION_STATUS
+from recording import RecordingWriter, open_recording
+from archive import ArchiveReader
+from stage_queue import StageQueue, BLOCK, DROP_NEWEST
+import read_labjack
+
+X1 = 0b00000000
+X100 = 0b00100000
+
+def configure(d, channels=3, samples_per_packet=10, scan_frequency=1000):
+    d.streamConfig(
+        ScanFrequency=scan_frequency,
+        ChannelNumbers=list(range(channels)),
+        ChannelOptions=[X100] + [X1] * (channels - 1),
+        NumChannels=channels,
+        SamplesPerPacket=samples_per_packet)
+    d.streamStart()
+
+def constant(channel, times, rng):
+    return times * 0 + 0.1 * (channel + 1)
+
+class TestFakeU6(unittest.TestCase):
+    def test_packets_and_channel_order(self):
+        d = FakeU6(packets_per_request=4, realtime=False, signal=constant)
+        configure(d)
+        readings = d.streamData(convert=False)
+        scans = ScanAssembler(['AIN0', 'AIN1', 'AIN2'])
+
+        # 10 samples per packet leaves a partial scan at the end of every packet
+        for _ in range(3):
+            reading = next(readings)
+            self.assertEqual(len(reading['result']), 4 * (14 + 2 * 10))
+            samples = scans.push(d.processStreamData(reading['result']))
+            self.assertAlmostEqual(samples[0].max(), 0.01, places=4)
+            self.assertAlmostEqual(samples[1].min(), 2.0, places=3)
+            self.assertAlmostEqual(samples[2].min(), 3.0, places=3)
+
+        self.assertEqual(reading['firstPacket'], 8)
+        self.assertEqual(scans.scans, 40)
+
+    def test_injected_missed_and_errors(self):
+        d = FakeU6(packets_per_request=4, realtime=False)
+        configure(d)
+        readings = d.streamData(convert=False)
+        next(readings)
+
+        d.inject_missed(5)
+        d.inject_error(48, packets=2)
+        reading = next(readings)
+        self.assertEqual(reading['missed'], 5)
+        self.assertEqual(reading['errors'], 2)
+        self.assertEqual(reading['result'][11], AUTO_RECOVER_END_OVERFLOW)
+        self.assertEqual(d.missed, 5)
+
+        # Part way through a reading
+        d.inject_missed(3, packet=2)
+        packets = np.frombuffer(next(readings)['result'], dtype=np.uint8).reshape(4, -1)
+        self.assertEqual(packets[:, 11].tolist(), [0, 0, AUTO_RECOVER_END_OVERFLOW, 0])
+        self.assertEqual(packets[2, 6:10].view('<u4')[0], 3)
+
+    def test_backlog_overflows_buffer(self):
+        d = FakeU6(packets_per_request=1, buffer_samples=300)
+        configure(d)
+        readings = d.streamData()
+
+        d.inject_backlog(0.05)
+        reading = next(readings)
+        self.assertGreater(reading['backlog'], 0)
+        self.assertEqual(reading['missed'], 0)
+
+        # A second of scans is far more than 300 samples
+        d.inject_backlog(1)
+        reading = next(readings)
+        self.assertGreater(reading['missed'], 800)
+        self.assertEqual(len(reading['AIN0']) + len(reading['AIN1']) + len(reading['AIN2']), 10)
+
+    def test_lost_packets_skip_packet_numbers(self):
+        d = FakeU6(packets_per_request=4, realtime=False, signal=constant)
+        configure(d)
+        readings = d.streamData(convert=False)
+        next(readings)
+
+        d.inject_lost_packets(2)
+        reading = next(readings)
+        self.assertEqual(reading['firstPacket'], 6)
+        self.assertEqual(reading['missed'], 0)
+        self.assertEqual(d.lost, 2)
+
+    def test_missed_mid_reading(self):
+        # Every sample is the time it was taken in volts, so a sample put on
+        # the wrong side of the gap shows in its value
+        d = FakeU6(packets_per_request=4, realtime=False, signal=lambda channel, times, rng: times / 10)
+        configure(d)
+        readings = d.streamData(convert=False)
+        engine = ConversionEngine([('A', 'AIN1', 1.0, 0, 'V'), ('B', 'AIN2', 1.0, 0, 'V')])
+        scans = ScanAssembler(engine.channels, ['AIN0', 'AIN1', 'AIN2'])
+        status = {name: 0 for name in ACQUISITION_STATUS}
+        settings = {'channel_settings': [(0, X100), (1, X1), (2, X1)], 'samples_per_packet': 10, 'scan_frequency': 1000}
+
+        def decode():
+            packets = np.frombuffer(next(readings)['result'], dtype=np.uint8).reshape(-1, 14 + 2 * 10)
+            return read_labjack.decode_reading(d, engine, 0.0, scans, packets, 0, status, 100.0)
+
+        with mock.patch.multiple(read_labjack, **settings), contextlib.redirect_stdout(io.StringIO()):
+            segments = decode()
+            d.inject_missed(7, packet=2)
+            segments += decode()
+
+        # The first two packets of the second reading end on scan 20, the
+        # missed scans come after them
+        self.assertEqual([gap for gap, _, _ in segments], [None, None, 100.02])
+        self.assertEqual(segments[2][1][0], 100.027)
+        self.assertEqual(status['missed_scans'], 7)
+        for _, timestamps, samples in segments:
+            np.testing.assert_allclose(samples[:, 0], timestamps - 100.0, atol=0.5e-3)
+            np.testing.assert_allclose(samples[:, 1], timestamps - 100.0, atol=0.5e-3)
+
+    def test_dropped_readings_past_packet_number_wrap(self):
+        d = FakeU6(packets_per_request=48, realtime=False)
+        channels = len(read_labjack.channel_settings)
+        slot_size = 8 * read_labjack.READING_HEADER_WORDS + 48 * (14 + 2 * read_labjack.samples_per_packet)
+        readings = StageQueue(1, slot_size, DROP_NEWEST)
+        taken = []
+
+        # Reading 1 waits in the queue while readings 2 to 7, 288 packets,
+        # are dropped. Then it is taken so reading 8 fits.
+        def signal(channel, times, rng):
+            if channel == 0 and d.packets == 7 * 48:
+                taken.append(bytes(readings.get()))
+                readings.release()
+                d.streamStop()
+            return times * 0
+
+        d.signal = signal
+        read_labjack.configure_stream(d)
+        d.streamStart()
+        read_labjack.read_stage(d, readings, [])
+        self.assertEqual(readings.stats()['dropped'], 6)
+
+        queues = {'convert': StageQueue(3, slot_size, BLOCK),
+                  'record': StageQueue(4, 1 << 16, BLOCK),
+                  'publish': StageQueue(4, 1 << 16, BLOCK)}
+        queues['convert'].put(taken[0])
+        queues['convert'].put(readings.get())
+        queues['convert'].end()
+        engine = ConversionEngine(read_labjack.sensors)
+        with contextlib.redirect_stdout(io.StringIO()):
+            read_labjack.convert_stage(d, engine, 0.0, queues, 100.0, 0.0)
+
+        queues['record'].get()
+        _, status, timestamps, values = read_labjack.parse_frame_message(queues['record'].get(), channels)
+        status = dict(zip(ACQUISITION_STATUS, status.tolist()))
+        self.assertEqual(status['lost_packets'], 288)
+        self.assertEqual(status['gaps'], 1)
+
+        # 576 samples then 3456 skipped: 52 scans, 4 samples of a partial
+        # scan, then the scan clock jumps to scan 367
+        self.assertTrue(np.isnan(values[0]).all())
+        self.assertAlmostEqual((timestamps[1] - 100.0) * read_labjack.scan_frequency, 367)
+        for queue in (readings, *queues.values()):
+            queue.close()
+
+    def test_stream_marks_gaps(self):
+        d = FakeU6(packets_per_request=4, realtime=False)
+
+        # Stops the stream once enough has been sampled, losing packets on
+        # the way so both kinds of gap are seen
+        def signal(channel, times, rng):
+            if channel == 0 and len(times) and times[0] > 0.05 and not d.lost:
+                d.inject_lost_packets(3)
+            if times[-1:] > 0.2:
+                d.streamStop()
+            return times * 0
+
+        d.signal = signal
+        d.inject_missed(7)
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            engine = ConversionEngine(read_labjack.sensors)
+            ring = RingBufferWriter(engine.names, name=f'pdp_test_gap_ring_{os.getpid()}')
+            reader = RingBufferReader(f'pdp_test_gap_ring_{os.getpid()}')
+            path = os.path.join(directory, 'gaps.pdprec')
+            recording = RecordingWriter(path, engine.schema())
+            read_labjack.archive_path = os.path.join(directory, 'gaps.pdparc')
+            read_labjack.configure_stream(d)
+            d.streamStart()
+            try:
+                read_labjack.stream(d, engine, 0.0, recording, ring, 100.0, 0.0)
+            finally:
+                recording.close()
+                status = reader.status()
+                reader.close()
+                ring.close()
+
+            header, frames = open_recording(path)
+            gaps = np.isnan(frames['values']).all(axis=1)
+            times = np.asarray(frames['timestamp'])
+
+            archive = ArchiveReader(read_labjack.archive_path)
+            archived_times, archived_values = archive.read()
+            archive.close()
+
+        # The archive holds the same frames, gap markers included
+        np.testing.assert_array_equal(archived_times, times)
+        np.testing.assert_array_equal(archived_values, frames['values'])
+
+        self.assertEqual(status['gaps'], 2)
+        self.assertEqual(status['missed_scans'], 7)
+        self.assertEqual(status['lost_packets'], 3)
+
+        # The missed scans come before the first packet. The lost packets
+        # take 36 samples, with the partial scan before them 4 scans of 11
+        # channels, so the scan clock jumps by 5 once
+        scans = (times[~gaps] - 100.0) * read_labjack.scan_frequency
+        self.assertEqual(times[gaps][0], 100.0)
+        self.assertAlmostEqual(scans[0], 7)
+        self.assertTrue(np.allclose(scans, np.round(scans)))
+        steps = np.diff(np.round(scans))
+        self.assertEqual(sorted(set(steps.tolist())), [1.0, 5.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import struct
+import unittest
+import numpy as np
+from server.frameEncoder import InstrumentationFrameEncoder, InstrumentationFrame
+
+class TestInstrumentationFrameEncoder(unittest.TestCase):
+    def setUp(self):
+        self.encoder = InstrumentationFrameEncoder(['P_INJECTOR', 'T_INJECTOR'], ['Pa', 'K'])
+
+    def test_matches_json_dumps(self):
+        values = [123456.789, 1e-12]
+        expected = json.dumps({
+            "identifier": "INSTRUMENTATION",
+            "data": {'P_INJECTOR': values[0], 'T_INJECTOR': values[1]}
+        })
+        self.assertEqual(self.encoder.encode(values), expected.encode())
+
+    def test_non_finite(self):
+        # JSON.parse rejects NaN and Infinity, so does a strict parser
+        def strict(message):
+            return json.loads(message, parse_constant=lambda constant: self.fail(f"{constant} in {message}"))
+
+        frame = strict(self.encoder.encode([float('nan'), float('inf')]))
+        self.assertEqual(frame['data'], {'P_INJECTOR': None, 'T_INJECTOR': None})
+
+        frames = [InstrumentationFrame(self.encoder, i, float(i), [float('nan'), 1.0]) for i in range(2)]
+        batch = strict(self.encoder.encode_batch(frames))
+        self.assertEqual(batch['data'], {'P_INJECTOR': [None, None], 'T_INJECTOR': [1.0, 1.0]})
+
+        envelope = strict(self.encoder.encode_envelope(
+            np.array([0.0, 1.0]), np.array([[np.nan, 1.0], [2.0, -np.inf]]), np.array([[np.nan, 1.0], [3.0, 4.0]])))
+        self.assertEqual(envelope['min'], {'P_INJECTOR': [None, 2.0], 'T_INJECTOR': [1.0, None]})
+        self.assertEqual(envelope['max']['P_INJECTOR'], [None, 3.0])
+
+    def test_binary_matches_schema(self):
+        schema = json.loads(self.encoder.schema())
+        self.assertEqual(schema['fields'], ['sequence', 'timestamp', 'P_INJECTOR', 'T_INJECTOR'])
+        self.assertEqual(schema['units'][2:], ['Pa', 'K'])
+        frame = InstrumentationFrame(self.encoder, 7, 12.5, [1.5, 300.25])
+        self.assertEqual(len(frame.binary), schema['size'])
+        self.assertEqual(struct.unpack(schema['struct'], frame.binary), (7, 12.5, 1.5, 300.25))
+        self.assertIs(frame.binary, frame.binary)
+
+    def test_batches(self):
+        frames = [InstrumentationFrame(self.encoder, i, float(i), [i, 2.0 * i]) for i in range(3)]
+        batch = json.loads(self.encoder.encode_batch(frames))
+        self.assertEqual(batch['sequence'], [0, 1, 2])
+        self.assertEqual(batch['data']['T_INJECTOR'], [0.0, 2.0, 4.0])
+
+        packed = self.encoder.encode_batch_binary(frames)
+        count, = struct.unpack_from('<I', packed)
+        values = np.frombuffer(packed, dtype='<f4', offset=4 + 16 * count)
+        self.assertEqual(values.tolist(), [0, 1, 2, 0, 2, 4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import struct
+import tempfile
+import unittest
+import numpy as np
+from unittest import mock
+from instrumentation.archive import ArchiveWriter
+from server.historyQuery import HistoryArchive, HistoryQuery
+
+CHANNELS = [{'name': 'P_INJECTOR', 'unit': 'Pa', 'gain': 2.0},
+            {'name': 'T_INJECTOR', 'unit': 'K', 'gain': None}]
+
+class TestHistoryQuery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.pdparc')
+
+        # 20 s at 1 kHz with a gap marker at 1005 s
+        self.timestamps = 1000.0 + np.arange(20000) / 1000
+        self.values = np.column_stack([np.arange(20000.0), np.full(20000, 300.0)])
+        self.values[5000] = np.nan
+        archive = ArchiveWriter(self.path, CHANNELS, 'float64')
+        archive.write_frames(self.timestamps, self.values)
+        archive.close()
+        self.archive = HistoryArchive(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def reply(self, request):
+        # Strict like JSON.parse, NaN is not JSON
+        def reject(constant):
+            raise ValueError(f"{constant} is not JSON")
+
+        query = HistoryQuery(self.archive, dict(request, identifier="HISTORY"))
+        return [json.loads(message, parse_constant=reject) for reply in query.messages() for message in reply]
+
+    def test_every_frame_in_chunks(self):
+        with mock.patch('server.historyQuery.HISTORY_MESSAGE_POINTS', 1500):
+            messages = self.reply({"id": 7, "channel": "P_INJECTOR", "start": 1004.0, "end": 1007.999})
+
+        self.assertEqual([len(message["data"]) for message in messages[:-1]], [1500, 1500, 1000])
+        self.assertEqual(messages[-1], {"identifier": "HISTORY_END", "id": 7, "channel": "P_INJECTOR", "resolution": 0.0, "points": 4000})
+
+        data = [value for message in messages[:-1] for value in message["data"]]
+        timestamps = [value for message in messages[:-1] for value in message["timestamp"]]
+        self.assertEqual(timestamps, self.timestamps[4000:8000].tolist())
+        self.assertIsNone(data[1000])
+        self.assertEqual(data[1001], 5001.0)
+
+    def test_resolution(self):
+        messages = self.reply({"channel": "P_INJECTOR", "start": 1004.0, "end": 1006.0, "resolution": 0.5})
+        self.assertEqual(messages[0]["timestamp"], [1004.0, 1004.5, 1005.0, 1005.5, 1006.0])
+        self.assertEqual(messages[0]["min"][2], 5001.0)
+        self.assertEqual(messages[0]["max"][2], 5499.0)
+        self.assertEqual(messages[0]["mean"][2], 5250.0)
+
+        # Whole chunks from the index
+        messages = self.reply({"channel": "T_INJECTOR", "resolution": 5})
+        self.assertEqual(messages[0]["timestamp"], [1000.0, 1005.0, 1010.0, 1015.0])
+        self.assertEqual(messages[0]["mean"], [300.0] * 4)
+        self.assertEqual(messages[-1]["points"], 4)
+
+    def test_binary(self):
+        query = HistoryQuery(self.archive, {"id": "a", "channel": "P_INJECTOR", "start": 1004.0, "end": 1006.0, "resolution": 0.5}, binary=True)
+        replies = list(query.messages())
+        self.assertEqual(len(replies), 2)
+
+        header, message = replies[0]
+        self.assertEqual(json.loads(header)["points"], 5)
+        self.assertEqual(struct.unpack_from('<I', message)[0], 5)
+        timestamps = np.frombuffer(message, dtype='<f8', count=5, offset=4)
+        minimum, maximum, mean = np.frombuffer(message, dtype='<f4', offset=44).reshape(3, 5)
+        self.assertEqual(timestamps.tolist(), [1004.0, 1004.5, 1005.0, 1005.5, 1006.0])
+        self.assertEqual(minimum[2], 5001.0)
+        self.assertEqual(mean[2], 5250.0)
+        self.assertEqual(json.loads(replies[1][0])["identifier"], "HISTORY_END")
+
+    def test_invalid_requests(self):
+        for request in ({"channel": "P_TANK"}, {"channel": None}, {"channel": "P_INJECTOR", "resolution": -1},
+                        {"channel": "P_INJECTOR", "start": 10, "end": 5}):
+            with self.assertRaises(ValueError):
+                HistoryQuery(self.archive, request)
+        with self.assertRaises(ValueError):
+            HistoryQuery(HistoryArchive(os.path.join(self.directory.name, 'missing.pdparc')), {"channel": "P_INJECTOR"})
+
+    def test_archive_written_between_queries(self):
+        archive = ArchiveWriter(self.path, CHANNELS, 'float64')
+        archive.start()
+        archive.write_frames(self.timestamps[:3500], self.values[:3500])
+        while archive.chunks_written < 3:
+            time.sleep(0.01)
+        reader = self.archive.reader()
+        self.assertEqual(len(reader.index), 3)
+
+        # The same reader, with the chunks written since
+        archive.write_frames(self.timestamps[3500:], self.values[3500:])
+        archive.close()
+        self.assertIs(self.archive.reader(), reader)
+        self.assertEqual(len(reader.index), 20)
+        messages = self.reply({"channel": "P_INJECTOR", "resolution": 1.0})
+        self.assertEqual(len(messages[0]["mean"]), 20)
+
+        # A new firing replaces the archive
+        archive = ArchiveWriter(self.path, CHANNELS, 'float64')
+        archive.close()
+        self.assertIsNot(self.archive.reader(), reader)
+        self.assertEqual(self.reply({"channel": "P_INJECTOR"})[-1]["points"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
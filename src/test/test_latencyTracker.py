@@ -0,0 +1,68 @@
+import time
+import asyncio
+import unittest
+from serialInterface.latencyTracker import LatencyTracker, LatencyHistogram
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.add(ms / 1000)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50_ms'], 50, delta=50 * 0.05)
+        self.assertAlmostEqual(summary['p99_ms'], 99, delta=99 * 0.05)
+        self.assertAlmostEqual(summary['max_ms'], 100)
+
+    def test_empty(self):
+        self.assertEqual(LatencyHistogram().percentile(50), 0.0)
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_confirmed_by_matching_state(self):
+        tracker = LatencyTracker()
+        tracker.sent('MEV', 'OPEN')
+        self.assertEqual(tracker.confirm({'MEV': 'CLOSE'}), {})
+        confirmed = tracker.confirm({'MEV': 'OPEN'})
+        self.assertIn('MEV', confirmed)
+        stats = tracker.stats()['valves']['MEV']
+        self.assertEqual(stats['count'], 1)
+        self.assertFalse(stats['pending'])
+
+    def test_superseded(self):
+        tracker = LatencyTracker()
+        tracker.sent('MEV', 'OPEN')
+        tracker.sent('MEV', 'CLOSE')
+        self.assertEqual(tracker.confirm({'MEV': 'OPEN'}), {})
+        self.assertEqual(tracker.stats()['valves']['MEV']['superseded'], 1)
+
+    def test_deadline(self):
+        tracker = LatencyTracker(deadline=0.01)
+        self.assertIsNone(tracker.next_deadline())
+        tracker.sent('NCV', 'OPEN')
+        self.assertEqual(tracker.expired(), [])
+        time.sleep(0.02)
+        self.assertEqual(tracker.next_deadline(), 0.0)
+        self.assertEqual(tracker.expired(), [('NCV', 'OPEN')])
+        self.assertEqual(tracker.stats()['valves']['NCV']['unconfirmed'], 1)
+        self.assertEqual(tracker.confirm({'NCV': 'OPEN'}), {})
+
+    def test_wait_wakes_on_sent(self):
+        tracker = LatencyTracker(deadline=0.05)
+
+        async def run():
+            waiter = asyncio.create_task(tracker.wait())
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            tracker.sent('MEV', 'OPEN')
+            await asyncio.wait_for(waiter, 1)
+
+            # Then sleeps until the deadline of the pending command
+            start = time.monotonic()
+            await asyncio.wait_for(tracker.wait(), 1)
+            return time.monotonic() - start
+
+        self.assertAlmostEqual(asyncio.run(run()), 0.05, delta=0.03)
+        self.assertEqual(tracker.expired(), [('MEV', 'OPEN')])
+
+if __name__ == '__main__':
+    unittest.main()
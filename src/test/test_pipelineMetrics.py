@@ -0,0 +1,61 @@
+import time
+import asyncio
+import unittest
+from logger.pipelineMetrics import PipelineMetrics, serve_metrics
+
+class TestPipelineMetrics(unittest.TestCase):
+    def test_snapshot(self):
+        metrics = PipelineMetrics()
+        metrics.count('commands.written')
+        metrics.count('commands.written', 2)
+        for ms in range(1, 101):
+            metrics.observe('serial.write', ms / 1000)
+        metrics.observe('serial.write', float('nan'))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['commands.written']['total'], 3)
+        stage = snapshot['stages']['serial.write']
+        self.assertEqual(stage['count'], 100)
+        self.assertAlmostEqual(stage['p50_ms'], 50, delta=2.5)
+        self.assertEqual(stage['window']['count'], 100)
+
+    def test_gauge(self):
+        metrics = PipelineMetrics()
+        for backlog in (3, 40, 7):
+            metrics.gauge('acquisition.backlog', backlog)
+        self.assertEqual(metrics.snapshot()['gauges']['acquisition.backlog'], {'value': 7, 'max': 40})
+
+    def test_sub_millisecond(self):
+        metrics = PipelineMetrics()
+        metrics.observe('instrumentation.handoff', 0.00002)
+        self.assertAlmostEqual(metrics.snapshot()['stages']['instrumentation.handoff']['p50_ms'], 0.02, delta=0.001)
+
+    def test_window_rotates(self):
+        metrics = PipelineMetrics(window=0.05)
+        metrics.observe('feedback.send', 0.001)
+        time.sleep(0.06)
+        metrics.observe('feedback.send', 0.002)
+        stage = metrics.snapshot()['stages']['feedback.send']
+        self.assertEqual(stage['count'], 2)
+        self.assertEqual(stage['window']['count'], 1)
+
+    def test_text_endpoint(self):
+        metrics = PipelineMetrics()
+        metrics.count('serial.lines', 7)
+
+        async def fetch():
+            server = await serve_metrics('localhost', 0, metrics)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection('localhost', port)
+                writer.write(b"GET / HTTP/1.0\r\n\r\n")
+                response = await reader.read()
+                writer.close()
+                return response.decode()
+
+        response = asyncio.run(fetch())
+        self.assertTrue(response.startswith("HTTP/1.0 200 OK"))
+        self.assertIn("counters.serial.lines.total 7\n", response)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import logging
+import tempfile
+import unittest
+from logger.queuedLogging import configure_log, read_binary_log, RateLimitFilter, TEXT_FORMAT, BINARY_FORMAT
+import logger.queuedLogging as queuedLogging
+
+class TestQueuedLogging(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        queuedLogging.shutdown()
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_text_with_fields(self):
+        log = configure_log('TestText', self.path('text.log'), log_format=TEXT_FORMAT)
+        log.info("Wrote %s", "VC,ABORT", extra={'fields': {'latency_ms': 0.5}})
+        queuedLogging.shutdown()
+        with open(self.path('text.log')) as file:
+            line = file.read()
+        self.assertIn('[TestText]', line)
+        self.assertIn('Wrote VC,ABORT {"latency_ms": 0.5}', line)
+
+    def test_binary_round_trip(self):
+        log = configure_log('TestBinary', self.path('binary.log'), log_format=BINARY_FORMAT)
+        log.info("Feedback", extra={'fields': {'MEV': 'OPEN'}})
+        log.warning("Unknown")
+        queuedLogging.shutdown()
+        entries = list(read_binary_log(self.path('binary.log')))
+        self.assertEqual([e['message'] for e in entries], ['Feedback', 'Unknown'])
+        self.assertEqual(entries[0]['fields'], {'MEV': 'OPEN'})
+        self.assertEqual(entries[1]['levelname'], 'WARNING')
+        self.assertIsNone(entries[1]['fields'])
+
+    def test_rate_limit(self):
+        limit = RateLimitFilter(rate=0, burst=2)
+        record = lambda level: logging.LogRecord('x', level, '', 0, 'msg', None, None)
+        self.assertTrue(limit.filter(record(logging.INFO)))
+        self.assertTrue(limit.filter(record(logging.INFO)))
+        self.assertFalse(limit.filter(record(logging.INFO)))
+        self.assertTrue(limit.filter(record(logging.ERROR)))
+        self.assertEqual(limit.suppressed, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import io
+import os
+import json
+import runpy
+import time
+import tempfile
+import contextlib
+import unittest
+import numpy as np
+from unittest import mock
+from instrumentation.recording import RecordingWriter, WriteBehindRecorder, open_recording, to_csv, to_json_lines, write_csv
+
+CHANNELS = [{'name': 'P_INJECTOR', 'unit': 'Pa', 'gain': 2.0},
+            {'name': 'T_INJECTOR', 'unit': 'K', 'gain': None}]
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.pdprec')
+        writer = RecordingWriter(self.path, CHANNELS, 'float64', metadata={'scan_frequency': 1000})
+        writer.write(1.0, [10.0, 300.0])
+        writer.write_frames(np.array([2.0, 3.0]), np.array([[20.0, 301.0], [30.0, 302.0]]))
+        writer.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_memmap(self):
+        header, frames = open_recording(self.path)
+        self.assertEqual(header['channels'], CHANNELS)
+        self.assertEqual(header['metadata']['scan_frequency'], 1000)
+        self.assertEqual(frames['timestamp'].tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(frames['values'][:, 1].tolist(), [300.0, 301.0, 302.0])
+
+    def test_partial_frame_ignored(self):
+        with open(self.path, 'ab') as file:
+            file.write(b'\x00' * 5)
+        header, frames = open_recording(self.path)
+        self.assertEqual(len(frames), 3)
+
+    def test_converters(self):
+        output = io.StringIO()
+        to_csv(self.path, output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'timestamp,P_INJECTOR,T_INJECTOR')
+        self.assertEqual(lines[1], '1.000000,10,300')
+
+        output = io.StringIO()
+        to_json_lines(self.path, output)
+        first = json.loads(output.getvalue().splitlines()[0])
+        self.assertEqual(first, {'P_INJECTOR': 10.0, 'T_INJECTOR': 300.0, 'timestamp': 1.0})
+
+    def test_json_lines_gap(self):
+        writer = RecordingWriter(self.path, CHANNELS, 'float64')
+        writer.write(1.0, [np.nan, np.inf])
+        writer.close()
+
+        # Strict like JSON.parse, NaN is not JSON
+        def reject(constant):
+            raise ValueError(f"{constant} is not JSON")
+
+        output = io.StringIO()
+        to_json_lines(self.path, output)
+        line = json.loads(output.getvalue(), parse_constant=reject)
+        self.assertEqual(line, {'P_INJECTOR': None, 'T_INJECTOR': None, 'timestamp': 1.0})
+
+    def test_command_line_to_stdout(self):
+        output = io.StringIO()
+        with mock.patch('sys.argv', ['recording.py', self.path, '--jsonl', '-']), \
+                contextlib.redirect_stdout(output):
+            runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                        'instrumentation', 'recording.py'), run_name='__main__')
+        self.assertFalse(output.closed)
+        self.assertEqual(len(output.getvalue().splitlines()), 3)
+
+    def test_csv_epoch_timestamps(self):
+        # Frames 1 ms apart on a real Unix time keep their own timestamp
+        output = io.StringIO()
+        timestamps = 1760725820.123 + np.arange(5) / 1000
+        write_csv(output, ['P_INJECTOR'], timestamps, np.arange(5.0).reshape(5, 1) + 0.5)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1:3], ['1760725820.123000,0.5', '1760725820.124000,1.5'])
+        self.assertEqual(len(set(line.split(',')[0] for line in lines[1:])), 5)
+
+class TestWriteBehindRecorder(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.pdprec')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_group_commit(self):
+        recorder = WriteBehindRecorder(RecordingWriter(self.path, CHANNELS), flush_interval=10)
+        recorder.start()
+        for i in range(100):
+            recorder.write_frames(np.array([float(i)]), np.array([[i, -i]]))
+
+        # Nothing is written until the flush interval or close
+        self.assertEqual(recorder.frames_written, 0)
+        self.assertEqual(recorder.status()['pending'], 100)
+        recorder.close()
+
+        header, frames = open_recording(self.path)
+        self.assertEqual(frames['timestamp'].tolist(), list(range(100)))
+        status = recorder.status()
+        self.assertEqual((status['pending'], status['pending_max']), (0, 100))
+        self.assertGreater(status['write_mb_per_s'], 0)
+
+    def test_flush_bytes_and_fsync(self):
+        recorder = WriteBehindRecorder(RecordingWriter(self.path, CHANNELS), flush_bytes=1, flush_interval=10, fsync_interval=0)
+        recorder.start()
+        recorder.write(1.0, [10.0, 300.0])
+        for _ in range(100):
+            if recorder.frames_written:
+                break
+            time.sleep(0.01)
+        self.assertEqual(recorder.frames_written, 1)
+        recorder.close()
+        self.assertGreater(recorder.status()['written_mb'], 0)
+
+    def test_fsync_without_more_frames(self):
+        writer = RecordingWriter(self.path, CHANNELS)
+        recorder = WriteBehindRecorder(writer, flush_bytes=1, flush_interval=10, fsync_interval=0.05)
+        with mock.patch.object(writer, 'sync', wraps=writer.sync) as sync:
+            recorder.start()
+            recorder.write(1.0, [10.0, 300.0])
+
+            # Written straight away, synced once the interval is up
+            for _ in range(100):
+                if sync.called:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(recorder.frames_written, 1)
+            self.assertEqual(sync.call_count, 1)
+
+            # Nothing left to sync
+            time.sleep(0.1)
+            self.assertEqual(sync.call_count, 1)
+            recorder.close()
+
+if __name__ == '__main__':
+    unittest.main()
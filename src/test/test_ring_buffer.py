@@ -0,0 +1,109 @@
+import os
+import time
+import unittest
+import numpy as np
+from instrumentation.ring_buffer import RingBufferWriter, RingBufferReader, ACQUISITION_STATUS
+
+RING_NAME = f'pdp_test_ring_{os.getpid()}'
+
+class TestRingBuffer(unittest.TestCase):
+    def setUp(self):
+        self.writer = RingBufferWriter(['A', 'B'], ['Pa', 'K'], name=RING_NAME, capacity=8)
+        self.reader = RingBufferReader(RING_NAME)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def test_schema(self):
+        self.assertEqual(self.reader.channels, ['A', 'B'])
+        self.assertEqual(self.reader.units, ['Pa', 'K'])
+        self.assertEqual(self.reader.capacity, 8)
+
+    def test_read_in_order(self):
+        for i in range(5):
+            self.writer.write(float(i), [i, -i])
+        records, overrun = self.reader.read()
+        self.assertEqual(overrun, 0)
+        self.assertEqual(records[:, 0].tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(records[:, 2].tolist(), [0, -1, -2, -3, -4])
+        records, overrun = self.reader.read()
+        self.assertEqual(len(records), 0)
+
+    def test_stage_marks(self):
+        self.writer.write(0.0, [0, 0])
+        before = time.monotonic()
+        self.writer.write_frames(np.array([1.0, 2.0]), np.zeros((2, 2)), (10.0, 11.0))
+        sequences, records, overrun = self.reader.read_sequenced()
+        marks = self.reader.marks(sequences)
+        self.assertTrue(np.isnan(marks[0, :2]).all())
+        self.assertEqual(marks[1:, :2].tolist(), [[10.0, 11.0], [10.0, 11.0]])
+        self.assertTrue((marks[1:, 2] >= before).all())
+
+    def test_status(self):
+        self.assertEqual(set(self.reader.status().values()), {0.0})
+        self.writer.write_status({'backlog': 12, 'gaps': 1, 'lag': 0.002})
+        status = self.reader.status()
+        self.assertEqual(set(status), set(ACQUISITION_STATUS))
+        self.assertEqual((status['backlog'], status['gaps'], status['lag']), (12.0, 1.0, 0.002))
+
+    def test_overrun(self):
+        for i in range(20):
+            self.writer.write(float(i), [i, i])
+        records, overrun = self.reader.read()
+        self.assertEqual(overrun, 12)
+        self.assertEqual(records[:, 0].tolist(), list(range(12, 20)))
+
+    def test_sequences(self):
+        for i in range(3):
+            self.writer.write(float(i), [i, i])
+        sequences, records, overrun = self.reader.read_sequenced()
+        self.assertEqual(sequences.tolist(), [0, 1, 2])
+
+    def test_write_frames(self):
+        self.writer.write(0.0, [0, 0])
+        self.writer.write_frames(np.array([1.0, 2.0]), np.array([[1, -1], [2, -2]]))
+        sequences, records, overrun = self.reader.read_sequenced()
+        self.assertEqual(sequences.tolist(), [0, 1, 2])
+        self.assertEqual(records[:, 2].tolist(), [0, -1, -2])
+
+    def test_write_frames_larger_than_ring(self):
+        timestamps = np.arange(20, dtype=np.float64)
+        self.writer.write_frames(timestamps, np.column_stack([timestamps, timestamps]))
+        records, overrun = self.reader.read()
+        self.assertEqual(overrun, 12)
+        self.assertEqual(records[:, 0].tolist(), list(range(12, 20)))
+
+    def test_independent_cursors(self):
+        other = RingBufferReader(RING_NAME)
+        self.writer.write(1.0, [1, 1])
+        self.assertEqual(len(self.reader.read()[0]), 1)
+        self.writer.write(2.0, [2, 2])
+        self.assertEqual(len(other.read()[0]), 2)
+        other.close()
+
+    def test_replaced_by_restart(self):
+        self.assertFalse(self.reader.replaced())
+
+        # A restarted writer swaps a new ring in, the old one is never
+        # written again
+        self.writer.write(1.0, [1, 1])
+        writer = RingBufferWriter(['A', 'B', 'C'], name=RING_NAME, capacity=8)
+        self.assertTrue(self.reader.replaced())
+        self.assertEqual(len(self.reader.read()[0]), 1)
+
+        reader = RingBufferReader(RING_NAME)
+        self.assertEqual(reader.channels, ['A', 'B', 'C'])
+        writer.write(2.0, [2, 2, 2])
+        self.assertEqual(reader.read()[0][:, 0].tolist(), [2.0])
+
+        # A writer that stops removes the ring
+        writer.close()
+        self.assertTrue(reader.replaced())
+        reader.close()
+
+        # Put one back for tearDown
+        self.writer = RingBufferWriter(['A', 'B'], name=RING_NAME, capacity=8)
+
+if __name__ == '__main__':
+    unittest.main()
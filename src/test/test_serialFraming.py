@@ -0,0 +1,43 @@
+import unittest
+from serialInterface.serialCommandTypes import DataTypes
+from serialInterface.serialFraming import SerialFramer, parse_message, diff_summary, MAX_LINE_LENGTH
+
+class TestSerialFramer(unittest.TestCase):
+    def setUp(self):
+        self.framer = SerialFramer()
+
+    def test_line_split_across_reads(self):
+        self.assertEqual(self.framer.feed(b'VC,SUMM'), [])
+        self.assertEqual(self.framer.feed(b'ARY,MEV,OPEN\r\nVC,'), [b'VC,SUMMARY,MEV,OPEN'])
+        self.assertEqual(self.framer.feed(b'ABORT\n'), [b'VC,ABORT'])
+
+    def test_several_lines_in_one_read(self):
+        self.assertEqual(self.framer.feed(b'VC,ABORT\n\r\nVC,UNABORT\n'), [b'VC,ABORT', b'VC,UNABORT'])
+
+    def test_overlong_line_discarded(self):
+        self.framer.feed(b'x' * (MAX_LINE_LENGTH + 1))
+        self.assertEqual(self.framer.discarded, MAX_LINE_LENGTH + 1)
+        self.assertEqual(self.framer.feed(b'\nVC,ABORT\n'), [b'VC,ABORT'])
+
+class TestParser(unittest.TestCase):
+    def test_parse(self):
+        message = parse_message(b'VC,STATUS,ARMED,')
+        self.assertEqual(message.source, 'VC')
+        self.assertIs(message.data_type, DataTypes.STATUS)
+        self.assertEqual(message.fields, [b'ARMED'])
+
+    def test_unknown(self):
+        self.assertIsNone(parse_message(b'garbage').data_type)
+        self.assertIsNone(parse_message(b'VC,NOPE').data_type)
+
+    def test_summary_reports_every_change(self):
+        state = {'MEV': 'CLOSE', 'NCV': 'CLOSE', 'RTV': 'CLOSE'}
+        message = parse_message(b'VC,SUMMARY,MEV,OPEN,NCV,CLOSE,RTV,OPEN,BOGUS,OPEN')
+        changes, unknown = diff_summary(message, state)
+        self.assertEqual(changes, {'MEV': 'OPEN', 'RTV': 'OPEN'})
+        self.assertEqual(state, {'MEV': 'OPEN', 'NCV': 'CLOSE', 'RTV': 'OPEN'})
+        self.assertEqual(unknown, ['BOGUS=OPEN'])
+        self.assertEqual(diff_summary(message, state)[0], {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,112 @@
+import os
+import json
+import asyncio
+import tempfile
 import unittest
-from  serial import Serial
+from serialInterface.serialInterface import SerialInterface
+from serialInterface.commandScheduler import CommandScheduler, SUPPRESSED
+from serialInterface.arduinoSimulator import ArduinoSimulator, ABORT_STATE
 
+def valve_command(valve, action):
+    return json.dumps({'command': 'CTRL', 'valve': valve, 'action': action})
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "the Arduino simulator needs a pty")
 class TestSerialInterface(unittest.TestCase):
-    def test():
-        pass
\ No newline at end of file
+    def setUp(self):
+        # serial.log is written to the working directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def run_with_simulator(self, simulator, scenario):
+        async def run():
+            simulator.start()
+            serial = SerialInterface(port=simulator.port)
+            feedback = asyncio.Queue()
+            scheduler = CommandScheduler(feedback)
+            tasks = [asyncio.create_task(serial.receive_loop(feedback))]
+            try:
+                return await asyncio.wait_for(scenario(serial, scheduler, feedback, tasks), 5)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                serial.close()
+                simulator.stop()
+        return asyncio.run(run())
+
+    def test_command_confirmed_by_summary(self):
+        async def scenario(serial, scheduler, feedback, tasks):
+            tasks.append(asyncio.create_task(serial.send_async(scheduler)))
+            scheduler.put(valve_command('MEV', 'OPEN'))
+            message = await feedback.get()
+            self.assertEqual(message['valves'], {'MEV': 'OPEN'})
+            return serial.latency_stats()['valves']['MEV']
+
+        stats = self.run_with_simulator(ArduinoSimulator(actuation_delay=0.05, summary_interval=0), scenario)
+        self.assertEqual(stats['count'], 1)
+        self.assertGreaterEqual(stats['max_ms'], 50)
+
+    def test_abort_written_first(self):
+        simulator = ArduinoSimulator(actuation_delay=0.05, summary_interval=0)
+
+        async def scenario(serial, scheduler, feedback, tasks):
+            scheduler.put(valve_command('MEV', 'OPEN'))
+            scheduler.put(valve_command('NCV', 'OPEN'))
+            scheduler.put('{"command": "ABORT"}')
+            tasks.append(asyncio.create_task(serial.send_async(scheduler)))
+            scheduler.put(valve_command('RTV', 'OPEN'))
+            while True:
+                message = await feedback.get()
+                if message['command'] == 'FEEDBACK':
+                    return message['valves']
+
+        # The valve commands queued before the ABORT are dropped, the one
+        # after it is ignored by the VC
+        valves = self.run_with_simulator(simulator, scenario)
+        self.assertEqual(simulator.received[:2], [b'VC,ABORT', b'VC,CTRL,RTV,OPEN'])
+        self.assertTrue(simulator.aborted)
+        self.assertEqual(valves, {'N2OV': 'OPEN', 'ERV': 'OPEN'})
+        self.assertEqual(simulator.valve_state, ABORT_STATE)
+
+    def test_invalid_command_does_not_stop_sending(self):
+        simulator = ArduinoSimulator(actuation_delay=0.01, summary_interval=0)
+
+        async def scenario(serial, scheduler, feedback, tasks):
+            # put() rejects this, only a command changed after queuing gets
+            # through
+            scheduler.put(valve_command('MEV', 'OPEN')).message = {'command': 'CTRL', 'valve': 'MEV'}
+            tasks.append(asyncio.create_task(serial.send_async(scheduler)))
+            await asyncio.sleep(0.05)
+            scheduler.put('{"command": "ABORT"}')
+            while not simulator.received:
+                await asyncio.sleep(0.01)
+
+        self.run_with_simulator(simulator, scenario)
+        self.assertEqual(simulator.received, [b'VC,ABORT'])
+
+    def test_suppressed_once_state_is_known(self):
+        async def scenario(serial, scheduler, feedback, tasks):
+            tasks.append(asyncio.create_task(serial.send_async(scheduler)))
+            # Every valve starts CLOSE, wait for a SUMMARY to confirm it
+            await asyncio.sleep(0.1)
+            scheduler.put(valve_command('MEV', 'CLOSE'))
+            return await feedback.get()
+
+        report = self.run_with_simulator(ArduinoSimulator(summary_interval=0.02), scenario)
+        self.assertEqual((report['command'], report['valve']), (SUPPRESSED, 'MEV'))
+
+    def test_line_noise(self):
+        async def scenario(serial, scheduler, feedback, tasks):
+            tasks.append(asyncio.create_task(serial.send_async(scheduler)))
+            scheduler.put(valve_command('RTV', 'OPEN'))
+            return await feedback.get()
+
+        simulator = ArduinoSimulator(actuation_delay=0.01, summary_interval=0, noise_rate=1.0, seed=1)
+        self.assertEqual(self.run_with_simulator(simulator, scenario)['valves'], {'RTV': 'OPEN'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+import multiprocessing
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'instrumentation'))
+
+from stage_queue import StageQueue, StageQueueError, BLOCK, DROP_NEWEST
+
+def produce(queue, count):
+    for i in range(count):
+        queue.put(np.full(4, i, dtype=np.float64))
+    queue.end()
+
+class TestStageQueue(unittest.TestCase):
+    def test_messages_in_order(self):
+        queue = StageQueue(4, 64)
+        queue.put(np.array([1.0, 2.0]), b'abc')
+        queue.put(np.array([3.0]))
+        first = queue.get()
+        self.assertEqual(first[:16].view(np.float64).tolist(), [1.0, 2.0])
+        self.assertEqual(first[16:].tobytes(), b'abc')
+        self.assertEqual(queue.get().view(np.float64).tolist(), [3.0])
+        self.assertIsNone(queue.get(timeout=0.01))
+        queue.close()
+
+    def test_drop_newest(self):
+        queue = StageQueue(2, 8, DROP_NEWEST)
+        self.assertEqual([queue.put(np.array([float(i)])) for i in range(3)], [True, True, False])
+        stats = queue.stats()
+        self.assertEqual((stats['depth'], stats['max_depth'], stats['dropped']), (2, 2, 1))
+        self.assertEqual(queue.get().view(np.float64)[0], 0.0)
+        queue.close()
+
+    def test_block_waits_for_release(self):
+        queue = StageQueue(1, 8, BLOCK)
+        queue.put(np.array([1.0]))
+        self.assertFalse(queue.put(np.array([2.0]), timeout=0.01))
+        self.assertGreater(queue.stats()['blocked'], 0)
+
+        # The slot is only free once the consumer moves on from it
+        queue.get()
+        self.assertFalse(queue.put(np.array([2.0]), timeout=0.01))
+        queue.release()
+        self.assertTrue(queue.put(np.array([2.0])))
+        queue.close()
+
+    def test_message_too_large(self):
+        queue = StageQueue(1, 8)
+        with self.assertRaises(StageQueueError):
+            queue.put(np.zeros(2))
+        queue.close()
+
+    def test_between_processes(self):
+        queue = StageQueue(8, 32, BLOCK)
+        producer = multiprocessing.get_context('fork').Process(target=produce, args=(queue, 100))
+        producer.start()
+        received = []
+        while len(message := queue.get(timeout=5)):
+            received.append(message.view(np.float64)[0])
+        producer.join()
+        self.assertEqual(received, list(range(100)))
+        queue.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,130 @@
+import os
+import json
+import socket
+import asyncio
+import tempfile
 import unittest
+import websockets
+import numpy as np
+from unittest import mock
+from instrumentation.ring_buffer import RingBufferWriter
+from server.wss import WebSocketServer, INSTRUMENTATION_WS_TYPE
+
+RING_NAME = f'pdp_test_wss_ring_{os.getpid()}'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
 
 class TestWSS(unittest.TestCase):
     def test():
-        pass
\ No newline at end of file
+        pass
+
+class TestInstrumentationServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # ws-server.log is written to the working directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+        self.port = free_port()
+        self.wss = WebSocketServer(INSTRUMENTATION_WS_TYPE, host='localhost', port=self.port,
+                                   ring_name=RING_NAME, metrics_port=free_port())
+        self.tasks = []
+
+    async def asyncTearDown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    async def connect(self):
+        for _ in range(100):
+            try:
+                return await websockets.connect(f'ws://localhost:{self.port}')
+            except OSError:
+                await asyncio.sleep(0.01)
+
+    async def receive_value(self, websocket, writer, value):
+        # Writes until the client receives the value, the server only
+        # publishes once it has attached
+        while True:
+            writer.write_frames(np.array([value]), np.array([[value, value]]))
+            try:
+                frame = json.loads(await asyncio.wait_for(websocket.recv(), 0.05))
+            except asyncio.TimeoutError:
+                continue
+            if frame['data']['A'] == value:
+                return frame
+
+    async def test_attaches_again_when_the_writer_restarts(self):
+        writer = RingBufferWriter(['A', 'B'], name=RING_NAME, capacity=64)
+        with mock.patch('server.wss.RING_CHECK_INTERVAL', 0.05):
+            self.tasks.append(asyncio.create_task(self.wss.start_instrumentation()))
+            websocket = await self.connect()
+            try:
+                await asyncio.wait_for(self.receive_value(websocket, writer, 1.0), 5)
+
+                # read_labjack.py restarted: the old ring is replaced
+                restarted = RingBufferWriter(['A', 'B'], name=RING_NAME, capacity=64)
+                await asyncio.wait_for(self.receive_value(websocket, restarted, 2.0), 5)
+
+                # Stopped and started again: the ring is removed, then made
+                restarted.close()
+                await asyncio.sleep(0.1)
+                writer = RingBufferWriter(['A', 'B'], name=RING_NAME, capacity=64)
+                await asyncio.wait_for(self.receive_value(websocket, writer, 3.0), 5)
+            finally:
+                await websocket.close()
+                writer.close()
+
+    async def test_configure_before_acquisition(self):
+        with mock.patch('server.wss.CONFIGURE_TIMEOUT', 0.05):
+            self.tasks.append(asyncio.create_task(self.wss.start_instrumentation()))
+            websocket = await self.connect()
+            try:
+                await websocket.send(json.dumps({"identifier": "CONFIGURE", "format": "BINARY"}))
+                reply = json.loads(await asyncio.wait_for(websocket.recv(), 5))
+                self.assertEqual(reply["identifier"], "ERROR")
+
+                # Later requests are answered
+                await websocket.send(json.dumps({"identifier": "STATS"}))
+                reply = json.loads(await asyncio.wait_for(websocket.recv(), 5))
+                self.assertEqual(reply["identifier"], "STATS")
+            finally:
+                await websocket.close()
+
+        # Waits for acquisition to start within the timeout
+        websocket = await self.connect()
+        writer = None
+        try:
+            await websocket.send(json.dumps({"identifier": "CONFIGURE", "format": "BINARY"}))
+            writer = RingBufferWriter(['A', 'B'], name=RING_NAME, capacity=64)
+            reply = json.loads(await asyncio.wait_for(websocket.recv(), 5))
+            self.assertEqual(reply["identifier"], "SCHEMA")
+        finally:
+            await websocket.close()
+            if writer is not None:
+                writer.close()
+
+    async def test_metrics_port_in_use(self):
+        with socket.socket() as taken:
+            taken.bind(('localhost', 0))
+            taken.listen()
+            self.wss = WebSocketServer(INSTRUMENTATION_WS_TYPE, host='localhost', port=self.port,
+                                       ring_name=RING_NAME, metrics_port=taken.getsockname()[1])
+            self.tasks.append(asyncio.create_task(self.wss.start_instrumentation()))
+
+            # The websocket serves without the metrics
+            websocket = await self.connect()
+            try:
+                await websocket.send(json.dumps({"identifier": "STATS"}))
+                reply = json.loads(await asyncio.wait_for(websocket.recv(), 5))
+                self.assertEqual(reply["identifier"], "STATS")
+            finally:
+                await websocket.close()
+
+if __name__ == '__main__':
+    unittest.main()